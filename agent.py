@@ -1,22 +1,34 @@
 # agent.py
+import os
 from langchain.agents import initialize_agent, AgentType
 from local_llm import load_local_llm
 from tools import CourseRecommenderTool, ProgramComparatorTool
+from generation_modes import react_mode
+from agent_cache import CACHE_ENABLED, cached_llm, cached_tools
 
-def get_agent_executor(retriever):
-    llm = load_local_llm()
+# Подробный вывод шагов агента в stdout нужен только при отладке
+AGENT_VERBOSE = os.getenv("AGENT_VERBOSE", "0") == "1"
 
+def get_agent_executor(retriever):
     tools = [
         CourseRecommenderTool(),
         ProgramComparatorTool(retriever=retriever),
     ]
 
+    # Грамматика ReAct не дает модели выйти из формата шага, поэтому повторы разбора не нужны
+    llm = load_local_llm(generation_mode=react_mode([tool.name for tool in tools]))
+
+    # Повторный запрос проходит те же шаги: ответы LLM и результаты инструментов берутся из кэша
+    if CACHE_ENABLED:
+        tools = cached_tools(tools)
+        llm = cached_llm(llm)
+
     agent_executor = initialize_agent(
         tools,
         llm,
         agent=AgentType.ZERO_SHOT_REACT_DESCRIPTION,
-        verbose=True,
+        verbose=AGENT_VERBOSE,
         handle_parsing_errors=True
     )
 
-    return agent_executor
\ No newline at end of file
+    return agent_executor
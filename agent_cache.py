@@ -0,0 +1,148 @@
+# agent_cache.py
+"""
+Кэш шагов агента ReAct: результатов инструментов и ответов LLM на промежуточных шагах.
+
+Инструменты из tools.py - чистые функции входной строки, а шаги агента генерируются жадно
+(см. generation_modes.react_mode), поэтому для повторного запроса агент проходит те же
+шаги "мысль -> действие -> наблюдение". Результат инструмента кэшируется по (имя инструмента,
+нормализованный вход), ответ LLM - по хешу полного промпта. Оба кэша ограничены по размеру
+(LRU) и по времени жизни записи (TTL); кэши создаются вместе с агентом, поэтому при смене
+версии индекса старые результаты не используются.
+"""
+import os
+import re
+import json
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Any, Optional
+
+from langchain.tools import BaseTool
+from langchain_core.runnables import Runnable
+
+import telemetry
+from local_llm import GENERATION_ERROR_ANSWER
+
+# Кэш выключается AGENT_CACHE=0
+CACHE_ENABLED = os.getenv("AGENT_CACHE", "1") == "1"
+# Максимальное число записей в каждом кэше
+DEFAULT_MAX_SIZE = int(os.getenv("AGENT_CACHE_SIZE", "256"))
+# Время жизни записи, секунд
+DEFAULT_TTL = float(os.getenv("AGENT_CACHE_TTL", "3600"))
+
+
+class TTLCache:
+    """LRU-кэш с временем жизни записей; потокобезопасен."""
+
+    def __init__(self, name: str, max_size: int = DEFAULT_MAX_SIZE, ttl: float = DEFAULT_TTL):
+        self.name = name
+        self.max_size = max_size
+        self.ttl = ttl
+        self._items: "OrderedDict[Any, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Any) -> Optional[Any]:
+        with self._lock:
+            item = self._items.get(key)
+            if item is not None and time.monotonic() - item[1] > self.ttl:
+                del self._items[key]
+                item = None
+            if item is not None:
+                self._items.move_to_end(key)
+        telemetry.record_cache(self.name, item is not None)
+        return item[0] if item is not None else None
+
+    def put(self, key: Any, value: Any):
+        with self._lock:
+            self._items[key] = (value, time.monotonic())
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._items)
+
+
+def normalize_input(text: str) -> str:
+    """
+    Нормализует вход инструмента: регистр, пробелы, кавычки и пунктуация по краям
+    (модель по-разному оформляет Action Input для одного и того же запроса).
+    """
+    text = re.sub(r"\s+", " ", str(text)).strip().lower()
+    return text.strip(" \"'«»`.,;:!?")
+
+
+def prompt_key(prompt: Any, **kwargs) -> str:
+    """
+    Хеш полного промпта вместе с параметрами вызова (стоп-слова и т.д.).
+    """
+    if hasattr(prompt, "to_string"):
+        prompt = prompt.to_string()
+    elif not isinstance(prompt, str):
+        prompt = json.dumps(prompt, ensure_ascii=False, sort_keys=True, default=str)
+    params = json.dumps(kwargs, ensure_ascii=False, sort_keys=True, default=str)
+    return hashlib.sha256(f"{prompt}\x00{params}".encode("utf-8")).hexdigest()
+
+
+def is_cacheable_result(result: Any) -> bool:
+    if not isinstance(result, str) or not result.strip():
+        return False
+    return result != GENERATION_ERROR_ANSWER and not result.lstrip().lower().startswith(("ошибка", "error"))
+
+
+class CachedTool(BaseTool):
+    """Инструмент агента с кэшем результатов по нормализованному входу."""
+    name: str
+    description: str
+    tool: BaseTool
+    cache: Any = None
+
+    def _run(self, query: str) -> str:
+        key = (self.tool.name, normalize_input(query))
+        result = self.cache.get(key)
+        if result is None:
+            result = self.tool._run(query)
+            # Пустой результат и сообщение об ошибке не кэшируем: следующий вызов может пройти успешно
+            if is_cacheable_result(result):
+                self.cache.put(key, result)
+        return result
+
+
+class CachedLLM(Runnable):
+    """Обертка LLM для шагов агента: одинаковый промпт не генерируется повторно."""
+
+    def __init__(self, llm: Runnable, cache: TTLCache):
+        self.llm = llm
+        self.cache = cache
+
+    def invoke(self, input: Any, config=None, **kwargs) -> str:
+        key = prompt_key(input, **kwargs)
+        result = self.cache.get(key)
+        if result is None:
+            result = self.llm.invoke(input, config, **kwargs)
+            self._store(key, result)
+        return result
+
+    async def ainvoke(self, input: Any, config=None, **kwargs) -> str:
+        key = prompt_key(input, **kwargs)
+        result = self.cache.get(key)
+        if result is None:
+            result = await self.llm.ainvoke(input, config, **kwargs)
+            self._store(key, result)
+        return result
+
+    def _store(self, key: str, result: str):
+        # Ответ-заглушку после ошибки генерации и пустой ответ не кэшируем
+        if is_cacheable_result(result):
+            self.cache.put(key, result)
+
+
+def cached_tools(tools, max_size: int = DEFAULT_MAX_SIZE, ttl: float = DEFAULT_TTL):
+    cache = TTLCache("agent_tool", max_size, ttl)
+    return [CachedTool(name=tool.name, description=tool.description, tool=tool, cache=cache) for tool in tools]
+
+
+def cached_llm(llm: Runnable, max_size: int = DEFAULT_MAX_SIZE, ttl: float = DEFAULT_TTL) -> CachedLLM:
+    return CachedLLM(llm, TTLCache("agent_llm", max_size, ttl))
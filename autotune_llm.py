@@ -0,0 +1,174 @@
+# autotune_llm.py
+"""
+Автоподбор профиля llama.cpp под CPU хоста.
+
+Для каждой комбинации (потоки, потоки батча, размер батча) модель загружается заново
+(с mmap это быстро - веса берутся из page cache), после чего измеряются скорость prompt-eval
+и decode. Лучшая комбинация по оценке времени типичного запроса записывается в файл профилей
+(llm_profile.json) как активный профиль.
+
+Квантизация при этом не меняется: меньшая квантизация всегда быстрее, но может ухудшить
+ответы, а качество здесь не измеряется. Другие варианты (--quantizations) замеряются с лучшими
+найденными потоками и батчем и выводятся рядом для сравнения; переключиться на них можно
+вручную (LLM_QUANTIZATION или профиль).
+
+Пример:
+    python autotune_llm.py --quantizations q4_K,q5_K --prompt-tokens 1500 --decode-tokens 200
+"""
+import argparse
+import logging
+import socket
+import time
+from dataclasses import replace
+from typing import Any, Dict, List, Optional, Tuple
+
+import telemetry
+from llm_config import PROFILE_FILE, RuntimeProfile, load_profile, physical_cpu_count, save_profile
+from local_llm import create_llama, read_llama_timings, reset_llama_timings
+
+logger = logging.getLogger(__name__)
+
+# Фрагмент, похожий на реальный контекст RAG; повторяется до нужной длины промпта
+BENCH_TEXT = (
+    "Искусственный интеллект институт прикладных компьютерных наук форма обучения Очная "
+    "длительность 2 Года язык обучения Русский стоимость контрактного обучения (год) 599 000 ₽ "
+    "общежитие Да военный учебный центр Да направления подготовки 09.04.01 Информатика и "
+    "вычислительная техника 51 бюджетных 4 целевая 55 контрактных. "
+)
+
+
+def thread_candidates(cores: int) -> List[int]:
+    """
+    Кандидаты числа потоков: от половины до всех физических ядер (и немного сверх).
+    """
+    values = {max(1, cores // 2), max(1, (cores * 3) // 4), cores, cores + max(1, cores // 4)}
+    return sorted(values)
+
+
+def build_prompt(model, target_tokens: int) -> str:
+    """
+    Собирает промпт заданной длины в токенах модели.
+    """
+    unit_tokens = max(1, len(model.tokenize(BENCH_TEXT.encode("utf-8"))))
+    return BENCH_TEXT * max(1, target_tokens // unit_tokens)
+
+
+def measure(profile: RuntimeProfile, prompt_tokens: int, decode_tokens: int, repeats: int) -> Dict[str, Any]:
+    """
+    Загружает модель с профилем и измеряет скорость prompt-eval и decode (токенов в секунду).
+    """
+    start = time.perf_counter()
+    model = create_llama(profile)
+    load_seconds = time.perf_counter() - start
+    prompt = build_prompt(model, prompt_tokens)
+
+    pp_speeds, tg_speeds = [], []
+    for _ in range(repeats):
+        # Сбрасываем KV-кэш, чтобы каждый прогон заново считал весь промпт
+        model.reset()
+        reset_llama_timings(model)
+        wall_start = time.perf_counter()
+        response = model.create_completion(prompt, max_tokens=decode_tokens, temperature=0.0)
+        wall = time.perf_counter() - wall_start
+        timings = read_llama_timings(model)
+        usage = response.get("usage", {})
+        if timings and timings["prompt_eval_ms"] > 0 and timings["eval_ms"] > 0:
+            pp_speeds.append(timings["prompt_eval_tokens"] / (timings["prompt_eval_ms"] / 1000))
+            tg_speeds.append(max(1, timings["eval_tokens"]) / (timings["eval_ms"] / 1000))
+        else:
+            # Без таймингов llama.cpp оцениваем только общую скорость
+            total_tokens = usage.get("prompt_tokens", 0) + usage.get("completion_tokens", 0)
+            pp_speeds.append(total_tokens / wall)
+            tg_speeds.append(total_tokens / wall)
+    del model
+
+    pp = max(pp_speeds)
+    tg = max(tg_speeds)
+    return {
+        "load_seconds": load_seconds,
+        "prompt_eval_tps": pp,
+        "decode_tps": tg,
+        # Оценка времени типичного запроса: промпт с контекстом + ответ
+        "request_seconds": prompt_tokens / pp + decode_tokens / tg,
+    }
+
+
+def run_measure(profile: RuntimeProfile, args) -> Optional[Dict[str, Any]]:
+    logger.info(f"Замер: quant={profile.quantization} threads={profile.n_threads} "
+                f"threads_batch={profile.n_threads_batch} batch={profile.n_batch}")
+    try:
+        return measure(profile, args.prompt_tokens, args.decode_tokens, args.repeats)
+    except Exception as e:
+        logger.error(f"Конфигурация не запустилась: {e}")
+        return None
+
+
+def print_results(results: List[Tuple[RuntimeProfile, Dict[str, Any]]]):
+    print(f"{'quant':<8} {'threads':>7} {'t_batch':>7} {'batch':>6} {'pp tok/s':>9} {'tg tok/s':>9} {'request s':>10}")
+    for profile, stats in results:
+        print(f"{profile.quantization:<8} {profile.n_threads:>7} {profile.n_threads_batch:>7} {profile.n_batch:>6} "
+              f"{stats['prompt_eval_tps']:>9.1f} {stats['decode_tps']:>9.2f} {stats['request_seconds']:>10.2f}")
+
+
+def main():
+    """
+    Перебирает профили, печатает таблицу результатов и сохраняет лучший профиль.
+    """
+    telemetry.setup_logging()
+    parser = argparse.ArgumentParser(description="Автоподбор профиля llama.cpp под CPU хоста")
+    parser.add_argument("--quantizations", default=None,
+                        help="Квантизации через запятую для сравнения с квантизацией профиля (профиль не переключается)")
+    parser.add_argument("--threads", default=None, help="Числа потоков через запятую (по умолчанию - по числу ядер)")
+    parser.add_argument("--batch-sizes", default="256,512", help="Размеры батча через запятую")
+    parser.add_argument("--prompt-tokens", type=int, default=1024, help="Длина тестового промпта в токенах")
+    parser.add_argument("--decode-tokens", type=int, default=128, help="Число генерируемых токенов")
+    parser.add_argument("--repeats", type=int, default=2, help="Повторов на каждую конфигурацию")
+    parser.add_argument("--name", default=f"auto-{socket.gethostname()}", help="Имя сохраняемого профиля")
+    parser.add_argument("--output", default=PROFILE_FILE, help="Файл профилей")
+    parser.add_argument("--dry-run", action="store_true", help="Не сохранять лучший профиль")
+    args = parser.parse_args()
+
+    base = load_profile(path=args.output)
+    cores = physical_cpu_count()
+    threads = [int(t) for t in args.threads.split(",")] if args.threads else thread_candidates(cores)
+    batch_sizes = [int(b) for b in args.batch_sizes.split(",")]
+    logger.info(f"Физических ядер: {cores}; кандидаты потоков: {threads}; батчи: {batch_sizes}; "
+                f"квантизация профиля: {base.quantization}")
+
+    results = []
+    for n_threads in threads:
+        # Prompt-eval хорошо масштабируется по ядрам, поэтому для батча пробуем и все ядра
+        for n_threads_batch in sorted({n_threads, max(n_threads, cores)}):
+            for n_batch in batch_sizes:
+                profile = replace(base, n_threads=n_threads, n_threads_batch=n_threads_batch, n_batch=n_batch)
+                stats = run_measure(profile, args)
+                if stats is not None:
+                    results.append((profile, stats))
+
+    if not results:
+        logger.error("Ни одна конфигурация не была успешно измерена")
+        return
+
+    print_results(sorted(results, key=lambda r: r[1]["request_seconds"]))
+    best_profile, best_stats = min(results, key=lambda r: r[1]["request_seconds"])
+    logger.info(f"Лучший профиль: {best_profile.to_dict()} ({best_stats['request_seconds']:.2f} с на запрос)")
+
+    # Другие квантизации только для сравнения: путь к файлу модели выбирается по квантизации
+    others = [q for q in (args.quantizations or "").split(",") if q and q != base.quantization]
+    if others:
+        compared = [(best_profile, best_stats)]
+        for quantization in others:
+            profile = replace(best_profile, quantization=quantization, model_path=None)
+            stats = run_measure(profile, args)
+            if stats is not None:
+                compared.append((profile, stats))
+        print("\nСравнение квантизаций (профиль не переключается; качество ответов не измерялось):")
+        print_results(compared)
+
+    if not args.dry_run:
+        save_profile(best_profile, args.name, path=args.output)
+        logger.info(f"Профиль '{args.name}' сохранен в {args.output} и сделан активным")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,104 @@
+# batch_embedder.py
+"""
+Асинхронное пакетное кодирование запросов для одновременных сообщений бота.
+
+Запросы на эмбеддинг складываются в очередь; фоновая задача ждет несколько миллисекунд,
+собирает пакет и выполняет один вызов embed_documents в отдельном потоке. Результаты
+возвращаются каждому ожидающему обработчику, а цикл событий не блокируется кодированием.
+Пока идет кодирование одного пакета, в очереди копится следующий.
+"""
+import time
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional, Tuple
+
+from langchain_core.embeddings import Embeddings
+
+import telemetry
+
+logger = logging.getLogger(__name__)
+
+BATCH_SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64)
+WAIT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+
+telemetry.metrics.describe("embedding_batch_size", "Число запросов в одном пакетном кодировании")
+telemetry.metrics.describe("embedding_batch_wait_seconds", "Ожидание запроса в очереди до начала кодирования")
+
+
+class BatchEmbedder:
+    """Объединяет одновременные запросы на эмбеддинг в пакеты."""
+
+    def __init__(self, embeddings: Embeddings, max_batch_size: int = 32, max_wait_ms: float = 5.0,
+                 executor: Optional[ThreadPoolExecutor] = None):
+        self.embeddings = embeddings
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.executor = executor or ThreadPoolExecutor(max_workers=1, thread_name_prefix="embedder")
+        self._queue: Optional[asyncio.Queue] = None
+        self._worker: Optional[asyncio.Task] = None
+
+    def _ensure_worker(self):
+        # Очередь и задача создаются в работающем цикле событий (его создает Application)
+        if self._worker is None or self._worker.done():
+            self._queue = asyncio.Queue()
+            self._worker = asyncio.get_running_loop().create_task(self._run(), name="batch-embedder")
+
+    async def embed_query(self, text: str) -> List[float]:
+        self._ensure_worker()
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((text, future, time.perf_counter()))
+        return await future
+
+    async def _collect(self) -> List[Tuple[str, asyncio.Future, float]]:
+        """
+        Ждет первый запрос, затем добирает пакет до max_batch_size или до истечения max_wait.
+        """
+        batch = [await self._queue.get()]
+        deadline = asyncio.get_running_loop().time() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - asyncio.get_running_loop().time()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), remaining))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await self._collect()
+            # Запросы, чьи обработчики уже отменены, не кодируем
+            batch = [item for item in batch if not item[1].done()]
+            if not batch:
+                continue
+            started = time.perf_counter()
+            for _, _, enqueued in batch:
+                telemetry.metrics.observe("embedding_batch_wait_seconds", started - enqueued, buckets=WAIT_BUCKETS)
+            telemetry.metrics.observe("embedding_batch_size", len(batch), buckets=BATCH_SIZE_BUCKETS)
+
+            # Одинаковые тексты в пакете кодируются один раз
+            texts = list(dict.fromkeys(text for text, _, _ in batch))
+            try:
+                vectors = await loop.run_in_executor(self.executor, self.embeddings.embed_documents, texts)
+            except Exception as e:
+                logger.error(f"Ошибка пакетного кодирования ({len(texts)} текстов): {e}")
+                for _, future, _ in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            by_text = dict(zip(texts, vectors))
+            for text, future, _ in batch:
+                if not future.done():
+                    future.set_result(by_text[text])
+
+    async def close(self):
+        if self._worker is not None:
+            self._worker.cancel()
+            try:
+                await self._worker
+            except asyncio.CancelledError:
+                pass
+        self.executor.shutdown(wait=False)
@@ -0,0 +1,257 @@
+# benchmark_retrieval.py
+"""
+Бенчмарк качества и скорости поиска по размеченному набору вопросов абитуриентов.
+
+Для каждой комбинации (чанкер, модель эмбеддингов, индекс) строит индекс,
+прогоняет вопросы из benchmarks/retrieval_questions.json и считает recall@k, MRR,
+время построения индекса и задержку каждого запроса.
+
+Пример:
+    python benchmark_retrieval.py --chunkers default,500:50 --indexes chroma,exact,int8,binary --k 1,3,5
+"""
+import os
+import json
+import time
+import argparse
+import statistics
+from typing import List, Dict, Any, Callable
+
+import numpy as np
+from sentence_transformers import SentenceTransformer
+
+import index_versions
+from quantized_index import QuantizedIndex
+
+QUESTIONS_FILE = os.path.join("benchmarks", "retrieval_questions.json")
+PROCESSED_FILE = os.path.join("processed_data", "processed_documents.json")
+DEFAULT_MODEL = "distiluse-base-multilingual-cased-v1"
+DEFAULT_CHUNKER = "default"
+
+
+def load_questions(path: str = QUESTIONS_FILE) -> List[Dict[str, Any]]:
+    """
+    Загружает размеченный набор вопросов.
+    """
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def load_documents(chunker: str) -> List[Dict[str, Any]]:
+    """
+    Возвращает чанки для заданной конфигурации чанкера.
+
+    'default' - готовые чанки из processed_documents.json (те же, что в боевом индексе),
+    'SIZE:OVERLAP' - повторное разбиение исходных данных через process_data.
+    """
+    if chunker == DEFAULT_CHUNKER:
+        with open(PROCESSED_FILE, 'r', encoding='utf-8') as f:
+            return json.load(f)
+
+    from process_data import collect_documents
+    chunk_size, overlap = (int(x) for x in chunker.split(":"))
+    return collect_documents(chunk_size=chunk_size, overlap=overlap)
+
+
+def _normalize(text: str) -> str:
+    return ' '.join(text.split())
+
+
+def relevant_ids_for(question: Dict[str, Any], documents: List[Dict[str, Any]], use_labels: bool) -> set:
+    """
+    Определяет множество релевантных чанков для вопроса.
+
+    Для боевого чанкера используются размеченные id. Для других чанкеров id не совпадают,
+    поэтому релевантным считается чанк нужной программы, содержащий один из эталонных фрагментов.
+    """
+    if use_labels:
+        return set(question["relevant_ids"])
+
+    relevant = set()
+    for doc in documents:
+        if doc["metadata"].get("program_name") not in question["programs"]:
+            continue
+        text = _normalize(doc["text"])
+        if any(snippet in text for snippet in question["answer_snippets"]):
+            relevant.add(doc["id"])
+    return relevant
+
+
+class ExactIndex:
+    """Точный поиск по косинусной близости (полный перебор на NumPy)."""
+
+    def __init__(self, ids: List[str], embeddings: np.ndarray):
+        self.ids = ids
+        norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+        self.matrix = embeddings / np.maximum(norms, 1e-12)
+
+    def search(self, query_embedding: np.ndarray, k: int) -> List[str]:
+        query = query_embedding / max(np.linalg.norm(query_embedding), 1e-12)
+        scores = self.matrix @ query
+        top = np.argsort(-scores)[:k]
+        return [self.ids[i] for i in top]
+
+
+class ChromaIndex:
+    """In-memory коллекция Chroma с теми же настройками, что и боевая."""
+
+    def __init__(self, ids: List[str], embeddings: np.ndarray):
+        import chromadb
+        from chromadb.config import Settings
+        client = chromadb.EphemeralClient(settings=Settings(anonymized_telemetry=False))
+        name = f"benchmark_{int(time.time() * 1000)}"
+        self.collection = client.create_collection(name=name, metadata=index_versions.COLLECTION_METADATA)
+        self.collection.add(ids=ids, embeddings=embeddings.tolist())
+
+    def search(self, query_embedding: np.ndarray, k: int) -> List[str]:
+        k = min(k, self.collection.count())
+        result = self.collection.query(query_embeddings=[query_embedding.tolist()], n_results=k)
+        return result["ids"][0]
+
+
+class QuantizedBenchmarkIndex:
+    """Двухэтапный поиск по квантованным кодам (см. quantized_index.py)."""
+
+    def __init__(self, ids: List[str], embeddings: np.ndarray, mode: str):
+        self.index = QuantizedIndex.build(ids, embeddings, mode=mode)
+
+    def search(self, query_embedding: np.ndarray, k: int) -> List[str]:
+        return [doc_id for doc_id, _ in self.index.search(query_embedding, k)]
+
+
+INDEX_BUILDERS: Dict[str, Callable[[List[str], np.ndarray], Any]] = {
+    "exact": ExactIndex,
+    "chroma": ChromaIndex,
+    "int8": lambda ids, embeddings: QuantizedBenchmarkIndex(ids, embeddings, "int8"),
+    "binary": lambda ids, embeddings: QuantizedBenchmarkIndex(ids, embeddings, "binary"),
+}
+
+
+def evaluate_config(
+        chunker: str,
+        model_name: str,
+        index_name: str,
+        questions: List[Dict[str, Any]],
+        ks: List[int],
+        models_cache: Dict[str, SentenceTransformer]
+) -> Dict[str, Any]:
+    """
+    Строит индекс для одной конфигурации и считает метрики по всем вопросам.
+    """
+    documents = load_documents(chunker)
+    if model_name not in models_cache:
+        models_cache[model_name] = SentenceTransformer(model_name)
+    model = models_cache[model_name]
+
+    ids = [doc["id"] for doc in documents]
+    texts = [doc["text"] for doc in documents]
+
+    # Время построения индекса = эмбеддинги документов + наполнение индекса
+    start = time.perf_counter()
+    doc_embeddings = np.asarray(model.encode(texts), dtype=np.float32)
+    embed_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    index = INDEX_BUILDERS[index_name](ids, doc_embeddings)
+    index_seconds = time.perf_counter() - start
+
+    max_k = max(ks)
+    hits_at_k = {k: [] for k in ks}
+    reciprocal_ranks = []
+    latencies_ms = []
+    per_query = []
+
+    use_labels = chunker == DEFAULT_CHUNKER
+    for question in questions:
+        relevant = relevant_ids_for(question, documents, use_labels)
+
+        start = time.perf_counter()
+        query_embedding = np.asarray(model.encode(question["question"]), dtype=np.float32)
+        found = index.search(query_embedding, max_k)
+        latencies_ms.append((time.perf_counter() - start) * 1000)
+
+        if not relevant:
+            # Вопрос без релевантных чанков в этой конфигурации считаем промахом
+            for k in ks:
+                hits_at_k[k].append(0.0)
+            reciprocal_ranks.append(0.0)
+            per_query.append({"question": question["question"], "found": found, "relevant": []})
+            continue
+
+        for k in ks:
+            hits_at_k[k].append(len(relevant.intersection(found[:k])) / len(relevant))
+
+        rank = next((i + 1 for i, doc_id in enumerate(found) if doc_id in relevant), None)
+        reciprocal_ranks.append(1.0 / rank if rank else 0.0)
+        per_query.append({"question": question["question"], "found": found, "relevant": sorted(relevant)})
+
+    latencies_sorted = sorted(latencies_ms)
+    return {
+        "chunker": chunker,
+        "model": model_name,
+        "index": index_name,
+        "num_chunks": len(documents),
+        "embed_seconds": embed_seconds,
+        "index_build_seconds": index_seconds,
+        "recall": {str(k): statistics.mean(v) for k, v in hits_at_k.items()},
+        "mrr": statistics.mean(reciprocal_ranks),
+        "latency_ms": {
+            "mean": statistics.mean(latencies_ms),
+            "p50": latencies_sorted[len(latencies_sorted) // 2],
+            "p95": latencies_sorted[min(len(latencies_sorted) - 1, int(len(latencies_sorted) * 0.95))],
+        },
+        "per_query": per_query,
+    }
+
+
+def print_report(results: List[Dict[str, Any]], ks: List[int]):
+    """
+    Печатает сводную таблицу по всем конфигурациям.
+    """
+    recall_headers = " ".join(f"R@{k:<5}" for k in ks)
+    print(f"{'chunker':<10} {'model':<40} {'index':<8} {'chunks':>6} {recall_headers} {'MRR':<6} "
+          f"{'p50 ms':>8} {'p95 ms':>8} {'build s':>8}")
+    print("-" * (100 + 8 * len(ks)))
+    for r in results:
+        recalls = " ".join(f"{r['recall'][str(k)]:<7.3f}" for k in ks)
+        build = r["embed_seconds"] + r["index_build_seconds"]
+        print(f"{r['chunker']:<10} {r['model'][:40]:<40} {r['index']:<8} {r['num_chunks']:>6} {recalls} "
+              f"{r['mrr']:<6.3f} {r['latency_ms']['p50']:>8.2f} {r['latency_ms']['p95']:>8.2f} {build:>8.2f}")
+
+
+def main():
+    """
+    Точка входа CLI: перебирает все комбинации конфигураций и печатает отчет.
+    """
+    parser = argparse.ArgumentParser(description="Бенчмарк качества и скорости поиска")
+    parser.add_argument("--questions", default=QUESTIONS_FILE, help="Файл с размеченными вопросами")
+    parser.add_argument("--chunkers", default=DEFAULT_CHUNKER,
+                        help="Список чанкеров через запятую: 'default' или 'SIZE:OVERLAP'")
+    parser.add_argument("--models", default=DEFAULT_MODEL, help="Список моделей эмбеддингов через запятую")
+    parser.add_argument("--indexes", default="chroma,exact",
+                        help=f"Список индексов через запятую: {', '.join(INDEX_BUILDERS)}")
+    parser.add_argument("--k", default="1,3,5", help="Значения k для recall@k через запятую")
+    parser.add_argument("--output", default=None, help="Сохранить полный отчет в JSON")
+    args = parser.parse_args()
+
+    questions = load_questions(args.questions)
+    ks = sorted(int(k) for k in args.k.split(","))
+    models_cache: Dict[str, SentenceTransformer] = {}
+
+    results = []
+    for chunker in args.chunkers.split(","):
+        for model_name in args.models.split(","):
+            for index_name in args.indexes.split(","):
+                print(f"Оценка: чанкер={chunker}, модель={model_name}, индекс={index_name}")
+                results.append(evaluate_config(chunker, model_name, index_name, questions, ks, models_cache))
+
+    print()
+    print_report(results, ks)
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+        print(f"\nПолный отчет сохранен в {args.output}")
+
+
+if __name__ == "__main__":
+    main()
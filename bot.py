@@ -1,56 +1,206 @@
 # bot.py
 import os
 import logging
+import threading
 
 from telegram import Update
-from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes
-from langchain.chains import RetrievalQA
+from telegram.ext import Application, CommandHandler, MessageHandler, SimpleUpdateProcessor, filters, ContextTypes
 from local_llm import load_local_llm
+from qa_pipeline import QAPipeline, format_sources
+from faq_store import FAQStore, FAQ_STORE_PATH
+from fact_table import FactMatcher, FACTS_PATH
+from batch_embedder import BatchEmbedder
+from conversation_memory import ConversationMemory, llm_summarizer
+from generation_modes import select_mode
+from quantized_index import QuantizedVectorStore
 from langchain_chroma import Chroma
-from langchain_huggingface import HuggingFaceEmbeddings
+from langchain_core.embeddings import Embeddings
+from langchain_core.documents import Document
 from dotenv import load_dotenv
 from agent import get_agent_executor
+import telemetry
+import profiling
+import index_versions
 
 # Загружаем переменные окружения
 load_dotenv()
 
 # Настройка логирования
-logging.basicConfig(level=logging.INFO)
+telemetry.setup_logging()
 logger = logging.getLogger(__name__)
 
 # Пути
-VECTOR_DB_DIR = "vector_db"
+VECTOR_DB_DIR = index_versions.VECTOR_DB_DIR
 MODEL_NAME = "distiluse-base-multilingual-cased-v1"
+# Режим поиска: chroma (по умолчанию) или quantized (см. create_vector_db.py --quantized)
+INDEX_MODE = os.getenv("INDEX_MODE", "chroma")
+# Бэкенд эмбеддингов запроса: torch (HuggingFaceEmbeddings) или onnx (см. onnx_embedder.py)
+EMBEDDING_BACKEND = os.getenv("EMBEDDING_BACKEND", "torch")
+# Режим получения обновлений: polling (по умолчанию) или webhook
+BOT_MODE = os.getenv("BOT_MODE", "polling")
+# Сколько обновлений обрабатывается одновременно (остальные ждут в очереди)
+MAX_CONCURRENT_UPDATES = int(os.getenv("BOT_MAX_CONCURRENT_UPDATES", "16"))
+# Размер пула HTTP-соединений к Bot API для исходящих вызовов (sendMessage и т.д.)
+TELEGRAM_POOL_SIZE = int(os.getenv("TELEGRAM_POOL_SIZE", "32"))
 
-# Инициализация векторного хранилища
-def load_retriever():
+class InstrumentedEmbeddings(Embeddings):
+    """Обертка над функцией эмбеддингов, измеряющая время кодирования запросов."""
+
+    def __init__(self, inner: Embeddings):
+        self.inner = inner
+
+    def embed_documents(self, texts):
+        with telemetry.span("embedding", texts=len(texts)):
+            return self.inner.embed_documents(texts)
+
+    def embed_query(self, text):
+        with telemetry.span("embedding", texts=1):
+            return self.inner.embed_query(text)
+
+
+# Модель эмбеддингов запросов
+def load_embeddings() -> Embeddings:
+    if EMBEDDING_BACKEND == "onnx":
+        try:
+            from onnx_embedder import OnnxEmbeddings
+            return OnnxEmbeddings()
+        except Exception as e:
+            logger.error(f"Ошибка загрузки ONNX-модели эмбеддингов, используется PyTorch: {e}")
+    # Импорт здесь: с бэкендом onnx PyTorch в процесс бота не загружается
     from langchain_huggingface import HuggingFaceEmbeddings
-    embedding_function = HuggingFaceEmbeddings(model_name=MODEL_NAME)
+    return HuggingFaceEmbeddings(model_name=MODEL_NAME)
+
+# Инициализация векторного хранилища (version=None - прежняя раскладка без версий)
+def load_retriever(version=None, embedding_function=None):
+    embedding_function = embedding_function or InstrumentedEmbeddings(load_embeddings())
+    index_dir = index_versions.index_dir(version)
+    if INDEX_MODE == "quantized":
+        try:
+            db = QuantizedVectorStore.load(os.path.join(index_dir, "quantized"), embedding_function)
+            return db.as_retriever(search_kwargs={"k": 1})
+        except Exception as e:
+            logger.error(f"Ошибка загрузки квантованного индекса, используется Chroma: {e}")
     try:
         # Явно указываем имя коллекции
         db = Chroma(
-            persist_directory=VECTOR_DB_DIR,
+            persist_directory=index_dir,
             embedding_function=embedding_function,
-            collection_name="itmo_master_programs" # <-- Добавить это
+            collection_name=index_versions.COLLECTION_NAME
         )
         return db.as_retriever(search_kwargs={"k": 1})
     except Exception as e:
         logger.error(f"Ошибка загрузки векторной БД: {e}")
         return None
 
-# Инициализация QA-цепочки
-def load_qa_chain(retriever):
+# Инициализация QA-пайплайна
+def load_qa_pipeline(retriever):
     llm = load_local_llm()
-    return RetrievalQA.from_chain_type(
-        llm=llm,
-        chain_type="stuff",
-        retriever=retriever,
-        return_source_documents=True
+    return QAPipeline(retriever=retriever, llm=llm)
+
+# Загрузка заранее сгенерированных ответов FAQ (см. build_faq.py)
+def load_faq_store():
+    if not os.path.exists(FAQ_STORE_PATH):
+        logger.info("Хранилище FAQ не найдено, ответы будут генерироваться на лету")
+        return None
+    try:
+        return FAQStore.load(FAQ_STORE_PATH)
+    except Exception as e:
+        logger.error(f"Ошибка загрузки хранилища FAQ: {e}")
+        return None
+
+# Таблица фактов для мгновенных ответов (см. fact_table.py)
+def load_fact_matcher():
+    if not os.path.exists(FACTS_PATH):
+        logger.info("Таблица фактов не найдена, фактические вопросы обрабатываются через QA")
+        return None
+    try:
+        return FactMatcher.load(FACTS_PATH)
+    except Exception as e:
+        logger.error(f"Ошибка загрузки таблицы фактов: {e}")
+        return None
+
+# Пакетное кодирование запросов одновременных пользователей (модель эмбеддингов общая для всех версий индекса)
+def load_batch_embedder(pipeline):
+    embeddings = getattr(getattr(pipeline.retriever, "vectorstore", None), "embeddings", None)
+    if embeddings is None:
+        return None
+    return BatchEmbedder(
+        embeddings,
+        max_batch_size=int(os.getenv("EMBED_BATCH_SIZE", "32")),
+        max_wait_ms=float(os.getenv("EMBED_BATCH_WAIT_MS", "5")),
     )
 
+# Память диалогов: сворачивание через LLM включается MEMORY_LLM_SUMMARY=1
+def load_conversation_memory(llm):
+    if os.getenv("MEMORY_LLM_SUMMARY", "0") == "1":
+        return ConversationMemory(summarizer=llm_summarizer(llm))
+    return ConversationMemory()
+
 # Глобальные переменные
-qa_chain = None
+qa_pipeline = None
 agent_executor = None
+faq_store = None
+fact_matcher = None
+batch_embedder = None
+memory = None
+# Компоненты, зависящие от версии индекса, подменяются вместе под блокировкой
+components_lock = threading.Lock()
+
+def current_components():
+    """
+    Согласованный снимок компонентов для одного запроса: при смене версии индекса
+    запрос дорабатывает со старым retriever, новые запросы получают новый.
+    """
+    with components_lock:
+        return qa_pipeline, agent_executor, faq_store, fact_matcher
+
+# Через сколько секунд после переключения закрывается старый индекс (запросы в обработке дорабатывают с ним)
+OLD_INDEX_RELEASE_DELAY = float(os.getenv("INDEX_RELEASE_DELAY", "300"))
+
+def release_vectorstore(vectorstore):
+    """
+    Закрывает клиент Chroma старой версии индекса (квантованный индекс освобождается сборщиком мусора).
+    """
+    client = getattr(vectorstore, "_client", None)
+    if client is None:
+        return
+    try:
+        if hasattr(client, "close"):
+            client.close()
+        else:
+            # chromadb без Client.close(): останавливаем систему клиента и убираем ее из общего кэша
+            from chromadb.api.client import SharedSystemClient
+            system = SharedSystemClient._identifier_to_system.pop(client._identifier, None)
+            if system is not None:
+                system.stop()
+        logger.info("Клиент Chroma предыдущей версии индекса закрыт")
+    except Exception as e:
+        logger.warning(f"Не удалось закрыть клиент Chroma предыдущей версии индекса: {e}")
+
+def swap_index(version):
+    """
+    Загружает новую версию индекса в фоне и атомарно подменяет retriever, QA-пайплайн и агента.
+    Модель LLM и эмбеддингов переиспользуются; ответы FAQ и таблица фактов перечитываются с диска.
+    """
+    global qa_pipeline, agent_executor, faq_store, fact_matcher
+    manifest = index_versions.read_manifest(version)
+    logger.info(f"Загрузка версии индекса {version}: {manifest}")
+    embedding_function = qa_pipeline.retriever.vectorstore.embeddings if qa_pipeline else None
+    retriever = load_retriever(version, embedding_function)
+    if not retriever:
+        raise RuntimeError(f"Не удалось загрузить индекс версии {version}")
+    new_pipeline = load_qa_pipeline(retriever)
+    new_agent = get_agent_executor(retriever)
+    new_faq_store = load_faq_store()
+    new_fact_matcher = load_fact_matcher()
+    with components_lock:
+        old_vectorstore = getattr(qa_pipeline.retriever, "vectorstore", None) if qa_pipeline else None
+        qa_pipeline, agent_executor, faq_store, fact_matcher = new_pipeline, new_agent, new_faq_store, new_fact_matcher
+    logger.info(f"Бот переключен на версию индекса {version}")
+    if old_vectorstore is not None:
+        timer = threading.Timer(OLD_INDEX_RELEASE_DELAY, release_vectorstore, args=(old_vectorstore,))
+        timer.daemon = True
+        timer.start()
 
 # Команда /start
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -61,78 +211,183 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "Задавайте вопросы о программах, поступлении, карьере или попросите помочь выбрать дисциплины!"
     )
 
-# Обработка сообщений
+# Команда /reset - очистка истории диалога
+async def reset(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    memory.clear(update.effective_chat.id)
+    await update.message.reply_text("История диалога очищена.")
+
+def log_retrieved_documents(docs):
+    """
+    Подробный отладочный вывод найденного контекста (только для семплированных запросов).
+    """
+    for i, doc in enumerate(docs):
+        source = doc.metadata.get('source') or doc.metadata.get('source_file', 'N/A')
+        telemetry.log_event(
+            "retrieved_document",
+            level=logging.INFO,
+            rank=i + 1,
+            id=getattr(doc, 'id', None) or 'N/A',
+            source=source,
+            preview=doc.page_content[:500],
+        )
+
+def remember_exchange(chat_id, user_input, answer):
+    # Выполняется в потоке: при MEMORY_LLM_SUMMARY=1 сворачивание истории генерирует текст LLM
+    memory.add_turn(chat_id, "user", user_input)
+    memory.add_turn(chat_id, "assistant", answer)
+
+@profiling.profiled("agent")
+async def run_agent(agent, query):
+    return await agent.ainvoke({"input": query})
+
+# Обработка сообщений (доля запросов профилируется при PROFILE_SAMPLE_RATE > 0, см. profiling.py)
+@profiling.profiled("handle_message")
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_input = update.message.text.strip()
+    chat_id = update.effective_chat.id
+    telemetry.new_trace()
     logger.info(f"Пользователь: {user_input}")
 
-    # Проверка, нужно ли использовать агента
-    if any(keyword in user_input.lower() for keyword in ["рекомендуй", "подбери", "совет", "какие курсы", "что выбрать", "сравни"]):
-        try:
-            response = await agent_executor.ainvoke({"input": user_input})
-            answer = response["output"]
-        except Exception as e:
-            logger.error(f"Ошибка агента: {e}")
-            answer = "Извините, не удалось обработать ваш запрос."
-    else:
-        # Обычный QA
-        # В bot.py, в handle_message, в блоке try для обычного QA
-        try:
-            # --- Отладка: Проверка контекста ---
-            print(f"[DEBUG] Поиск контекста для вопроса: {user_input}")
-            debug_docs = retriever.invoke(user_input)  # retriever доступен в области видимости?
-            # Если retriever недоступен, получите его, например, через qa_chain
-            # debug_docs = qa_chain.retriever.invoke(user_input)
-            # или сохраните retriever в переменной выше
-            if hasattr(qa_chain, 'retriever'):
-                debug_docs = qa_chain.retriever.invoke(user_input)
-                print(f"[DEBUG] Найдено {len(debug_docs)} документов через qa_chain.retriever:")
-                for i, doc in enumerate(debug_docs):
-                    print(
-                        f"[DEBUG]   Документ {i + 1} (источник: {doc.metadata.get('source', 'N/A') or doc.metadata.get('source_file', 'N/A')}):")
-                    # Выведем больше текста для проверки
-                    print(
-                        f"[DEBUG]     Содержимое: {doc.page_content[:500] if hasattr(doc, 'page_content') else doc.page_content[:500] if 'page_content' in doc else 'NO page_content'}...")
-                    # Или, если документ - это просто словарь
-                    # print(f"[DEBUG]     Содержимое: {doc['document'][:500] if 'document' in doc else 'NO document key'}...")
-                    print("-" * 20)
-            else:
-                # Если retriever напрямую доступен в handle_message
-                debug_docs = retriever.invoke(user_input)
-            print(f"[DEBUG] Найдено {len(debug_docs)} документов:")
-            for i, doc in enumerate(debug_docs):
-                print(
-                    f"[DEBUG]   Документ {i + 1} (источник: {doc.metadata.get('source', 'N/A')}): {doc.page_content[:200]}...")
-            # --- Конец отладки ---
-
-            result = qa_chain.invoke({"query": user_input})  # Используем invoke вместо __call__
-            answer = result["result"]
-        except Exception as e:
-            logger.error(f"Ошибка QA: {e}")
-            answer = "Не удалось найти ответ. Попробуйте уточнить вопрос."
+    # Уточняющие вопросы ("а сколько там бюджетных мест?") дополняются программой из истории
+    query = memory.contextualize_query(chat_id, user_input)
+    history = memory.render_context(chat_id)
+
+    pipeline, agent, faq, facts = current_components()
+
+    with telemetry.track_in_flight(), telemetry.span("handle_message"):
+        # Проверка, нужно ли использовать агента
+        if any(keyword in user_input.lower() for keyword in ["рекомендуй", "подбери", "совет", "какие курсы", "что выбрать", "сравни"]):
+            try:
+                with telemetry.span("agent"):
+                    response = await run_agent(agent, query)
+                answer = response["output"]
+                await profiling.to_thread(remember_exchange, chat_id, user_input, answer)
+            except Exception as e:
+                logger.error(f"Ошибка агента: {e}")
+                answer = "Извините, не удалось обработать ваш запрос."
+        else:
+            # Обычный QA: поиск выполняется один раз, документы идут и в отладку, и в промпт
+            try:
+                # Частые фактические вопросы отвечаются из таблицы фактов без эмбеддинга, поиска и LLM
+                fact = facts.match(query) if facts else None
+                # Эмбеддинг запроса считается один раз: для поиска в FAQ и в векторной БД.
+                # Одновременные запросы кодируются одним пакетом в отдельном потоке
+                query_embedding = None
+                if not fact:
+                    if batch_embedder:
+                        query_embedding = await batch_embedder.embed_query(query)
+                    else:
+                        query_embedding = await profiling.to_thread(pipeline.embed_query, query)
+                faq_entry = faq.lookup(query_embedding, query) if faq and query_embedding is not None else None
+                if fact:
+                    logger.info(f"Ответ из таблицы фактов: {fact['intent']}")
+                    answer = fact["answer"]
+                    source_docs = [Document(page_content="", metadata=m) for m in fact["sources"]]
+                elif faq_entry:
+                    logger.info(f"Ответ из FAQ: {faq_entry['id']} (близость {faq_entry['score']:.3f})")
+                    answer = faq_entry["answer"]
+                    source_docs = [Document(page_content="", metadata=m) for m in faq_entry["sources"]]
+                else:
+                    # Поиск и генерация выполняются в потоках, чтобы цикл событий продолжал
+                    # принимать обновления других пользователей (и попадают в профиль запроса)
+                    docs = await profiling.to_thread(pipeline.retrieve, query, embedding=query_embedding)
+                    # Отладочный вывод найденного контекста включается семплированием (DEBUG_SAMPLE_RATE)
+                    if telemetry.should_sample_debug():
+                        log_retrieved_documents(docs)
+
+                    # Короткие фактические вопросы (цена, дата, количество) генерируются жадно по грамматике
+                    result = await profiling.to_thread(pipeline.answer, user_input, docs, history=history,
+                                                     generation_mode=select_mode(user_input))
+                    answer = result["result"]
+                    source_docs = result["source_documents"]
+                await profiling.to_thread(remember_exchange, chat_id, user_input, answer)
+                sources = format_sources(source_docs)
+                if sources:
+                    answer = f"{answer}\n\n{sources}"
+            except Exception as e:
+                logger.error(f"Ошибка QA: {e}")
+                answer = "Не удалось найти ответ. Попробуйте уточнить вопрос."
 
     await update.message.reply_text(answer)
 
+async def on_stop(app: Application):
+    # К этому моменту прием обновлений остановлен, а Application дождался завершения
+    # уже начатых обработчиков: ответы на принятые сообщения отправлены
+    logger.info("Прием обновлений остановлен, обработка принятых сообщений завершена")
+
+async def on_shutdown(app: Application):
+    if batch_embedder:
+        await batch_embedder.close()
+
+def build_application() -> Application:
+    """
+    Приложение Telegram: обновления обрабатываются параллельно (не более MAX_CONCURRENT_UPDATES
+    одновременно), исходящие вызовы Bot API идут через общий пул соединений.
+    TELEGRAM_API_BASE_URL позволяет направить бота на локальную заглушку API (fake_telegram_api.py).
+    """
+    builder = (
+        Application.builder()
+        .token(os.getenv("TELEGRAM_BOT_TOKEN"))
+        .concurrent_updates(SimpleUpdateProcessor(MAX_CONCURRENT_UPDATES))
+        .connection_pool_size(TELEGRAM_POOL_SIZE)
+        .pool_timeout(float(os.getenv("TELEGRAM_POOL_TIMEOUT", "10")))
+        .post_stop(on_stop)
+        .post_shutdown(on_shutdown)
+    )
+    base_url = os.getenv("TELEGRAM_API_BASE_URL")
+    if base_url:
+        builder = builder.base_url(base_url).base_file_url(base_url.replace("/bot", "/file/bot"))
+    app = builder.build()
+
+    app.add_handler(CommandHandler("start", start))
+    app.add_handler(CommandHandler("reset", reset))
+    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
+    return app
+
 def main():
-    global qa_chain, agent_executor, retriever
+    global qa_pipeline, agent_executor, faq_store, fact_matcher, batch_embedder, memory
 
-    # Загружаем компоненты
-    retriever = load_retriever()
+    # Загружаем компоненты активной версии индекса
+    version = index_versions.current_version()
+    retriever = load_retriever(version)
     if not retriever:
         logger.error("Не удалось загрузить retriever. Выход.")
         return
 
-    qa_chain = load_qa_chain(retriever)
+    qa_pipeline = load_qa_pipeline(retriever)
     agent_executor = get_agent_executor(retriever)
+    faq_store = load_faq_store()
+    fact_matcher = load_fact_matcher()
+    batch_embedder = load_batch_embedder(qa_pipeline)
+    memory = load_conversation_memory(qa_pipeline.llm)
 
-    # Запуск бота
-    app = Application.builder().token(os.getenv("TELEGRAM_BOT_TOKEN")).build()
+    telemetry.start_metrics_server()
 
-    app.add_handler(CommandHandler("start", start))
-    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
+    # Новые сборки create_vector_db.py подхватываются без перезапуска бота
+    index_versions.IndexWatcher(swap_index, loaded_version=version).start()
 
-    logger.info("Бот запущен...")
-    app.run_polling()
+    # Запуск бота
+    app = build_application()
+
+    if BOT_MODE == "webhook":
+        webhook_url = os.getenv("WEBHOOK_URL")
+        if not webhook_url:
+            logger.error("Для режима webhook нужна переменная WEBHOOK_URL. Выход.")
+            return
+        url_path = os.getenv("WEBHOOK_PATH", "telegram")
+        logger.info(f"Бот запущен в режиме webhook: {webhook_url}")
+        # По SIGINT/SIGTERM сервер перестает принимать обновления, а начатые обработчики дорабатывают
+        app.run_webhook(
+            listen=os.getenv("WEBHOOK_LISTEN", "0.0.0.0"),
+            port=int(os.getenv("WEBHOOK_PORT", "8443")),
+            url_path=url_path,
+            webhook_url=webhook_url,
+            secret_token=os.getenv("WEBHOOK_SECRET") or None,
+            max_connections=MAX_CONCURRENT_UPDATES,
+        )
+    else:
+        logger.info("Бот запущен...")
+        app.run_polling()
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
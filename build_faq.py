@@ -0,0 +1,187 @@
+# build_faq.py
+"""
+Офлайн-сборка хранилища FAQ: канонические вопросы по каждой программе отвечаются
+локальной LLM (жадно, с фиксированными параметрами, чтобы ответы были воспроизводимы)
+и сохраняются вместе с id исходных чанков.
+
+Ответы программы перегенерируются, только если изменились ее исходные файлы, обработанные
+чанки или параметры генерации.
+Запускать после process_data.py, например, ночью по расписанию:
+    python build_faq.py [--force]
+"""
+import os
+import json
+import hashlib
+import argparse
+import logging
+from pathlib import Path
+from typing import Any, Dict, List
+
+import numpy as np
+from langchain_core.documents import Document
+from sentence_transformers import SentenceTransformer
+
+import telemetry
+from faq_store import (
+    CANONICAL_QUESTIONS,
+    FAQ_STORE_PATH,
+    FAQ_TEMPLATE_VERSION,
+    content_hash,
+    load_store_file,
+    save_store_file,
+)
+from programs import PROGRAM_TITLES
+from qa_pipeline import QAPipeline
+
+logger = logging.getLogger(__name__)
+
+DOWNLOADS_DIR = "downloads"
+PROCESSED_FILE = os.path.join("processed_data", "processed_documents.json")
+MODEL_NAME = "distiluse-base-multilingual-cased-v1"
+# Сколько чанков программы подставлять в контекст ответа
+SOURCE_CHUNKS_PER_QUESTION = 2
+# Параметры генерации канонических ответов: жадный выбор токенов, без случайности
+FAQ_GENERATION_CONFIG = {
+    "max_tokens": 512,
+    "temperature": 0.0,
+    "top_p": 1.0,
+    "top_k": 1,
+    "repeat_penalty": 1.1,
+}
+
+
+def program_source_files(program_name: str) -> List[str]:
+    """
+    Возвращает исходные файлы программы: текст страницы и PDF учебного плана.
+    """
+    content_file = os.path.join(DOWNLOADS_DIR, f"{program_name}_content.txt")
+    files = [content_file]
+    plan_info_file = os.path.join(DOWNLOADS_DIR, f"{program_name}_plan_info.txt")
+    if os.path.exists(plan_info_file):
+        with open(plan_info_file, "r", encoding="utf-8") as f:
+            for line in f:
+                if line.startswith("Скачанный учебный план:"):
+                    files.append(line.split(":", 1)[1].strip().replace("\\", os.sep))
+    return files
+
+
+def build_key(program_name: str, chunks: List[Dict[str, Any]]) -> str:
+    """
+    Ключ сборки ответов программы: исходные файлы, обработанные чанки и параметры генерации.
+    """
+    digest = hashlib.sha256(content_hash(program_source_files(program_name)).encode("utf-8"))
+    for chunk in chunks:
+        digest.update(json.dumps([chunk.get("id"), chunk["text"], chunk.get("metadata")],
+                                 ensure_ascii=False, sort_keys=True).encode("utf-8"))
+    digest.update(json.dumps(FAQ_GENERATION_CONFIG, sort_keys=True).encode("utf-8"))
+    return digest.hexdigest()
+
+
+def select_sources(
+        question_embedding: np.ndarray,
+        chunks: List[Dict[str, Any]],
+        chunk_embeddings: np.ndarray,
+        k: int = SOURCE_CHUNKS_PER_QUESTION
+) -> List[Dict[str, Any]]:
+    """
+    Выбирает чанки программы, наиболее близкие к каноническому вопросу.
+    """
+    scores = chunk_embeddings @ question_embedding
+    return [chunks[i] for i in np.argsort(-scores)[:k]]
+
+
+def build_program_entries(
+        program_name: str,
+        chunks: List[Dict[str, Any]],
+        embedder: SentenceTransformer,
+        pipeline: QAPipeline
+) -> List[Dict[str, Any]]:
+    """
+    Генерирует ответы на все канонические вопросы одной программы.
+    """
+    title = PROGRAM_TITLES.get(program_name, program_name)
+    chunk_embeddings = embedder.encode([c["text"] for c in chunks], normalize_embeddings=True)
+
+    entries = []
+    prompts = []
+    for topic, templates in CANONICAL_QUESTIONS.items():
+        questions = [t.format(title=title) for t in templates]
+        question_embeddings = embedder.encode(questions, normalize_embeddings=True)
+        sources = select_sources(question_embeddings[0], chunks, chunk_embeddings)
+        docs = [Document(page_content=c["text"], metadata=c["metadata"]) for c in sources]
+        prompts.append(pipeline.build_prompt(questions[0], docs))
+        entries.append({
+            "id": f"{program_name}_{topic}",
+            "program_name": program_name,
+            "topic": topic,
+            "questions": questions,
+            "question_embeddings": question_embeddings.tolist(),
+            "source_ids": [c["id"] for c in sources],
+            "sources": [c["metadata"] for c in sources],
+        })
+
+    # Локальная LLM генерирует по одному промпту за раз (одна модель llama.cpp на процесс)
+    with telemetry.span("faq_generate", program=program_name, questions=len(prompts)):
+        for entry, prompt in zip(entries, prompts):
+            entry["answer"] = pipeline.generate(prompt).strip()
+    return entries
+
+
+def main():
+    """
+    Пересобирает хранилище FAQ для программ с изменившимся контентом.
+    """
+    telemetry.setup_logging()
+    parser = argparse.ArgumentParser(description="Офлайн-сборка ответов FAQ")
+    parser.add_argument("--force", action="store_true", help="Перегенерировать ответы для всех программ")
+    parser.add_argument("--output", default=FAQ_STORE_PATH, help="Путь к файлу хранилища")
+    args = parser.parse_args()
+
+    with open(PROCESSED_FILE, "r", encoding="utf-8") as f:
+        documents = json.load(f)
+    chunks_by_program: Dict[str, List[Dict[str, Any]]] = {}
+    for doc in documents:
+        chunks_by_program.setdefault(doc["metadata"]["program_name"], []).append(doc)
+
+    store = load_store_file(args.output)
+    if store.get("template_version") != FAQ_TEMPLATE_VERSION:
+        store = {"template_version": FAQ_TEMPLATE_VERSION, "programs": {}}
+
+    programs = [p.stem.replace("_content", "") for p in Path(DOWNLOADS_DIR).glob("*_content.txt")]
+    stale = []
+    for program_name in programs:
+        current_hash = build_key(program_name, chunks_by_program.get(program_name, []))
+        stored = store["programs"].get(program_name)
+        if args.force or not stored or stored.get("content_hash") != current_hash:
+            stale.append((program_name, current_hash))
+        else:
+            logger.info(f"FAQ для {program_name} актуален, пропускаем")
+
+    # Удаляем программы, которых больше нет в исходных данных
+    for program_name in list(store["programs"]):
+        if program_name not in programs:
+            del store["programs"][program_name]
+
+    if stale:
+        # Тяжелые модели загружаются только если есть что генерировать
+        from local_llm import load_local_llm
+        embedder = SentenceTransformer(MODEL_NAME)
+        pipeline = QAPipeline(retriever=None, llm=load_local_llm(**FAQ_GENERATION_CONFIG))
+        for program_name, current_hash in stale:
+            chunks = chunks_by_program.get(program_name)
+            if not chunks:
+                logger.warning(f"Нет обработанных чанков для {program_name}, запустите process_data.py")
+                continue
+            logger.info(f"Генерация FAQ для {program_name}...")
+            store["programs"][program_name] = {
+                "content_hash": current_hash,
+                "entries": build_program_entries(program_name, chunks, embedder, pipeline),
+            }
+
+    save_store_file(store, args.output)
+    total = sum(len(p["entries"]) for p in store["programs"].values())
+    logger.info(f"Хранилище FAQ сохранено в {args.output}: {total} ответов, перегенерировано программ: {len(stale)}")
+
+
+if __name__ == "__main__":
+    main()
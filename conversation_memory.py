@@ -0,0 +1,232 @@
+# conversation_memory.py
+"""
+Память диалога для каждого чата со строгим бюджетом токенов.
+
+Последние реплики хранятся компактными записями; когда они перестают помещаться в бюджет,
+самые старые сворачиваются в краткое содержание. Неактивные чаты вытесняются по LRU,
+поэтому общий объем памяти ограничен при любом числе пользователей.
+"""
+import os
+import time
+import threading
+from collections import OrderedDict, deque
+from typing import Any, Callable, Deque, Optional
+
+from programs import PROGRAM_TITLES, detect_program
+
+import telemetry
+
+# Бюджет токенов на память одного чата (последние реплики + краткое содержание)
+DEFAULT_TOKEN_BUDGET = int(os.getenv("MEMORY_TOKEN_BUDGET", "512"))
+# Максимальное число чатов в памяти
+DEFAULT_MAX_CHATS = int(os.getenv("MEMORY_MAX_CHATS", "5000"))
+# Время бездействия (секунды), после которого память чата удаляется
+DEFAULT_IDLE_TTL = int(os.getenv("MEMORY_IDLE_TTL", str(6 * 3600)))
+# Максимальная длина одной реплики в памяти (символов); длинные ответы обрезаются
+MAX_TURN_CHARS = 600
+# Число блокировок, по которым распределяются чаты (add_turn одного чата выполняется последовательно)
+CHAT_LOCK_STRIPES = 64
+
+ROLE_TITLES = {"user": "Пользователь", "assistant": "Бот"}
+
+
+def approx_token_count(text: str) -> int:
+    """
+    Грубая оценка числа токенов для кириллического текста (~3 символа на токен).
+    """
+    return len(text) // 3 + 1
+
+
+def extractive_summarizer(summary: str, turn_text: str) -> str:
+    """
+    Дешевое инкрементальное сворачивание без LLM: к содержанию дописывается сжатая реплика.
+    """
+    compact = turn_text if len(turn_text) <= 150 else turn_text[:147] + "..."
+    return f"{summary} {compact}".strip()
+
+
+def llm_summarizer(llm) -> Callable[[str, str], str]:
+    """
+    Возвращает сворачивание через LLM: модель обновляет краткое содержание новой репликой.
+    """
+    def summarize(summary: str, turn_text: str) -> str:
+        prompt = (
+            "Обнови краткое содержание диалога абитуриента с ботом, добавив новую реплику. "
+            "Сохрани упомянутые программы, факты и вопросы. Ответь только новым кратким содержанием.\n\n"
+            f"Краткое содержание: {summary or 'пусто'}\n"
+            f"Новая реплика: {turn_text}"
+        )
+        return llm.invoke(prompt, max_tokens=128, temperature=0.0).strip()
+    return summarize
+
+
+class ChatTurn:
+    """Компактная запись одной реплики."""
+    __slots__ = ("role", "text", "tokens")
+
+    def __init__(self, role: str, text: str, token_counter: Callable[[str], int]):
+        self.role = role
+        self.text = text if len(text) <= MAX_TURN_CHARS else text[:MAX_TURN_CHARS - 3] + "..."
+        self.tokens = token_counter(self.text)
+
+    def render(self) -> str:
+        return f"{ROLE_TITLES.get(self.role, self.role)}: {self.text}"
+
+
+class ChatMemory:
+    """Состояние одного чата: последние реплики, краткое содержание и контекст."""
+    __slots__ = ("turns", "turn_tokens", "summary", "summary_tokens", "last_program", "last_active", "cleared")
+
+    def __init__(self):
+        self.turns: Deque[ChatTurn] = deque()
+        self.turn_tokens = 0
+        self.summary = ""
+        self.summary_tokens = 0
+        self.last_program: Optional[str] = None
+        self.last_active = time.monotonic()
+        # Чат очищен командой /clear: незавершенное сворачивание не должно его восстановить
+        self.cleared = False
+
+    def render(self) -> str:
+        parts = []
+        if self.summary:
+            parts.append(f"Краткое содержание диалога: {self.summary}")
+        if self.turns:
+            parts.append("Предыдущие сообщения:\n" + "\n".join(turn.render() for turn in self.turns))
+        return "\n".join(parts)
+
+
+class ConversationMemory:
+    """Ограниченная память диалогов всех чатов с LRU-вытеснением неактивных."""
+
+    def __init__(
+            self,
+            token_budget: int = DEFAULT_TOKEN_BUDGET,
+            max_chats: int = DEFAULT_MAX_CHATS,
+            idle_ttl: float = DEFAULT_IDLE_TTL,
+            summarizer: Callable[[str, str], str] = extractive_summarizer,
+            token_counter: Callable[[str], int] = approx_token_count
+    ):
+        self.token_budget = token_budget
+        # Краткому содержанию отводится треть бюджета, остальное - последним репликам
+        self.summary_budget = token_budget // 3
+        self.turns_budget = token_budget - self.summary_budget
+        self.max_chats = max_chats
+        self.idle_ttl = idle_ttl
+        self.summarizer = summarizer
+        self.token_counter = token_counter
+        self._chats: "OrderedDict[Any, ChatMemory]" = OrderedDict()
+        self._lock = threading.Lock()
+        # Блокировки чатов не зависят от объектов ChatMemory, поэтому переживают вытеснение
+        self._chat_locks = [threading.Lock() for _ in range(CHAT_LOCK_STRIPES)]
+
+    def __len__(self) -> int:
+        return len(self._chats)
+
+    def _get(self, chat_id, create: bool) -> Optional[ChatMemory]:
+        chat = self._chats.get(chat_id)
+        now = time.monotonic()
+        if chat is not None and now - chat.last_active > self.idle_ttl:
+            self._drop(chat_id)
+            chat = None
+        if chat is None:
+            if not create:
+                return None
+            chat = ChatMemory()
+            self._chats[chat_id] = chat
+            self._evict()
+        self._chats.move_to_end(chat_id)
+        chat.last_active = now
+        return chat
+
+    def _drop(self, chat_id):
+        self._chats.pop(chat_id, None)
+
+    def _evict(self):
+        # Сначала удаляем просроченные чаты с начала LRU-очереди, затем самые старые сверх лимита
+        now = time.monotonic()
+        while self._chats:
+            oldest_id, oldest = next(iter(self._chats.items()))
+            if now - oldest.last_active <= self.idle_ttl and len(self._chats) <= self.max_chats:
+                break
+            self._drop(oldest_id)
+            telemetry.metrics.inc("memory_evictions_total")
+        telemetry.metrics.set_gauge("memory_chats", len(self._chats))
+
+    def add_turn(self, chat_id, role: str, text: str):
+        """
+        Добавляет реплику; старые реплики сверх бюджета сворачиваются в краткое содержание.
+        Сворачивание через LLM блокирует поток на время генерации: из асинхронного кода
+        метод вызывается в отдельном потоке. Вызовы для одного чата выполняются по очереди,
+        поэтому сворачивание всегда продолжает актуальное краткое содержание.
+        """
+        with self._chat_locks[hash(chat_id) % CHAT_LOCK_STRIPES]:
+            self._add_turn(chat_id, role, text)
+
+    def _add_turn(self, chat_id, role: str, text: str):
+        with self._lock:
+            chat = self._get(chat_id, create=True)
+            turn = ChatTurn(role, text, self.token_counter)
+            chat.turns.append(turn)
+            chat.turn_tokens += turn.tokens
+            if role == "user":
+                chat.last_program = detect_program(text) or chat.last_program
+
+            # Пока в чате больше одной реплики, старые сверх бюджета уходят в краткое содержание
+            overflow = []
+            while chat.turn_tokens > self.turns_budget and len(chat.turns) > 1:
+                old = chat.turns.popleft()
+                chat.turn_tokens -= old.tokens
+                overflow.append(old)
+
+            summary = chat.summary
+        if not overflow:
+            return
+
+        # Сворачивание (возможно, через LLM) выполняется вне общей блокировки
+        for old in overflow:
+            summary = self.summarizer(summary, old.render())
+        tokens = self.token_counter(summary)
+        if tokens > self.summary_budget:
+            # Оставляем хвост: свежие факты важнее самых старых
+            summary = summary[-self.summary_budget * 3:]
+            summary = summary.split(" ", 1)[-1]
+            tokens = self.token_counter(summary)
+        with self._lock:
+            if chat.cleared:
+                return
+            if self._chats.get(chat_id) is not chat:
+                # Чат вытеснили, пока шло сворачивание: возвращаем его вместе с новым содержанием
+                self._chats[chat_id] = chat
+                self._evict()
+            chat.summary = summary
+            chat.summary_tokens = tokens
+
+    def render_context(self, chat_id) -> str:
+        """
+        Возвращает историю диалога для промпта (в пределах бюджета токенов).
+        """
+        with self._lock:
+            chat = self._get(chat_id, create=False)
+            return chat.render() if chat else ""
+
+    def contextualize_query(self, chat_id, query: str) -> str:
+        """
+        Дополняет уточняющий вопрос программой из предыдущих сообщений, чтобы поиск шел
+        по нужной программе ("а сколько там бюджетных мест?").
+        """
+        if detect_program(query):
+            return query
+        with self._lock:
+            chat = self._get(chat_id, create=False)
+            program = chat.last_program if chat else None
+        if not program:
+            return query
+        return f"{query} ({PROGRAM_TITLES.get(program, program)})"
+
+    def clear(self, chat_id):
+        with self._lock:
+            chat = self._chats.get(chat_id)
+            if chat is not None:
+                chat.cleared = True
+            self._drop(chat_id)
@@ -1,16 +1,33 @@
 # Create_vector_db.py
 import os
 import json
-from typing import List, Dict, Any
+import logging
+import argparse
+from typing import TYPE_CHECKING, List, Dict, Any, Optional
+import numpy as np
 import chromadb
 from chromadb.config import Settings
-from sentence_transformers import SentenceTransformer
+
+import telemetry
+import index_versions
+from quantized_index import QUANTIZATION_MODES, QuantizedIndex, format_report
+
+if TYPE_CHECKING:
+    from sentence_transformers import SentenceTransformer
+
+logger = logging.getLogger(__name__)
 
 # import hashlib # hashlib не используется в текущем коде, можно удалить
 
 # Пути к папкам
 PROCESSED_DIR = "processed_data"
-VECTOR_DB_DIR = "vector_db"
+VECTOR_DB_DIR = index_versions.VECTOR_DB_DIR
+QUANTIZED_SUBDIR = "quantized"
+# Косинусная близость зашумленного запроса к исходному документу при оценке квантованного индекса
+EVAL_QUERY_SIMILARITY = float(os.getenv("INDEX_EVAL_SIMILARITY", "0.9"))
+# Бэкенд эмбеддингов: torch или onnx (индекс и бот должны использовать один и тот же)
+EMBEDDING_BACKEND = os.getenv("EMBEDDING_BACKEND", "torch")
+EMBEDDING_MODEL_NAME = 'distiluse-base-multilingual-cased-v1'
 
 # Создаем папку для векторной базы данных
 os.makedirs(VECTOR_DB_DIR, exist_ok=True)
@@ -22,91 +39,98 @@ def load_processed_documents() -> List[Dict[str, Any]]:
     Загружает обработанные документы из JSON файла.
     """
     input_file = os.path.join(PROCESSED_DIR, "processed_documents.json")
-    print(f"[DEBUG] Попытка загрузить документы из: {input_file}")
+    logger.debug(f"Попытка загрузить документы из: {input_file}")
     try:
         if not os.path.exists(input_file):
-            print(f"[ERROR] Файл {input_file} не существует.")
+            logger.error(f"Файл {input_file} не существует.")
             return []
 
         with open(input_file, 'r', encoding='utf-8') as f:
             raw_data = f.read()
-            print(f"[DEBUG] Содержимое файла (первые 200 символов): {raw_data[:200]}...")
+            logger.debug(f"Содержимое файла (первые 200 символов): {raw_data[:200]}...")
 
             # Проверка на пустоту или почти пустоту
             if not raw_data.strip() or raw_data.strip() == "[]":
-                print(f"[WARNING] Файл {input_file} пуст или содержит пустой массив.")
+                logger.warning(f"Файл {input_file} пуст или содержит пустой массив.")
                 return []
 
             documents = json.loads(raw_data)
 
-        print(f"[DEBUG] Успешно загружено. Тип данных: {type(documents)}")
+        logger.debug(f"Успешно загружено. Тип данных: {type(documents)}")
         if isinstance(documents, list):
-            print(f"[DEBUG] Количество документов в списке: {len(documents)}")
+            logger.debug(f"Количество документов в списке: {len(documents)}")
             if documents:
                 # Проверим структуру первого документа
                 first_doc = documents[0]
-                print(f"[DEBUG] Структура первого документа: {list(first_doc.keys())}")
-                print(
-                    f"[DEBUG] Первый документ (первые 200 символов текста): {first_doc.get('text', 'NO TEXT KEY')[:200] if isinstance(first_doc.get('text'), str) else 'TEXT KEY IS NOT A STRING'}...")
+                logger.debug(f"Структура первого документа: {list(first_doc.keys())}")
+                logger.debug(
+                    f"Первый документ (первые 200 символов текста): {first_doc.get('text', 'NO TEXT KEY')[:200] if isinstance(first_doc.get('text'), str) else 'TEXT KEY IS NOT A STRING'}...")
         else:
-            print(f"[ERROR] Ожидался список, но загружены данные типа: {type(documents)}")
+            logger.error(f"Ожидался список, но загружены данные типа: {type(documents)}")
             return []
 
-        print(f"Загружено {len(documents)} документов из {input_file}")
+        logger.info(f"Загружено {len(documents)} документов из {input_file}")
         return documents
     except FileNotFoundError:
-        print(f"Файл {input_file} не найден. Убедитесь, что предыдущий шаг выполнен.")
+        logger.error(f"Файл {input_file} не найден. Убедитесь, что предыдущий шаг выполнен.")
         return []
     except json.JSONDecodeError as e:
-        print(f"Ошибка декодирования JSON в файле {input_file}: {e}")
+        logger.error(f"Ошибка декодирования JSON в файле {input_file}: {e}")
         return []
     except Exception as e:
-        print(f"Ошибка при загрузке документов: {e}")
-        import traceback
-        traceback.print_exc()
+        logger.exception(f"Ошибка при загрузке документов: {e}")
         return []
 
 
-def initialize_embedding_model() -> SentenceTransformer:
+def initialize_embedding_model() -> "SentenceTransformer":
     """
     Инициализирует модель для создания эмбеддингов.
+    При EMBEDDING_BACKEND=onnx используется ONNX-модель с тем же интерфейсом encode().
     """
+    if EMBEDDING_BACKEND == "onnx":
+        from onnx_embedder import OnnxEmbeddings
+        logger.info("Загрузка ONNX-модели эмбеддингов")
+        return OnnxEmbeddings()
     try:
-        model_name = 'distiluse-base-multilingual-cased-v1'
-        print(f"Загрузка модели эмбеддингов: {model_name}")
+        # Импорт здесь: с бэкендом onnx PyTorch не загружается
+        from sentence_transformers import SentenceTransformer
+        model_name = EMBEDDING_MODEL_NAME
+        logger.info(f"Загрузка модели эмбеддингов: {model_name}")
         model = SentenceTransformer(model_name)
-        print("Модель эмбеддингов загружена успешно")
+        logger.info("Модель эмбеддингов загружена успешно")
         return model
     except Exception as e:
-        print(f"Ошибка при загрузке модели эмбеддингов: {e}")
+        logger.error(f"Ошибка при загрузке модели эмбеддингов: {e}")
         raise e
 
 
-def initialize_vector_db() -> chromadb.Collection:
+def initialize_vector_db(path: str = VECTOR_DB_DIR) -> chromadb.Collection:
     """
-    Инициализирует векторную базу данных ChromaDB.
+    Инициализирует векторную базу данных ChromaDB в папке сборки.
     """
     try:
-        client = chromadb.PersistentClient(path=VECTOR_DB_DIR, settings=Settings(anonymized_telemetry=False))
-        collection_name = "itmo_master_programs"
-        collection = client.get_or_create_collection(name=collection_name)
-        print(f"Векторная база данных инициализирована. Коллекция: {collection_name}")
+        client = chromadb.PersistentClient(path=path, settings=Settings(anonymized_telemetry=False))
+        collection_name = index_versions.COLLECTION_NAME
+        collection = client.get_or_create_collection(name=collection_name,
+                                                     metadata=index_versions.COLLECTION_METADATA)
+        logger.info(f"Векторная база данных инициализирована. Коллекция: {collection_name}")
         return collection
     except Exception as e:
-        print(f"Ошибка при инициализации векторной базы данных: {e}")
+        logger.error(f"Ошибка при инициализации векторной базы данных: {e}")
         raise e
 
 
 def add_documents_to_vector_db(
         collection: chromadb.Collection,
         documents: List[Dict[str, Any]],
-        model: SentenceTransformer
-):
+        model: "SentenceTransformer"
+) -> Dict[str, List[Any]]:
     """
     Добавляет документы в векторную базу данных.
+    Возвращает добавленные id, эмбеддинги, метаданные и тексты (для квантованного индекса).
     """
-    print("Начало добавления документов в векторную базу данных...")
-    print(f"[DEBUG] Получено {len(documents)} документов для обработки.")
+    logger.info("Начало добавления документов в векторную базу данных...")
+    logger.debug(f"Получено {len(documents)} документов для обработки.")
 
     ids = []
     embeddings = []
@@ -117,24 +141,24 @@ def add_documents_to_vector_db(
     for i, doc in enumerate(documents):
         # Проверяем наличие необходимых ключей
         if 'id' not in doc:
-            print(f"[WARNING] Документ индекс {i} не содержит ключ 'id'. Пропущен. Документ: {str(doc)[:100]}...")
+            logger.warning(f"Документ индекс {i} не содержит ключ 'id'. Пропущен. Документ: {str(doc)[:100]}...")
             continue
         if 'text' not in doc:
-            print(f"[WARNING] Документ индекс {i} не содержит ключ 'text'. Пропущен. Документ: {str(doc)[:100]}...")
+            logger.warning(f"Документ индекс {i} не содержит ключ 'text'. Пропущен. Документ: {str(doc)[:100]}...")
             continue
         if 'metadata' not in doc:
-            print(f"[WARNING] Документ индекс {i} не содержит ключ 'metadata'. Пропущен. Документ: {str(doc)[:100]}...")
+            logger.warning(f"Документ индекс {i} не содержит ключ 'metadata'. Пропущен. Документ: {str(doc)[:100]}...")
             continue
 
         # Проверим, что text - это строка
         if not isinstance(doc['text'], str):
-            print(
-                f"[WARNING] В документе индекс {i} поле 'text' не является строкой. Тип: {type(doc['text'])}. Пропущен.")
+            logger.warning(
+                f"В документе индекс {i} поле 'text' не является строкой. Тип: {type(doc['text'])}. Пропущен.")
             continue
         # Проверим, что metadata - это словарь
         if not isinstance(doc['metadata'], dict):
-            print(
-                f"[WARNING] В документе индекс {i} поле 'metadata' не является словарем. Тип: {type(doc['metadata'])}. Пропущен.")
+            logger.warning(
+                f"В документе индекс {i} поле 'metadata' не является словарем. Тип: {type(doc['metadata'])}. Пропущен.")
             continue
 
         doc_id = doc['id']
@@ -143,9 +167,10 @@ def add_documents_to_vector_db(
 
         # Создаем эмбеддинг для текста
         try:
-            embedding = model.encode(text).tolist()
+            with telemetry.span("embedding", doc_id=doc_id):
+                embedding = model.encode(text).tolist()
         except Exception as e:
-            print(f"Ошибка при создании эмбеддинга для документа {doc_id}: {e}")
+            logger.error(f"Ошибка при создании эмбеддинга для документа {doc_id}: {e}")
             continue
 
         ids.append(doc_id)
@@ -154,26 +179,74 @@ def add_documents_to_vector_db(
         texts.append(text)
         added_count += 1
 
-    print(f"[DEBUG] Подготовлено {added_count} документов для добавления в БД.")
+    logger.debug(f"Подготовлено {added_count} документов для добавления в БД.")
 
     # Добавляем документы в коллекцию
     if ids:
         try:
-            print(f"[DEBUG] Попытка добавить {len(ids)} документов в коллекцию Chroma...")
-            collection.add(
-                ids=ids,
-                embeddings=embeddings,
-                metadatas=metadatas,
-                documents=texts
-            )
-            print(f"Успешно добавлено {len(ids)} документов в векторную базу данных")
+            logger.debug(f"Попытка добавить {len(ids)} документов в коллекцию Chroma...")
+            with telemetry.span("index_add", documents=len(ids)):
+                collection.add(
+                    ids=ids,
+                    embeddings=embeddings,
+                    metadatas=metadatas,
+                    documents=texts
+                )
+            logger.info(f"Успешно добавлено {len(ids)} документов в векторную базу данных")
         except Exception as e:
-            print(f"Ошибка при добавлении документов в векторную базу данных: {e}")
-            import traceback
-            traceback.print_exc()
+            logger.exception(f"Ошибка при добавлении документов в векторную базу данных: {e}")
             raise e
     else:
-        print("[WARNING] Нет документов для добавления после фильтрации.")
+        logger.warning("Нет документов для добавления после фильтрации.")
+
+    return {"ids": ids, "embeddings": embeddings, "metadatas": metadatas, "texts": texts}
+
+
+def noisy_queries(embeddings: np.ndarray, size: int, similarity: float = EVAL_QUERY_SIMILARITY,
+                  seed: int = 0) -> np.ndarray:
+    """
+    Запросы для оценки: нормированные документы со случайным шумом, подобранным так, чтобы
+    косинусная близость запроса к исходному документу была около similarity.
+
+    Шум с отклонением sigma по каждой из dim координат имеет норму около sigma * sqrt(dim)
+    и почти ортогонален документу, поэтому cos = 1 / sqrt(1 + sigma^2 * dim).
+    """
+    rng = np.random.default_rng(seed)
+    sample = rng.choice(len(embeddings), size=min(size, len(embeddings)), replace=False)
+    base = embeddings[sample] / np.maximum(np.linalg.norm(embeddings[sample], axis=1, keepdims=True), 1e-12)
+    dim = embeddings.shape[1]
+    sigma = np.sqrt(1 / similarity ** 2 - 1) / np.sqrt(dim)
+    return (base + rng.normal(scale=sigma, size=base.shape)).astype(np.float32)
+
+
+def build_quantized_index(added: Dict[str, List[Any]], mode: str, output_dir: str,
+                          eval_queries: int = 200,
+                          eval_similarity: float = EVAL_QUERY_SIMILARITY) -> Optional[QuantizedIndex]:
+    """
+    Строит квантованный индекс по уже посчитанным эмбеддингам, сохраняет его рядом с Chroma
+    и печатает recall относительно точного поиска, объем памяти и задержку.
+    """
+    if not added["ids"]:
+        logger.warning("Нет эмбеддингов для построения квантованного индекса.")
+        return None
+    embeddings = np.asarray(added["embeddings"], dtype=np.float32)
+    with telemetry.span("quantized_index_build", mode=mode, documents=len(added["ids"])):
+        index = QuantizedIndex.build(added["ids"], embeddings, mode=mode)
+
+    # Запросами служат сами документы со случайным шумом: ближайший сосед известен, но не тривиален
+    report = index.evaluate(noisy_queries(embeddings, eval_queries, eval_similarity), k=5)
+    report["eval_query_similarity"] = eval_similarity
+    logger.info(format_report(report))
+
+    documents = [
+        {"id": doc_id, "text": text, "metadata": metadata}
+        for doc_id, text, metadata in zip(added["ids"], added["texts"], added["metadatas"])
+    ]
+    index.save(output_dir, documents)
+    with open(os.path.join(output_dir, "report.json"), "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    logger.info(f"Квантованный индекс сохранен в {output_dir}")
+    return index
 
 
 def verify_vector_db(collection: chromadb.Collection):
@@ -182,77 +255,114 @@ def verify_vector_db(collection: chromadb.Collection):
     """
     try:
         count = collection.count()
-        print(f"Общее количество документов в коллекции: {count}")
+        logger.info(f"Общее количество документов в коллекции: {count}")
 
         if count > 0:
             results = collection.get(limit=3)
-            print("Примеры документов в векторной базе:")
+            logger.info("Примеры документов в векторной базе:")
             # Проверяем, есть ли данные в results
             if results and 'ids' in results and results['ids']:
                 for i in range(min(3, len(results['ids']))):
-                    print(f"  ID: {results['ids'][i]}")
+                    logger.info(f"  ID: {results['ids'][i]}")
                     # Проверяем длину documents перед доступом
                     if i < len(results['documents']):
-                        print(
+                        logger.info(
                             f"  Текст (первые 100 символов): {results['documents'][i][:100] if results['documents'][i] else 'N/A'}...")
                     else:
-                        print(f"  Текст: N/A")
+                        logger.info(f"  Текст: N/A")
                     # Проверяем длину metadatas перед доступом
                     if i < len(results['metadatas']):
-                        print(f"  Метаданные: {results['metadatas'][i]}")
+                        logger.info(f"  Метаданные: {results['metadatas'][i]}")
                     else:
-                        print(f"  Метаданные: N/A")
-                    print("-" * 20)
+                        logger.info(f"  Метаданные: N/A")
+                    logger.info("-" * 20)
             else:
-                print("  Получен пустой результат или отсутствуют данные.")
+                logger.info("  Получен пустой результат или отсутствуют данные.")
     except Exception as e:
-        print(f"Ошибка при проверке векторной базы данных: {e}")
-        import traceback
-        traceback.print_exc()
+        logger.exception(f"Ошибка при проверке векторной базы данных: {e}")
 
 
 def main():
     """
     Основная функция для создания векторной базы знаний.
     """
-    print("=" * 40)
-    print("Начало создания векторной базы знаний...")
-    print("=" * 40)
+    telemetry.setup_logging()
+    parser = argparse.ArgumentParser(description="Создание векторной базы знаний")
+    parser.add_argument("--quantized", choices=QUANTIZATION_MODES, default=os.getenv("INDEX_QUANTIZATION") or None,
+                        help="Дополнительно построить квантованный индекс (int8 или binary)")
+    parser.add_argument("--eval-similarity", type=float, default=EVAL_QUERY_SIMILARITY,
+                        help="Близость зашумленных запросов к документам при оценке квантованного индекса")
+    args = parser.parse_args()
+
+    logger.info("=" * 40)
+    logger.info("Начало создания векторной базы знаний...")
+    logger.info("=" * 40)
 
     documents = load_processed_documents()
     if not documents:
-        print("Нет документов для добавления в векторную базу данных. Завершение.")
+        logger.info("Нет документов для добавления в векторную базу данных. Завершение.")
         return
 
-    print(f"Шаг 1: Загружены {len(documents)} документов.")
+    logger.info(f"Шаг 1: Загружены {len(documents)} документов.")
 
     try:
         model = initialize_embedding_model()
-        print("Шаг 2: Модель эмбеддингов инициализирована.")
+        logger.info("Шаг 2: Модель эмбеддингов инициализирована.")
     except Exception as e:
-        print(f"Шаг 2: Не удалось инициализировать модель эмбеддингов: {e}")
+        logger.error(f"Шаг 2: Не удалось инициализировать модель эмбеддингов: {e}")
         return
 
+    # Новая сборка пишется в отдельную папку; бот продолжает читать активную версию
+    version = index_versions.new_version()
+    output_dir = index_versions.build_dir(version)
+    logger.info(f"Версия сборки индекса: {version} ({output_dir})")
+
     try:
-        collection = initialize_vector_db()
-        print("Шаг 3: Векторная база данных инициализирована.")
+        collection = initialize_vector_db(output_dir)
+        logger.info("Шаг 3: Векторная база данных инициализирована.")
     except Exception as e:
-        print(f"Шаг 3: Не удалось инициализировать векторную базу данных: {e}")
+        logger.error(f"Шаг 3: Не удалось инициализировать векторную базу данных: {e}")
+        index_versions.discard(version)
         return
 
     try:
-        add_documents_to_vector_db(collection, documents, model)
-        print("Шаг 4: Документы добавлены в векторную базу данных.")
+        added = add_documents_to_vector_db(collection, documents, model)
+        logger.info("Шаг 4: Документы добавлены в векторную базу данных.")
     except Exception as e:
-        print(f"Шаг 4: Не удалось добавить документы в векторную базу данных: {e}")
+        logger.error(f"Шаг 4: Не удалось добавить документы в векторную базу данных: {e}")
+        index_versions.discard(version)
         return
 
-    print("Шаг 5: Проверка содержимого векторной базы данных...")
+    logger.info("Шаг 5: Проверка содержимого векторной базы данных...")
     verify_vector_db(collection)
+    if collection.count() == 0:
+        logger.error("Шаг 5: Коллекция пуста, сборка не будет опубликована.")
+        index_versions.discard(version)
+        return
 
-    print("=" * 40)
-    print("Создание векторной базы знаний завершено успешно!")
-    print("=" * 40)
+    quantized = None
+    if args.quantized:
+        logger.info(f"Шаг 6: Построение квантованного индекса ({args.quantized})...")
+        try:
+            build_quantized_index(added, args.quantized, os.path.join(output_dir, QUANTIZED_SUBDIR),
+                                  eval_similarity=args.eval_similarity)
+            quantized = args.quantized
+        except Exception as e:
+            logger.exception(f"Шаг 6: Не удалось построить квантованный индекс: {e}")
+
+    # Публикация: манифест, затем атомарная подмена указателя на активную версию
+    index_versions.write_manifest(version, {
+        "collection": index_versions.COLLECTION_NAME,
+        "documents": collection.count(),
+        "embedding_backend": EMBEDDING_BACKEND,
+        "quantized": quantized,
+    })
+    index_versions.publish(version)
+    index_versions.prune_builds()
+
+    logger.info("=" * 40)
+    logger.info("Создание векторной базы знаний завершено успешно!")
+    logger.info("=" * 40)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,321 @@
+# fact_table.py
+"""
+Таблица фактов о программах и быстрые ответы на фактические вопросы без LLM.
+
+На страницах программ есть фиксированный блок "ключ - значение" (форма обучения, длительность,
+стоимость, общежитие, военный учебный центр, даты экзаменов, направления с числом мест).
+При обработке данных он разбирается в типизированную таблицу processed_data/program_facts.json,
+а FactMatcher отвечает на частые вопросы прямо из нее: без эмбеддинга, поиска и генерации.
+Если вопрос не распознан однозначно, матчер возвращает None и запрос идет обычным путем.
+"""
+import os
+import re
+import json
+import logging
+from dataclasses import dataclass, field, asdict
+from typing import Any, Dict, List, Optional
+
+import telemetry
+from programs import PROGRAM_TITLES, detect_program
+
+logger = logging.getLogger(__name__)
+
+FACTS_PATH = os.path.join("processed_data", "program_facts.json")
+# Вопросы с ожидаемым типом ответа (null - вопрос должен уйти в обычный QA)
+CASES_FILE = os.path.join("benchmarks", "fact_questions.json")
+# Вопросы длиннее этого числа слов обычно требуют развернутого ответа
+MAX_QUERY_WORDS = 14
+
+# Подпись поля на странице -> имя поля таблицы
+FIELD_LABELS = {
+    "форма обучения": "study_form",
+    "длительность": "duration",
+    "язык обучения": "language",
+    "стоимость контрактного обучения (год)": "tuition_rub",
+    "общежитие": "dormitory",
+    "военный учебный центр": "military_center",
+    "гос. аккредитация": "accreditation",
+}
+BOOL_FIELDS = {"dormitory", "military_center", "accreditation"}
+
+DIRECTION_CODE_RE = re.compile(r"^\d{2}\.\d{2}\.\d{2}$")
+EXAM_DATE_RE = re.compile(r"^\d{2}\.\d{2}\.\d{4}(,\s*\d{1,2}:\d{2})?$")
+
+
+@dataclass
+class Direction:
+    """Направление подготовки с числом мест."""
+    code: str
+    name: str
+    budget: int = 0
+    target: int = 0
+    contract: int = 0
+
+
+@dataclass
+class ProgramFacts:
+    """Факты об одной программе со страницы программы."""
+    program: str
+    source_file: str = ""
+    study_form: Optional[str] = None
+    duration: Optional[str] = None
+    language: Optional[str] = None
+    tuition_rub: Optional[int] = None
+    dormitory: Optional[bool] = None
+    military_center: Optional[bool] = None
+    accreditation: Optional[bool] = None
+    exam_dates: List[str] = field(default_factory=list)
+    directions: List[Direction] = field(default_factory=list)
+
+    @property
+    def title(self) -> str:
+        return PROGRAM_TITLES.get(self.program, self.program)
+
+    def places(self, kind: str) -> int:
+        return sum(getattr(d, kind) for d in self.directions)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return asdict(self)
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> "ProgramFacts":
+        data = dict(data)
+        data["directions"] = [Direction(**d) for d in data.get("directions", [])]
+        return cls(**data)
+
+
+def _parse_int(value: str) -> Optional[int]:
+    digits = re.sub(r"\D", "", value)
+    return int(digits) if digits else None
+
+
+def _parse_value(field_name: str, value: str) -> Any:
+    if field_name == "tuition_rub":
+        return _parse_int(value)
+    if field_name in BOOL_FIELDS:
+        return value.strip().lower() in ("да", "есть")
+    return value.strip()
+
+
+def extract_facts(program: str, text: str, source_file: str = "") -> ProgramFacts:
+    """
+    Разбирает блок фактов со страницы программы (значение идет строкой ниже подписи).
+    """
+    facts = ProgramFacts(program=program, source_file=source_file)
+    lines = [line.strip() for line in text.splitlines() if line.strip()]
+    i = 0
+    while i < len(lines):
+        label = lines[i].lower()
+        if label in FIELD_LABELS and i + 1 < len(lines):
+            field_name = FIELD_LABELS[label]
+            # Берем только первое вхождение: ниже по странице подписи могут повторяться в тексте
+            if getattr(facts, field_name) is None:
+                setattr(facts, field_name, _parse_value(field_name, lines[i + 1]))
+            i += 2
+            continue
+        if label == "даты вступительного экзамена":
+            i += 1
+            while i < len(lines) and EXAM_DATE_RE.match(lines[i]):
+                facts.exam_dates.append(lines[i])
+                i += 1
+            continue
+        if label == "направления подготовки":
+            i += 1
+            # Группы: код, название, N "бюджетных", N "целевая", N "контрактных"
+            while i + 1 < len(lines) and DIRECTION_CODE_RE.match(lines[i]):
+                direction = Direction(code=lines[i], name=lines[i + 1])
+                i += 2
+                while i + 1 < len(lines) and lines[i].isdigit():
+                    kind = lines[i + 1].lower()
+                    if kind.startswith("бюджет"):
+                        direction.budget = int(lines[i])
+                    elif kind.startswith("целев"):
+                        direction.target = int(lines[i])
+                    elif kind.startswith("контракт"):
+                        direction.contract = int(lines[i])
+                    else:
+                        break
+                    i += 2
+                facts.directions.append(direction)
+            continue
+        i += 1
+    return facts
+
+
+def build_fact_table(programs: List[tuple]) -> Dict[str, ProgramFacts]:
+    """
+    Извлекает факты для списка (имя программы, файл контента, ...) из process_data.list_programs().
+    """
+    table = {}
+    for program, content_file, *_ in programs:
+        with open(content_file, "r", encoding="utf-8") as f:
+            facts = extract_facts(program, f.read(), source_file=content_file)
+        missing = [name for name in FIELD_LABELS.values() if getattr(facts, name) is None]
+        if missing:
+            logger.warning(f"Факты программы {program}: не найдены поля {', '.join(missing)}")
+        table[program] = facts
+    return table
+
+
+def save_fact_table(table: Dict[str, ProgramFacts], path: str = FACTS_PATH):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump({name: facts.to_dict() for name, facts in table.items()}, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_path, path)
+
+
+def load_fact_table(path: str = FACTS_PATH) -> Dict[str, ProgramFacts]:
+    with open(path, "r", encoding="utf-8") as f:
+        return {name: ProgramFacts.from_dict(data) for name, data in json.load(f).items()}
+
+
+def _has_value(value: Any) -> bool:
+    return value is not None and value != "" and value != []
+
+
+def _format_rub(value: int) -> str:
+    return f"{value:,}".replace(",", " ") + " ₽"
+
+
+def _yes_no(value: Optional[bool]) -> str:
+    return "да" if value else "нет"
+
+
+def _render_places(facts: ProgramFacts, kind: str, label: str) -> str:
+    details = "; ".join(f"{d.code} {d.name} — {getattr(d, kind)}" for d in facts.directions)
+    return f"{label} на программе «{facts.title}»: {facts.places(kind)} ({details})."
+
+
+# (тип вопроса, шаблон, функция ответа по фактам программы, нужное поле таблицы).
+# Шаблоны привязаны к форме вопроса ("есть ли общежитие", "сколько стоит обучение"):
+# лучше отдать вопрос в обычный QA, чем ответить не на тот вопрос.
+FACT_INTENTS = [
+    ("budget_places", re.compile(r"(сколько|количеств\w*)\s+(\w+\s+)?бюджетн\w*\s+мест|сколько\s+мест\s+на\s+бюджет"),
+     lambda f: _render_places(f, "budget", "Бюджетных мест"), "directions"),
+    ("target_places", re.compile(r"(сколько|количеств\w*)\s+(\w+\s+)?(целев\w*\s+мест|мест\s+(по\s+)?целев)"),
+     lambda f: _render_places(f, "target", "Мест целевого обучения"), "directions"),
+    ("contract_places", re.compile(r"(сколько|количеств\w*)\s+(\w+\s+)?(контрактн|платн)\w*\s+мест"),
+     lambda f: _render_places(f, "contract", "Контрактных мест"), "directions"),
+    ("tuition", re.compile(r"сколько\s+стоит\s+(\w+\s+)?обучени|(как\w*|сколько)\s+(\w+\s+)?стоимост\w*\s+(\w+\s+)?обучени|"
+                           r"^стоимост\w*\s+(\w+\s+)?обучени|цена\s+обучени"),
+     lambda f: f"Стоимость контрактного обучения на программе «{f.title}»: {_format_rub(f.tuition_rub)} в год.",
+     "tuition_rub"),
+    ("exam_dates", re.compile(r"(когда|дат\w*)\s+(\w+\s+){0,2}(вступительн\w*\s+)?экзамен|экзамен\w*\s+(\w+\s+)?когда"),
+     lambda f: f"Даты вступительного экзамена на программе «{f.title}»: {'; '.join(f.exam_dates)}.",
+     "exam_dates"),
+    ("dormitory", re.compile(r"(есть|предоставля\w*|да\w*|будет)\s+ли\s+(\w+\s+)?общежити|общежити\w*\s+(есть|предоставля)"),
+     lambda f: f"Общежитие на программе «{f.title}»: {_yes_no(f.dormitory)}.", "dormitory"),
+    ("military_center", re.compile(r"(есть|имеется)\s+ли\s+(\w+\s+)?(военн\w*\s+(учебн\w*\s+)?(центр|кафедр)|вуц\b)"),
+     lambda f: f"Военный учебный центр на программе «{f.title}»: {_yes_no(f.military_center)}.",
+     "military_center"),
+    ("duration", re.compile(r"сколько\s+(лет\s+)?(длится|идет)\s+обучени|сколько\s+лет\s+(учиться|обучени)|"
+                           r"длительност\w*\s+обучени|срок\w*\s+обучени"),
+     lambda f: f"Длительность обучения на программе «{f.title}»: {f.duration}.", "duration"),
+    ("study_form", re.compile(r"форм\w*\s+обучени|(есть\s+ли|можно\s+ли)\s+(\w+\s+)?заочн"),
+     lambda f: f"Форма обучения на программе «{f.title}»: {f.study_form}.", "study_form"),
+    ("language", re.compile(r"язык\w*\s+обучени|на\s+каком\s+языке"),
+     lambda f: f"Язык обучения на программе «{f.title}»: {f.language}.", "language"),
+]
+# Слова, уточняющие вопрос сверх факта из таблицы ("где общежитие", "стоимость для иностранцев",
+# "требования для поступления на бюджет"): такие вопросы отвечает обычный QA.
+# Таблица описывает текущий год приема, стоимость за год и программу целиком, поэтому
+# вопросы о другом годе ("в прошлом году"), другом периоде ("за семестр") и отдельном
+# направлении ("на направлении Инноватика") тоже уходят в QA.
+QUALIFIER_RE = re.compile(
+    r"\b(где|как|куда|откуда|почему|зачем|кому|кроме)\b|требовани|услови|иностран|гражда|оплат|скидк|льгот|"
+    r"рассрочк|материнск|вычет|засел|документ|проходн|балл|конкурс|подготов|перевод|вечерн|"
+    r"прошл|позапрошл|следующ|будущ|предыдущ|раньше|ранее|\b(19|20)\d{2}\b|"
+    r"семестр|месяц|квартал|\bза\s+(весь|все|всё|два|2)\b|"
+    r"направлени|профил|специальност|\b\d{2}\.\d{2}\.\d{2}\b"
+)
+
+class FactMatcher:
+    """Отвечает на фактический вопрос из таблицы, если тип вопроса и программа определены однозначно."""
+
+    def __init__(self, table: Dict[str, ProgramFacts]):
+        self.table = table
+        # Названия направлений из таблицы ("Инноватика"): по основе первого слова,
+        # чтобы совпадали и падежные формы ("на Инноватике")
+        stems = {d.name.lower().split()[0][:-2] for facts in table.values() for d in facts.directions if d.name}
+        stems = sorted(stem for stem in stems if len(stem) >= 5)
+        self.direction_re = re.compile(r"\b(" + "|".join(map(re.escape, stems)) + ")") if stems else None
+
+    @classmethod
+    def load(cls, path: str = FACTS_PATH) -> "FactMatcher":
+        table = load_fact_table(path)
+        logger.info(f"Загружена таблица фактов: {len(table)} программ из {path}")
+        return cls(table)
+
+    def match(self, query: str) -> Optional[Dict[str, Any]]:
+        """
+        Возвращает {"intent", "answer", "sources"} или None, если ответ не однозначен.
+        """
+        with telemetry.span("fact_lookup") as lookup_span:
+            result = self._match(query)
+            lookup_span["intent"] = result["intent"] if result else None
+        telemetry.record_cache("facts", result is not None)
+        return result
+
+    def _match(self, query: str) -> Optional[Dict[str, Any]]:
+        query_lower = query.lower()
+        if len(query_lower.split()) > MAX_QUERY_WORDS or QUALIFIER_RE.search(query_lower):
+            return None
+        if self.direction_re is not None and self.direction_re.search(query_lower):
+            return None
+        intents = [intent for intent in FACT_INTENTS if intent[1].search(query_lower)]
+        if len(intents) != 1:
+            return None
+        name, _, render, field_name = intents[0]
+
+        program = detect_program(query)
+        if program:
+            programs = [program] if program in self.table else []
+        else:
+            programs = sorted(self.table)
+        # У всех выбранных программ поле должно быть заполнено, иначе отвечает обычный QA
+        if not programs or any(not _has_value(getattr(self.table[p], field_name)) for p in programs):
+            return None
+
+        answer = "\n".join(render(self.table[p]) for p in programs)
+        sources = [
+            {"program_name": p, "chunk_type": "web_content", "source_file": self.table[p].source_file}
+            for p in programs
+        ]
+        return {"intent": name, "answer": answer, "sources": sources}
+
+
+def check_cases(matcher: FactMatcher, path: str = CASES_FILE) -> List[str]:
+    """
+    Прогоняет вопросы из файла проверки; возвращает описания несовпадений.
+    """
+    with open(path, "r", encoding="utf-8") as f:
+        cases = json.load(f)
+    failures = []
+    for case in cases:
+        result = matcher.match(case["question"])
+        intent = result["intent"] if result else None
+        if intent != case["intent"]:
+            failures.append(f"{case['question']!r}: ожидалось {case['intent']}, получено {intent}")
+            continue
+        # Необязательное поле programs - программы, по которым должен быть дан ответ
+        programs = sorted(source["program_name"] for source in result["sources"]) if result else []
+        if "programs" in case and programs != sorted(case["programs"]):
+            failures.append(f"{case['question']!r}: ожидались программы {case['programs']}, получено {programs}")
+    return failures
+
+
+def main():
+    """
+    Проверка распознавания вопросов по benchmarks/fact_questions.json.
+    """
+    matcher = FactMatcher.load()
+    failures = check_cases(matcher)
+    for failure in failures:
+        print(failure)
+    print(f"Несовпадений: {len(failures)}")
+    raise SystemExit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
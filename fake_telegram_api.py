@@ -0,0 +1,234 @@
+# fake_telegram_api.py
+"""
+Локальная заглушка Telegram Bot API и нагрузочный прогон бота в режиме webhook.
+
+Заглушка отвечает на вызовы, которые делает бот (getMe, setWebhook, deleteWebhook,
+getWebhookInfo, sendMessage, sendChatAction), и запоминает отправленные ответы.
+Нагрузочный прогон отправляет на webhook бота обновления с сообщениями от разных чатов
+(как это делает Telegram) и измеряет время до ответа в каждый чат.
+
+Пример:
+    # 1. заглушка API и нагрузка (ждет, пока бот зарегистрирует webhook)
+    python fake_telegram_api.py --port 8081 --messages 50 --concurrency 10 --secret s3cret
+    # 2. бот, направленный на заглушку
+    TELEGRAM_API_BASE_URL=http://127.0.0.1:8081/bot BOT_MODE=webhook \\
+        WEBHOOK_URL=http://127.0.0.1:8443/telegram WEBHOOK_LISTEN=127.0.0.1 WEBHOOK_SECRET=s3cret python bot.py
+"""
+import json
+import time
+import argparse
+import statistics
+import threading
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, List, Optional
+from urllib.parse import parse_qsl
+
+DEFAULT_QUESTIONS = [
+    "Сколько бюджетных мест на программе Искусственный интеллект?",
+    "Какие дисциплины есть в учебном плане AI Product?",
+    "Чем отличаются программы ИИ и AI Product?",
+    "Какие карьерные перспективы после программы Искусственный интеллект?",
+    "Есть ли общежитие?",
+]
+
+BOT_USER = {"id": 1, "is_bot": True, "first_name": "ITMO Bot", "username": "itmo_test_bot"}
+
+
+class FakeTelegramState:
+    """Состояние заглушки: зарегистрированный webhook и ответы бота по чатам."""
+
+    def __init__(self):
+        self.webhook: Dict[str, Any] = {}
+        self.replies: Dict[int, List[Dict[str, Any]]] = {}
+        self.message_id = 0
+        self._lock = threading.Lock()
+        self._changed = threading.Condition(self._lock)
+
+    def set_webhook(self, params: Dict[str, Any]):
+        with self._changed:
+            self.webhook = params
+            self._changed.notify_all()
+
+    def add_reply(self, params: Dict[str, Any]) -> Dict[str, Any]:
+        with self._changed:
+            self.message_id += 1
+            chat_id = int(params["chat_id"])
+            message = {
+                "message_id": self.message_id,
+                "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "private"},
+                "from": BOT_USER,
+                "text": params.get("text", ""),
+            }
+            self.replies.setdefault(chat_id, []).append({**message, "received_at": time.perf_counter()})
+            self._changed.notify_all()
+            return message
+
+    def wait_webhook(self, timeout: float) -> Optional[Dict[str, Any]]:
+        with self._changed:
+            self._changed.wait_for(lambda: self.webhook.get("url"), timeout)
+            return self.webhook or None
+
+    def wait_reply(self, chat_id: int, timeout: float) -> Optional[Dict[str, Any]]:
+        with self._changed:
+            self._changed.wait_for(lambda: self.replies.get(chat_id), timeout)
+            replies = self.replies.get(chat_id)
+            return replies[0] if replies else None
+
+
+def _parse_params(handler: BaseHTTPRequestHandler) -> Dict[str, Any]:
+    """
+    Параметры вызова Bot API: JSON или form-urlencoded (python-telegram-bot кодирует
+    вложенные значения в JSON).
+    """
+    length = int(handler.headers.get("Content-Length") or 0)
+    body = handler.rfile.read(length).decode("utf-8") if length else ""
+    if not body:
+        return {}
+    if handler.headers.get("Content-Type", "").startswith("application/json"):
+        return json.loads(body)
+    params = {}
+    for key, value in parse_qsl(body):
+        try:
+            params[key] = json.loads(value)
+        except ValueError:
+            params[key] = value
+    return params
+
+
+def make_handler(state: FakeTelegramState):
+    class FakeTelegramHandler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            # Путь вида /bot<token>/<method>
+            method = self.path.rstrip("/").rsplit("/", 1)[-1]
+            params = _parse_params(self)
+            if method == "getMe":
+                result: Any = BOT_USER
+            elif method == "setWebhook":
+                state.set_webhook(params)
+                result = True
+            elif method == "deleteWebhook":
+                state.set_webhook({})
+                result = True
+            elif method == "getWebhookInfo":
+                result = {"url": state.webhook.get("url", ""), "has_custom_certificate": False,
+                          "pending_update_count": 0}
+            elif method == "sendMessage":
+                result = state.add_reply(params)
+            elif method == "sendChatAction":
+                result = True
+            else:
+                self._respond(404, {"ok": False, "error_code": 404, "description": f"Not Found: {method}"})
+                return
+            self._respond(200, {"ok": True, "result": result})
+
+        do_GET = do_POST
+
+        def _respond(self, status: int, payload: Dict[str, Any]):
+            body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    return FakeTelegramHandler
+
+
+def start_server(port: int, host: str = "127.0.0.1") -> tuple:
+    state = FakeTelegramState()
+    server = ThreadingHTTPServer((host, port), make_handler(state))
+    threading.Thread(target=server.serve_forever, name="fake-telegram-api", daemon=True).start()
+    return server, state
+
+
+def make_update(update_id: int, chat_id: int, text: str) -> Dict[str, Any]:
+    user = {"id": chat_id, "is_bot": False, "first_name": f"user{chat_id}"}
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            "from": user,
+            "text": text,
+        },
+    }
+
+
+def send_update(webhook_url: str, update: Dict[str, Any], secret: Optional[str] = None):
+    headers = {"Content-Type": "application/json"}
+    if secret:
+        headers["X-Telegram-Bot-Api-Secret-Token"] = str(secret)
+    request = urllib.request.Request(webhook_url, data=json.dumps(update).encode("utf-8"), headers=headers)
+    with urllib.request.urlopen(request, timeout=30) as response:
+        response.read()
+
+
+def run_load(state: FakeTelegramState, webhook_url: str, messages: int, concurrency: int,
+             secret: Optional[str] = None, timeout: float = 300.0) -> Dict[str, Any]:
+    """
+    Отправляет messages обновлений (каждое от своего чата) не более concurrency одновременно
+    и возвращает задержки до ответа бота.
+    """
+    def one(i: int) -> Optional[float]:
+        chat_id = 1000 + i
+        started = time.perf_counter()
+        send_update(webhook_url, make_update(i + 1, chat_id, DEFAULT_QUESTIONS[i % len(DEFAULT_QUESTIONS)]), secret)
+        reply = state.wait_reply(chat_id, timeout)
+        return reply["received_at"] - started if reply else None
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        results = list(pool.map(one, range(messages)))
+    elapsed = time.perf_counter() - started
+    latencies = sorted(r for r in results if r is not None)
+    report = {"messages": messages, "answered": len(latencies), "seconds": elapsed}
+    if latencies:
+        report.update({
+            "p50": statistics.median(latencies),
+            "p95": latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))],
+            "max": latencies[-1],
+            "throughput": len(latencies) / elapsed,
+        })
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Заглушка Telegram Bot API и нагрузка на webhook бота")
+    parser.add_argument("--port", type=int, default=8081, help="Порт заглушки API")
+    parser.add_argument("--webhook", default=None,
+                        help="URL webhook бота (по умолчанию берется из setWebhook, который вызывает бот)")
+    parser.add_argument("--messages", type=int, default=20, help="Сколько сообщений отправить")
+    parser.add_argument("--concurrency", type=int, default=10, help="Сколько сообщений отправлять одновременно")
+    parser.add_argument("--secret", default=None, help="Секрет webhook (WEBHOOK_SECRET бота)")
+    parser.add_argument("--timeout", type=float, default=300.0, help="Ожидание ответа на одно сообщение, с")
+    args = parser.parse_args()
+
+    server, state = start_server(args.port)
+    print(f"Заглушка Bot API: http://127.0.0.1:{args.port}/bot (TELEGRAM_API_BASE_URL)")
+    webhook_url = args.webhook
+    if not webhook_url:
+        print("Ожидание регистрации webhook ботом...")
+        webhook = state.wait_webhook(timeout=600)
+        if not webhook:
+            print("Бот не зарегистрировал webhook")
+            return
+        webhook_url = webhook["url"]
+        args.secret = args.secret or webhook.get("secret_token")
+
+    report = run_load(state, webhook_url, args.messages, args.concurrency, args.secret, args.timeout)
+    print(f"Отвечено: {report['answered']} из {report['messages']} за {report['seconds']:.1f} с")
+    if report["answered"]:
+        print(f"Задержка ответа: p50={report['p50']:.2f} с, p95={report['p95']:.2f} с, max={report['max']:.2f} с; "
+              f"{report['throughput']:.2f} сообщ./с")
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
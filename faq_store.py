@@ -0,0 +1,149 @@
+# faq_store.py
+"""
+Хранилище заранее сгенерированных ответов на типовые вопросы (FAQ).
+
+Ответы строятся офлайн скриптом build_faq.py. Во время работы бот ищет ближайший
+канонический вопрос программы, названной в запросе, по эмбеддингу и, если сходство выше
+порога, отвечает из хранилища без поиска контекста и вызова LLM.
+"""
+import os
+import json
+import hashlib
+import logging
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+
+import telemetry
+from programs import detect_program
+
+logger = logging.getLogger(__name__)
+
+FAQ_STORE_PATH = os.path.join("processed_data", "faq_store.json")
+# Версия шаблонов вопросов, промпта и параметров генерации; изменение версии инвалидирует все ответы
+FAQ_TEMPLATE_VERSION = "2"
+# Минимальная косинусная близость, при которой ответ берется из FAQ
+DEFAULT_MIN_SIMILARITY = float(os.getenv("FAQ_MIN_SIMILARITY", "0.85"))
+
+# Канонические вопросы по темам; {title} заменяется названием программы.
+# Все формулировки темы разделяют один сгенерированный ответ.
+CANONICAL_QUESTIONS: Dict[str, List[str]] = {
+    "cost": [
+        "Сколько стоит обучение на программе {title}?",
+        "Какая стоимость контрактного обучения на {title}?",
+    ],
+    "budget_places": [
+        "Сколько бюджетных мест на программе {title}?",
+        "Какое количество бюджетных мест на {title}?",
+    ],
+    "exam_dates": [
+        "Когда вступительные экзамены на программу {title}?",
+        "Какие даты вступительного экзамена на {title}?",
+    ],
+    "dormitory": [
+        "Есть ли общежитие у программы {title}?",
+        "Предоставляют ли общежитие студентам {title}?",
+    ],
+    "military_center": [
+        "Есть ли военный учебный центр на программе {title}?",
+        "Есть ли военная кафедра на {title}?",
+    ],
+    "partners": [
+        "Какие компании являются партнерами программы {title}?",
+        "С какими партнерами работает программа {title}?",
+    ],
+}
+
+
+def content_hash(paths: List[str]) -> str:
+    """
+    Возвращает хеш содержимого исходных файлов программы и версии шаблонов FAQ.
+    """
+    digest = hashlib.sha256(FAQ_TEMPLATE_VERSION.encode("utf-8"))
+    for path in sorted(p for p in paths if p):
+        digest.update(path.replace("\\", "/").encode("utf-8"))
+        try:
+            with open(path, "rb") as f:
+                for chunk in iter(lambda: f.read(65536), b""):
+                    digest.update(chunk)
+        except OSError:
+            digest.update(b"<missing>")
+    return digest.hexdigest()
+
+
+def load_store_file(path: str = FAQ_STORE_PATH) -> Dict[str, Any]:
+    """
+    Читает файл хранилища; при отсутствии возвращает пустую структуру.
+    """
+    if not os.path.exists(path):
+        return {"template_version": FAQ_TEMPLATE_VERSION, "programs": {}}
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def save_store_file(data: Dict[str, Any], path: str = FAQ_STORE_PATH):
+    """
+    Атомарно сохраняет хранилище (запись во временный файл и замена).
+    """
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_path, path)
+
+
+class FAQStore:
+    """Индекс канонических вопросов с поиском ближайшего соседа по эмбеддингу."""
+
+    def __init__(self, entries: List[Dict[str, Any]], min_similarity: float = DEFAULT_MIN_SIMILARITY):
+        self.entries = entries
+        self.min_similarity = min_similarity
+        # Каждая формулировка вопроса - отдельная строка матрицы, ссылающаяся на свою запись
+        rows = []
+        self.row_to_entry: List[int] = []
+        for entry_idx, entry in enumerate(entries):
+            for embedding in entry["question_embeddings"]:
+                rows.append(embedding)
+                self.row_to_entry.append(entry_idx)
+        if rows:
+            matrix = np.asarray(rows, dtype=np.float32)
+            self.matrix = matrix / np.maximum(np.linalg.norm(matrix, axis=1, keepdims=True), 1e-12)
+        else:
+            self.matrix = np.zeros((0, 0), dtype=np.float32)
+
+    @classmethod
+    def load(cls, path: str = FAQ_STORE_PATH, min_similarity: float = DEFAULT_MIN_SIMILARITY) -> "FAQStore":
+        data = load_store_file(path)
+        entries = []
+        for program in data.get("programs", {}).values():
+            entries.extend(program.get("entries", []))
+        logger.info(f"Загружено {len(entries)} ответов FAQ из {path}")
+        return cls(entries, min_similarity=min_similarity)
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def lookup(self, query_embedding: List[float], query: str) -> Optional[Dict[str, Any]]:
+        """
+        Возвращает запись FAQ, ближайшую к запросу, если близость не ниже порога.
+        Канонические вопросы программ отличаются только названием, поэтому сравниваются
+        только вопросы программы, упомянутой в запросе; без программы FAQ не используется.
+        """
+        program = detect_program(query)
+        rows = [row for row, entry_idx in enumerate(self.row_to_entry)
+                if self.entries[entry_idx].get("program_name") == program] if program else []
+        if not rows:
+            telemetry.record_cache("faq", False)
+            return None
+        with telemetry.span("faq_lookup", program=program) as lookup_span:
+            query_vector = np.asarray(query_embedding, dtype=np.float32)
+            query_vector = query_vector / max(float(np.linalg.norm(query_vector)), 1e-12)
+            scores = self.matrix[rows] @ query_vector
+            best = int(np.argmax(scores))
+            best_row = rows[best]
+            best_score = float(scores[best])
+            lookup_span["score"] = round(best_score, 4)
+        hit = best_score >= self.min_similarity
+        telemetry.record_cache("faq", hit)
+        if not hit:
+            return None
+        return {**self.entries[self.row_to_entry[best_row]], "score": best_score}
@@ -0,0 +1,144 @@
+# generation_modes.py
+"""
+Режимы генерации в зависимости от типа вопроса.
+
+Для коротких фактических вопросов (цена, дата, количество, да/нет) генерация идет жадно,
+с маленьким max_tokens и JSON-схемой, превращенной llama.cpp в GBNF-грамматику: модель не может
+выйти за рамки короткого структурированного ответа. Для агента есть грамматика формата ReAct,
+исключающая ошибки разбора шагов.
+"""
+import re
+import json
+import logging
+from dataclasses import dataclass, field
+from functools import lru_cache
+from typing import Any, Dict, List, Optional
+
+from llama_cpp import LlamaGrammar
+
+logger = logging.getLogger(__name__)
+
+# Ответ, если в контексте нет нужного факта
+NOT_FOUND_ANSWER = "В предоставленной информации нет ответа на этот вопрос."
+
+# Схема короткого фактического ответа: сначала модель решает, есть ли факт в контексте,
+# затем пишет сам факт и короткое предложение-ответ
+FACT_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "found": {"type": "boolean"},
+        "value": {"type": "string"},
+        "answer": {"type": "string"},
+    },
+    "required": ["found", "value", "answer"],
+}
+
+# Формат шага агента ZERO_SHOT_REACT: либо действие с входом, либо финальный ответ.
+# Промпт LangChain уже заканчивается на "Thought:", поэтому грамматика начинается с текста мысли.
+# Длина строк ограничена, чтобы шаг не съедал весь max_tokens.
+REACT_GBNF_TEMPLATE = r'''
+root ::= " " line "\n" (action | final)
+action ::= "Action: " tool "\n" "Action Input: " line
+final ::= "Final Answer: " text
+tool ::= {tools}
+line ::= [^\n]{{1,300}}
+text ::= [^\n]{{1,400}} ("\n" [^\n]{{1,400}}){{0,10}}
+'''
+
+
+@dataclass(frozen=True)
+class GenerationMode:
+    """Параметры генерации для типа вопроса."""
+    name: str
+    max_tokens: int
+    temperature: float = 0.0
+    top_k: int = 1
+    # JSON-схема структурированного ответа (компилируется в GBNF)
+    json_schema: Optional[Dict[str, Any]] = field(default=None, hash=False, compare=False)
+    # Готовая GBNF-грамматика (используется, если схема не задана)
+    gbnf: Optional[str] = None
+
+    def completion_overrides(self) -> Dict[str, Any]:
+        """
+        Параметры create_completion, которые задает режим.
+        """
+        overrides: Dict[str, Any] = {
+            "max_tokens": self.max_tokens,
+            "temperature": self.temperature,
+            "top_k": self.top_k,
+        }
+        grammar = self.grammar()
+        if grammar is not None:
+            overrides["grammar"] = grammar
+        return overrides
+
+    def grammar(self) -> Optional[LlamaGrammar]:
+        if self.json_schema is not None:
+            return _compile_json_schema(json.dumps(self.json_schema, ensure_ascii=False, sort_keys=False))
+        if self.gbnf is not None:
+            return _compile_gbnf(self.gbnf)
+        return None
+
+    def render(self, text: str) -> Optional[str]:
+        """
+        Превращает сгенерированный текст в ответ пользователю.
+        Возвращает None, если структурированный ответ оборван (тогда нужна свободная генерация).
+        """
+        if self.json_schema is None:
+            return text
+        try:
+            data = json.loads(text)
+        except json.JSONDecodeError:
+            # Грамматика гарантирует JSON, но генерация могла оборваться по max_tokens
+            logger.warning(f"Не удалось разобрать структурированный ответ режима {self.name}: {text[:200]}")
+            return None
+        if not data.get("found"):
+            return NOT_FOUND_ANSWER
+        return data.get("answer") or data.get("value") or NOT_FOUND_ANSWER
+
+
+@lru_cache(maxsize=32)
+def _compile_json_schema(schema_json: str) -> LlamaGrammar:
+    return LlamaGrammar.from_json_schema(schema_json, verbose=False)
+
+
+@lru_cache(maxsize=32)
+def _compile_gbnf(gbnf: str) -> LlamaGrammar:
+    return LlamaGrammar.from_string(gbnf, verbose=False)
+
+
+# Режимы коротких фактических ответов. Кириллица в токенизаторе Llama-2 занимает примерно
+# токен на 2-3 символа, поэтому запас рассчитан на JSON с двумя русскими строками
+PRICE_MODE = GenerationMode("price", max_tokens=192, json_schema=FACT_SCHEMA)
+DATE_MODE = GenerationMode("date", max_tokens=256, json_schema=FACT_SCHEMA)
+COUNT_MODE = GenerationMode("count", max_tokens=192, json_schema=FACT_SCHEMA)
+YES_NO_MODE = GenerationMode("yes_no", max_tokens=160, json_schema=FACT_SCHEMA)
+
+# Шаблоны определения типа вопроса; порядок важен ("сколько мест" - количество, "сколько стоит" - цена)
+QUERY_TYPE_PATTERNS = [
+    (COUNT_MODE, re.compile(r"сколько\s+(\w+\s+)?(бюджетн|мест|целев|контрактн|студент|человек)|количеств|число\s+мест")),
+    (PRICE_MODE, re.compile(r"сколько\s+стои|стоимост|цен[аыу]|оплат|\bруб")),
+    # Только сроки-даты ("срок подачи документов", "крайний срок"): "срок обучения" - это длительность
+    (DATE_MODE, re.compile(r"\bкогда\b|\bдат[аыу]\b|до\s+какого|крайн\w*\s+срок|дедлайн|"
+                           r"\bсрок\w*\s+(подач|при[её]м|поступлени|зачислени|сдач|регистрац|оплат|начал|окончани)")),
+    (YES_NO_MODE, re.compile(r"^(а\s+)?(есть|можно|будет|нужн\w*|предусмотрен\w*|предоставля\w*)\s+ли\b")),
+]
+
+
+def select_mode(query: str) -> Optional[GenerationMode]:
+    """
+    Возвращает режим короткого ответа для фактического вопроса или None для свободного ответа.
+    """
+    query_lower = query.lower().strip()
+    for mode, pattern in QUERY_TYPE_PATTERNS:
+        if pattern.search(query_lower):
+            return mode
+    return None
+
+
+def react_mode(tool_names: List[str], max_tokens: int = 256) -> GenerationMode:
+    """
+    Режим для шагов агента ReAct: грамматика допускает только известные инструменты.
+    """
+    tools = " | ".join(json.dumps(name, ensure_ascii=False) for name in tool_names)
+    return GenerationMode("react", max_tokens=max_tokens, gbnf=REACT_GBNF_TEMPLATE.format(tools=tools))
@@ -0,0 +1,230 @@
+# index_versions.py
+"""
+Версионирование векторного индекса (blue/green).
+
+Каждая сборка пишется в отдельную папку vector_db/builds/<версия>/ вместе с manifest.json.
+Активная версия задается файлом vector_db/CURRENT, который заменяется атомарно (os.replace)
+только после успешной сборки и проверки. Бот следит за этим файлом (IndexWatcher), загружает
+новую версию в фоне и подменяет retriever, не прерывая запросы, которые уже обрабатываются.
+
+Если файла CURRENT нет, используется прежняя раскладка: Chroma прямо в vector_db/.
+"""
+import os
+import json
+import shutil
+import logging
+import time
+import threading
+from datetime import datetime, timezone
+from typing import Any, Callable, Dict, Optional, Set
+
+import telemetry
+
+logger = logging.getLogger(__name__)
+
+VECTOR_DB_DIR = "vector_db"
+BUILDS_DIR = os.path.join(VECTOR_DB_DIR, "builds")
+CURRENT_FILE = os.path.join(VECTOR_DB_DIR, "CURRENT")
+MANIFEST_FILE = "manifest.json"
+COLLECTION_NAME = "itmo_master_programs"
+# Метрика HNSW коллекции Chroma (эмбеддинги не нормируются, поэтому это не косинус)
+COLLECTION_METADATA = {"hnsw:space": "l2"}
+# Сколько последних сборок хранить (активная не удаляется никогда)
+KEEP_BUILDS = int(os.getenv("INDEX_KEEP_BUILDS", "3"))
+# Период проверки файла CURRENT в боте, секунд
+WATCH_INTERVAL = float(os.getenv("INDEX_WATCH_INTERVAL", "30"))
+# Максимальная пауза между повторными попытками загрузить сборку, которая не загрузилась, секунд
+MAX_RETRY_INTERVAL = float(os.getenv("INDEX_MAX_RETRY_INTERVAL", "600"))
+# Отметки загруженных ботами версий: vector_db/loaded/<pid> с именем версии
+LOADED_DIR = os.path.join(VECTOR_DB_DIR, "loaded")
+# Сборки моложе этого возраста (секунд) не удаляются: бот мог еще не успеть их загрузить
+PRUNE_GRACE = float(os.getenv("INDEX_PRUNE_GRACE", "600"))
+
+telemetry.metrics.describe("index_swaps_total", "Переключения бота на новую версию индекса")
+
+
+def new_version() -> str:
+    """
+    Имя новой сборки: UTC-время с микросекундами (сортируется по времени создания).
+    """
+    return datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%S%fZ")
+
+
+def build_dir(version: str) -> str:
+    return os.path.join(BUILDS_DIR, version)
+
+
+def write_manifest(version: str, info: Dict[str, Any]):
+    manifest = {"version": version, "created_at": datetime.now(timezone.utc).isoformat(), **info}
+    with open(os.path.join(build_dir(version), MANIFEST_FILE), "w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2)
+
+
+def read_manifest(version: str) -> Dict[str, Any]:
+    path = os.path.join(build_dir(version), MANIFEST_FILE)
+    if not os.path.exists(path):
+        return {}
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def current_version() -> Optional[str]:
+    """
+    Активная версия или None, если используется прежняя раскладка без версий.
+    """
+    try:
+        with open(CURRENT_FILE, "r", encoding="utf-8") as f:
+            version = f.read().strip()
+    except FileNotFoundError:
+        return None
+    return version or None
+
+
+def index_dir(version: Optional[str]) -> str:
+    """
+    Папка индекса для версии; для None - корень vector_db (прежняя раскладка).
+    """
+    return build_dir(version) if version else VECTOR_DB_DIR
+
+
+def publish(version: str):
+    """
+    Делает сборку активной: файл CURRENT подменяется атомарно.
+    """
+    if not os.path.exists(os.path.join(build_dir(version), MANIFEST_FILE)):
+        raise ValueError(f"Сборка {version} не завершена: нет {MANIFEST_FILE}")
+    tmp_path = f"{CURRENT_FILE}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(version)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, CURRENT_FILE)
+    logger.info(f"Активная версия индекса: {version}")
+
+
+def discard(version: str):
+    """
+    Удаляет незавершенную или неудачную сборку.
+    """
+    shutil.rmtree(build_dir(version), ignore_errors=True)
+
+
+def mark_loaded(version: Optional[str]):
+    """
+    Отмечает версию, которую обслуживает текущий процесс бота (prune_builds ее не удалит).
+    """
+    os.makedirs(LOADED_DIR, exist_ok=True)
+    path = os.path.join(LOADED_DIR, str(os.getpid()))
+    with open(f"{path}.tmp", "w", encoding="utf-8") as f:
+        f.write(version or "")
+    os.replace(f"{path}.tmp", path)
+
+
+def _process_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def loaded_versions() -> Set[str]:
+    """
+    Версии, загруженные работающими процессами бота; отметки завершившихся процессов удаляются.
+    """
+    if not os.path.isdir(LOADED_DIR):
+        return set()
+    versions = set()
+    for name in os.listdir(LOADED_DIR):
+        path = os.path.join(LOADED_DIR, name)
+        if not name.isdigit():
+            continue
+        if not _process_alive(int(name)):
+            os.remove(path)
+            continue
+        with open(path, "r", encoding="utf-8") as f:
+            version = f.read().strip()
+        if version:
+            versions.add(version)
+    return versions
+
+
+def prune_builds(keep: int = KEEP_BUILDS, grace: float = PRUNE_GRACE):
+    """
+    Удаляет старые сборки, оставляя keep последних, активную и загруженные ботами.
+
+    Предыдущие версии не удаляются сразу: бот мог еще не переключиться (или не смог
+    загрузить новую сборку), а запросы в обработке продолжают читать старый индекс.
+    Сборки моложе grace секунд тоже не удаляются.
+    """
+    if not os.path.isdir(BUILDS_DIR):
+        return
+    protected = loaded_versions()
+    active = current_version()
+    if active:
+        protected.add(active)
+    now = time.time()
+    versions = sorted(os.listdir(BUILDS_DIR), reverse=True)
+    for version in versions[keep:]:
+        if version in protected or now - os.path.getmtime(build_dir(version)) < grace:
+            continue
+        logger.info(f"Удаление старой сборки индекса: {version}")
+        discard(version)
+
+
+class IndexWatcher:
+    """Фоновый поток, вызывающий on_change(версия) при смене файла CURRENT."""
+
+    def __init__(self, on_change: Callable[[str], None], interval: float = WATCH_INTERVAL,
+                 loaded_version: Optional[str] = None):
+        self.on_change = on_change
+        self.interval = interval
+        self.loaded_version = loaded_version
+        # Сборка, которую не удалось загрузить, и время следующей попытки (с экспоненциальной паузой)
+        self.failed_version: Optional[str] = None
+        self.failures = 0
+        self.retry_at = 0.0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="index-watcher", daemon=True)
+
+    def start(self):
+        logger.info(f"Отслеживание новых версий индекса каждые {self.interval:.0f} с")
+        mark_loaded(self.loaded_version)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def check(self) -> bool:
+        """
+        Проверяет CURRENT и при смене версии загружает ее; возвращает True при переключении.
+        """
+        version = current_version()
+        if not version or version == self.loaded_version:
+            return False
+        if version == self.failed_version and time.monotonic() < self.retry_at:
+            return False
+        logger.info(f"Обнаружена новая версия индекса: {version}")
+        try:
+            with telemetry.span("index_swap", version=version):
+                self.on_change(version)
+        except Exception as e:
+            # Остаемся на прежней версии и повторяем попытку со все большей паузой
+            self.failures = self.failures + 1 if version == self.failed_version else 1
+            self.failed_version = version
+            delay = min(self.interval * 2 ** self.failures, MAX_RETRY_INTERVAL)
+            self.retry_at = time.monotonic() + delay
+            logger.exception(f"Не удалось переключиться на версию индекса {version}, "
+                             f"повтор через {delay:.0f} с: {e}")
+            return False
+        self.loaded_version = version
+        self.failed_version, self.failures = None, 0
+        mark_loaded(version)
+        telemetry.metrics.inc("index_swaps_total")
+        return True
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.check()
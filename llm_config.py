@@ -0,0 +1,190 @@
+# llm_config.py
+"""
+Профили запуска llama.cpp: потоки, размер батча, контекст, mmap/mlock и вариант квантизации.
+
+Порядок применения настроек (каждый следующий уровень переопределяет предыдущий):
+    1. значения по умолчанию RuntimeProfile;
+    2. файл профилей (LLM_PROFILE_FILE, по умолчанию llm_profile.json) - активный или
+       выбранный через LLM_PROFILE именованный профиль;
+    3. переменные окружения LLM_N_THREADS, LLM_N_THREADS_BATCH, LLM_N_BATCH, LLM_N_CTX,
+       LLM_USE_MMAP, LLM_USE_MLOCK, LLM_N_GPU_LAYERS, LLM_QUANTIZATION, LLM_MODEL_PATH,
+       LLM_DRAFT_MODE, LLM_DRAFT_TOKENS, LLM_DRAFT_MODEL_PATH.
+
+Файл профилей создается командой `python autotune_llm.py`, подбирающей настройки под CPU хоста.
+"""
+import os
+import json
+import logging
+from dataclasses import dataclass, asdict, fields
+from typing import Any, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+PROFILE_FILE = os.getenv("LLM_PROFILE_FILE", "llm_profile.json")
+MODELS_DIR = "models"
+MODEL_REPO_ID = "IlyaGusev/saiga2_7b_gguf"
+# Прежний путь к локальной модели; используется, если файл существует
+LEGACY_MODEL_PATH = os.path.join(MODELS_DIR, "saiga2_7b.gguf")
+
+# Переменные окружения -> поле профиля
+ENV_OVERRIDES = {
+    "LLM_N_THREADS": "n_threads",
+    "LLM_N_THREADS_BATCH": "n_threads_batch",
+    "LLM_N_BATCH": "n_batch",
+    "LLM_N_CTX": "n_ctx",
+    "LLM_USE_MMAP": "use_mmap",
+    "LLM_USE_MLOCK": "use_mlock",
+    "LLM_N_GPU_LAYERS": "n_gpu_layers",
+    "LLM_QUANTIZATION": "quantization",
+    "LLM_MODEL_PATH": "model_path",
+    "LLM_DRAFT_MODE": "draft_mode",
+    "LLM_DRAFT_TOKENS": "draft_num_pred_tokens",
+    "LLM_DRAFT_MODEL_PATH": "draft_model_path",
+}
+
+
+def physical_cpu_count() -> int:
+    """
+    Число физических ядер, доступных процессу (с учетом affinity в контейнерах).
+    """
+    try:
+        available = len(os.sched_getaffinity(0))
+    except AttributeError:
+        available = os.cpu_count() or 1
+    try:
+        import psutil
+        physical = psutil.cpu_count(logical=False) or available
+        return max(1, min(physical, available))
+    except ImportError:
+        # Без psutil считаем, что включен SMT (2 логических ядра на физическое)
+        return max(1, available // 2) if available > 1 else 1
+
+
+@dataclass
+class RuntimeProfile:
+    """Параметры загрузки модели llama.cpp."""
+    n_threads: int = 8
+    n_threads_batch: Optional[int] = None
+    n_batch: int = 512
+    n_ctx: int = 4096
+    use_mmap: bool = True
+    use_mlock: bool = False
+    n_gpu_layers: int = 0
+    # Вариант квантизации из репозитория модели: q4_K, q5_K, q8_0 и т.д.
+    quantization: str = "q4_K"
+    # Явный путь к GGUF-файлу; если не задан, ищется локальный файл или скачивается с HuggingFace
+    model_path: Optional[str] = None
+    repo_id: str = MODEL_REPO_ID
+    # Спекулятивное декодирование: none, prompt_lookup или model (см. speculative.py)
+    draft_mode: str = "none"
+    draft_num_pred_tokens: int = 10
+    # GGUF маленькой модели с тем же словарем токенов (для draft_mode='model')
+    draft_model_path: Optional[str] = None
+
+    @property
+    def model_filename(self) -> str:
+        return f"model-{self.quantization}.gguf"
+
+    def resolve_model_path(self) -> Optional[str]:
+        """
+        Возвращает путь к локальному файлу модели или None, если ее нужно скачать.
+        """
+        candidates = [
+            self.model_path,
+            os.path.join(MODELS_DIR, self.model_filename),
+        ]
+        # Старый путь относится к модели q4_K, поэтому подходит только для нее
+        if self.quantization == "q4_K":
+            candidates.append(LEGACY_MODEL_PATH)
+        for path in candidates:
+            if path and os.path.exists(path):
+                return path
+        return None
+
+    def llama_kwargs(self) -> Dict[str, Any]:
+        """
+        Аргументы для конструктора Llama / Llama.from_pretrained.
+        """
+        return {
+            "n_ctx": self.n_ctx,
+            "n_threads": self.n_threads,
+            "n_threads_batch": self.n_threads_batch or self.n_threads,
+            "n_batch": self.n_batch,
+            "use_mmap": self.use_mmap,
+            "use_mlock": self.use_mlock,
+            "n_gpu_layers": self.n_gpu_layers,
+        }
+
+    def to_dict(self) -> Dict[str, Any]:
+        return asdict(self)
+
+
+def _coerce(field_name: str, value: Any) -> Any:
+    """
+    Приводит значение из env/JSON к типу поля профиля.
+    """
+    default = getattr(RuntimeProfile, field_name, None)
+    if isinstance(value, str):
+        if isinstance(default, bool):
+            return value.strip().lower() in ("1", "true", "yes", "on")
+        if isinstance(default, int) or field_name == "n_threads_batch":
+            return int(value) if value.strip() else None
+    return value
+
+
+def _apply(profile: RuntimeProfile, values: Dict[str, Any]) -> RuntimeProfile:
+    known = {f.name for f in fields(RuntimeProfile)}
+    for key, value in values.items():
+        if key in known:
+            setattr(profile, key, _coerce(key, value))
+        else:
+            logger.warning(f"Неизвестный параметр профиля LLM: {key}")
+    return profile
+
+
+def read_profile_file(path: str = PROFILE_FILE) -> Dict[str, Any]:
+    if not os.path.exists(path):
+        return {}
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def load_profile(name: Optional[str] = None, path: str = PROFILE_FILE) -> RuntimeProfile:
+    """
+    Собирает профиль из значений по умолчанию, файла профилей и переменных окружения.
+
+    Файл может содержать либо плоский набор параметров, либо
+    {"active": "<имя>", "profiles": {"<имя>": {...}, ...}}.
+    """
+    profile = RuntimeProfile()
+    data = read_profile_file(path)
+    if data:
+        if "profiles" in data:
+            name = name or os.getenv("LLM_PROFILE") or data.get("active")
+            if name and name in data["profiles"]:
+                _apply(profile, data["profiles"][name])
+            elif name:
+                logger.warning(f"Профиль LLM '{name}' не найден в {path}, используются значения по умолчанию")
+        else:
+            _apply(profile, data)
+
+    env_values = {field: os.environ[env] for env, field in ENV_OVERRIDES.items() if env in os.environ}
+    _apply(profile, env_values)
+    return profile
+
+
+def save_profile(profile: RuntimeProfile, name: str, path: str = PROFILE_FILE, activate: bool = True):
+    """
+    Сохраняет именованный профиль в файл, не затрагивая остальные профили.
+    """
+    data = read_profile_file(path)
+    if data and "profiles" not in data:
+        # Плоский файл превращаем в именованный профиль 'manual'
+        data = {"active": "manual", "profiles": {"manual": data}}
+    data.setdefault("profiles", {})[name] = profile.to_dict()
+    if activate or "active" not in data:
+        data["active"] = name
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_path, path)
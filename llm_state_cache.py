@@ -0,0 +1,271 @@
+# llm_state_cache.py
+"""
+Снимки состояния llama.cpp (KV-кэша) на диске для быстрого старта после перезапуска.
+
+После рестарта модель быстро отображается в память (mmap из page cache), но системный промпт
+и частые префиксы RAG-промптов (инструкция + один и тот же найденный фрагмент) приходится
+считать заново. Этот модуль:
+    - при старте загружает сохраненные снимки и сразу восстанавливает снимок системного промпта
+      через Llama.load_state (или считает и сохраняет его, если снимка еще нет);
+    - перед генерацией подставляет снимок с самым длинным общим префиксом, если он длиннее
+      того, что уже лежит в KV-кэше модели;
+    - считает обращения к префиксам и сохраняет снимки самых частых из них.
+
+Снимок содержит KV-кэш только для токенов префикса (без ответа модели). Снимки 7B-модели
+занимают сотни мегабайт, поэтому в памяти держатся только токены префиксов, а сами состояния
+читаются с диска при подстановке; общий объем снимков ограничен LLM_STATE_MAX_BYTES.
+
+Снимки лежат в LLM_STATE_DIR/<хеш файла модели>-t<версия шаблона>-c<n_ctx>/: при смене модели,
+шаблона промпта или размера контекста старые снимки просто не используются.
+"""
+import os
+import json
+import pickle
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from datetime import datetime, timezone
+from typing import Any, Dict, List
+
+from llama_cpp import Llama
+
+import telemetry
+
+logger = logging.getLogger(__name__)
+
+STATE_DIR = os.getenv("LLM_STATE_DIR", "llm_state")
+FINGERPRINTS_FILE = "fingerprints.json"
+INDEX_FILE = "index.json"
+# Сколько снимков хранить и сколько места на диске они могут занимать
+MAX_SNAPSHOTS = int(os.getenv("LLM_STATE_MAX_SNAPSHOTS", "4"))
+MAX_BYTES = int(os.getenv("LLM_STATE_MAX_BYTES", str(4 * 2 ** 30)))
+# После скольких обращений префикс сохраняется на диск
+SNAPSHOT_MIN_HITS = int(os.getenv("LLM_STATE_MIN_HITS", "3"))
+# Снимок подставляется, только если он экономит хотя бы столько токенов prompt-eval
+MIN_GAIN_TOKENS = 32
+# Сколько кандидатов в частые префиксы отслеживать
+MAX_TRACKED_PREFIXES = 128
+
+
+def model_file_hash(path: str) -> str:
+    """
+    SHA-256 файла модели. Хеш многогигабайтного файла кэшируется по (путь, размер, mtime).
+    """
+    stat = os.stat(path)
+    cache_key = f"{os.path.abspath(path)}:{stat.st_size}:{stat.st_mtime_ns}"
+    fingerprints_path = os.path.join(STATE_DIR, FINGERPRINTS_FILE)
+    fingerprints: Dict[str, str] = {}
+    if os.path.exists(fingerprints_path):
+        with open(fingerprints_path, "r", encoding="utf-8") as f:
+            fingerprints = json.load(f)
+    if cache_key in fingerprints:
+        return fingerprints[cache_key]
+
+    logger.info(f"Вычисление хеша файла модели {path}...")
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(16 * 2 ** 20), b""):
+            digest.update(block)
+    fingerprints[cache_key] = digest.hexdigest()
+    os.makedirs(STATE_DIR, exist_ok=True)
+    _write_json_atomic(fingerprints_path, fingerprints)
+    return fingerprints[cache_key]
+
+
+def _write_json_atomic(path: str, data: Any):
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_path, path)
+
+
+def _prefix_key(tokens: List[int]) -> str:
+    return hashlib.sha256(" ".join(map(str, tokens)).encode("ascii")).hexdigest()[:24]
+
+
+def _truncate_kv(model: Llama, n_tokens: int):
+    """
+    Оставляет в KV-кэше модели только первые n_tokens токенов (как Llama.generate при повторе префикса).
+    """
+    model._ctx.kv_cache_seq_rm(-1, n_tokens, -1)
+    model.n_tokens = n_tokens
+
+
+class LlmStateCache:
+    """Снимки KV-состояния для префиксов промптов с хранением на диске."""
+
+    def __init__(self, directory: str, max_snapshots: int = MAX_SNAPSHOTS, max_bytes: int = MAX_BYTES,
+                 min_hits: int = SNAPSHOT_MIN_HITS):
+        self.directory = directory
+        self.max_snapshots = max_snapshots
+        self.max_bytes = max_bytes
+        self.min_hits = min_hits
+        # key -> {"file", "tokens", "n_tokens", "bytes", "hits", "saved_at", "pinned"}
+        self.index: Dict[str, Dict[str, Any]] = {}
+        # Снимки, которые еще записываются на диск: key -> LlamaState
+        self._pending: Dict[str, Any] = {}
+        # Кандидаты в частые префиксы: key -> [tokens, hits]
+        self.candidates: "OrderedDict[str, List[Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    @classmethod
+    def for_model(cls, model: Llama, template_version: str, **kwargs) -> "LlmStateCache":
+        model_hash = model_file_hash(model.model_path)
+        directory = os.path.join(STATE_DIR, f"{model_hash[:16]}-t{template_version}-c{model.n_ctx()}")
+        return cls(directory, **kwargs)
+
+    def load(self):
+        """
+        Загружает индекс снимков; сами состояния читаются с диска при подстановке.
+        """
+        index_path = os.path.join(self.directory, INDEX_FILE)
+        if not os.path.exists(index_path):
+            return
+        with open(index_path, "r", encoding="utf-8") as f:
+            index = json.load(f)
+        for key, entry in index.items():
+            if "tokens" in entry and os.path.exists(os.path.join(self.directory, entry["file"])):
+                self.index[key] = entry
+            else:
+                logger.warning(f"Снимок состояния LLM {key} пропущен: нет файла или токенов префикса")
+        logger.info(f"Найдено снимков состояния LLM: {len(self.index)} в {self.directory}")
+
+    def warm(self, model: Llama, prefix: str):
+        """
+        Восстанавливает снимок префикса (обычно системного промпта) в модель;
+        если снимка нет, считает префикс и сохраняет его как закрепленный.
+        """
+        tokens = model.tokenize(prefix.encode("utf-8"))
+        key = _prefix_key(tokens)
+        with telemetry.span("llm_state_warm", tokens=len(tokens)) as warm_span:
+            state = self._read_state(key) if key in self.index else None
+            if state is not None:
+                model.load_state(state)
+                warm_span["restored"] = True
+                logger.info(f"Состояние LLM восстановлено из снимка ({len(tokens)} токенов префикса)")
+                return
+            model.reset()
+            model.eval(tokens)
+            warm_span["restored"] = False
+        self._store(key, model.save_state(), tokens, pinned=True)
+
+    def prepare(self, model: Llama, tokens: List[int]):
+        """
+        Перед генерацией подставляет снимок с самым длинным общим префиксом, если это выгодно.
+        """
+        current = Llama.longest_token_prefix(model._input_ids.tolist(), tokens)
+        best_key, best_len = None, current
+        with self._lock:
+            candidates = [(key, entry["tokens"]) for key, entry in self.index.items()]
+        for key, prefix_tokens in candidates:
+            length = Llama.longest_token_prefix(prefix_tokens, tokens)
+            if length > best_len:
+                best_key, best_len = key, length
+        hit = best_key is not None and best_len - current >= MIN_GAIN_TOKENS
+        state = None
+        if hit:
+            with telemetry.span("llm_state_restore", tokens=best_len):
+                state = self._read_state(best_key)
+                if state is not None:
+                    model.load_state(state)
+        telemetry.record_cache("llm_state", state is not None)
+        if state is not None:
+            with self._lock:
+                if best_key in self.index:
+                    self.index[best_key]["hits"] += 1
+
+    def observe(self, model: Llama, prefix_tokens: List[int]):
+        """
+        Учитывает префикс завершенного запроса; частый префикс сохраняется снимком.
+        Вызывается сразу после генерации, пока KV-кэш модели начинается с этого префикса:
+        перед снимком KV-кэш обрезается до префикса, чтобы в снимок не попал ответ.
+        """
+        if len(prefix_tokens) < MIN_GAIN_TOKENS:
+            return
+        key = _prefix_key(prefix_tokens)
+        if key in self.index:
+            return
+        with self._lock:
+            candidate = self.candidates.pop(key, [prefix_tokens, 0])
+            candidate[1] += 1
+            self.candidates[key] = candidate
+            while len(self.candidates) > MAX_TRACKED_PREFIXES:
+                self.candidates.popitem(last=False)
+        if candidate[1] >= self.min_hits and \
+                Llama.longest_token_prefix(model._input_ids.tolist(), prefix_tokens) == len(prefix_tokens):
+            self.candidates.pop(key, None)
+            _truncate_kv(model, len(prefix_tokens))
+            self._store(key, model.save_state(), prefix_tokens, hits=candidate[1])
+
+    def _read_state(self, key: str) -> Any:
+        with self._lock:
+            entry = self.index.get(key)
+            state = self._pending.get(key)
+        if state is not None or entry is None:
+            return state
+        try:
+            with open(os.path.join(self.directory, entry["file"]), "rb") as f:
+                return pickle.load(f)
+        except Exception as e:
+            logger.warning(f"Снимок состояния LLM {key} не прочитан: {e}")
+            with self._lock:
+                self.index.pop(key, None)
+            return None
+
+    def _store(self, key: str, state: Any, tokens: List[int], hits: int = 0, pinned: bool = False):
+        """
+        Регистрирует снимок и записывает его на диск в фоне; до конца записи он держится в памяти.
+        """
+        size = int(state.llama_state_size)
+        if not pinned and size > self.max_bytes:
+            logger.info(f"Снимок состояния LLM ({size} байт) больше LLM_STATE_MAX_BYTES, не сохраняется")
+            return
+        with self._lock:
+            self._pending[key] = state
+            self.index[key] = {
+                "file": f"{key}.state",
+                "tokens": list(tokens),
+                "n_tokens": len(tokens),
+                "bytes": size,
+                "hits": hits,
+                "pinned": pinned,
+                "saved_at": datetime.now(timezone.utc).isoformat(),
+            }
+            self._evict()
+        logger.info(f"Сохраняется снимок состояния LLM: {len(tokens)} токенов префикса, {size / 2 ** 20:.0f} МБ")
+        threading.Thread(target=self._write, args=(key, state), daemon=True).start()
+
+    def _evict(self):
+        # Закрепленные снимки (системный промпт) не вытесняются; остальные - по числу обращений
+        while len(self.index) > self.max_snapshots or \
+                sum(e.get("bytes", 0) for e in self.index.values()) > self.max_bytes:
+            evictable = [k for k, e in self.index.items() if not e.get("pinned")]
+            if not evictable:
+                break
+            victim = min(evictable, key=lambda k: self.index[k]["hits"])
+            self.index.pop(victim)
+            self._pending.pop(victim, None)
+            try:
+                os.remove(os.path.join(self.directory, f"{victim}.state"))
+            except FileNotFoundError:
+                pass
+
+    def _write(self, key: str, state: Any):
+        try:
+            path = os.path.join(self.directory, f"{key}.state")
+            with open(f"{path}.tmp", "wb") as f:
+                pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(f"{path}.tmp", path)
+            with self._lock:
+                self._pending.pop(key, None)
+                if key not in self.index:
+                    # Снимок успели вытеснить, пока он записывался
+                    os.remove(path)
+                # В индекс попадают только снимки, файлы которых уже записаны
+                written = {k: e for k, e in self.index.items()
+                           if os.path.exists(os.path.join(self.directory, e["file"]))}
+                _write_json_atomic(os.path.join(self.directory, INDEX_FILE), written)
+        except Exception as e:
+            logger.error(f"Не удалось записать снимок состояния LLM {key}: {e}")
@@ -1,61 +1,180 @@
 # local_llm.py
 import os
+import logging
+import threading
+import llama_cpp
 from llama_cpp import Llama
 from langchain_core.runnables import Runnable
-from typing import Any, List, Optional, Union, Dict
+from typing import List, Optional, Union, Dict
+
+import telemetry
+import profiling
+from llm_config import RuntimeProfile, load_profile
+from speculative import CountingDraftModel, build_draft_model
+from llm_state_cache import LlmStateCache
+
+logger = logging.getLogger(__name__)
 
 # Глобальная переменная для хранения модели
 _LOCAL_MODEL = None
-# Путь к локальной модели
-MODEL_PATH = os.path.join("models", "saiga2_7b.gguf")
-# Или используем repo_id и filename для автоматической загрузки
-MODEL_REPO_ID = "IlyaGusev/saiga2_7b_gguf"
-MODEL_FILENAME = "model-q4_K.gguf"  # Вы можете изменить на model-q5_K.gguf и т.д.
+# Профиль, с которым загружена модель
+_LOCAL_PROFILE: Optional[RuntimeProfile] = None
+# Модель llama.cpp не потокобезопасна: загрузка и генерация выполняются под этой блокировкой
+_MODEL_LOCK = threading.RLock()
+# Снимки KV-состояния на диске (см. llm_state_cache.py); выключаются LLM_STATE_CACHE=0
+_STATE_CACHE: Optional[LlmStateCache] = None
+
+# Ответ при ошибке генерации (кэши ответов его не сохраняют)
+GENERATION_ERROR_ANSWER = "Извините, не удалось получить ответ от локальной модели."
+
+# Версия шаблона промпта: при изменении SYSTEM_PROMPT или format_prompt ее нужно увеличить,
+# чтобы не использовать снимки KV-состояния, посчитанные для старого шаблона
+PROMPT_TEMPLATE_VERSION = "1"
+SYSTEM_PROMPT = (
+    "Ты помощник абитуриента ИТМО. Отвечай точно, кратко и только на основе предоставленной информации. "
+    "Отвечай на русском языке. Не добавляй фразы вроде 'Question:' или 'Helpful Answer:'."
+)
+# Граница общего префикса RAG-промпта: все до вопроса (инструкция и найденный контекст)
+# часто повторяется между запросами
+PREFIX_BOUNDARY = "\nQuestion:"
+
+
+def prompt_prefix() -> str:
+    """
+    Неизменная часть промпта перед текстом пользователя.
+    """
+    return f"<|system|>{SYSTEM_PROMPT}</|system|>\n<|user|>"
+
+
+def format_prompt(prompt: str) -> str:
+    """
+    Промпт в формате, ожидаемом моделью Saiga2.
+    """
+    return f"{prompt_prefix()}{prompt}</|user|>\n<|assistant|>"
+
+
+def create_llama(profile: RuntimeProfile, **extra_kwargs) -> Llama:
+    """
+    Создает экземпляр Llama по профилю: из локального файла или с HuggingFace.
+    """
+    kwargs = {**profile.llama_kwargs(), "verbose": False, **extra_kwargs}
+    if "draft_model" not in kwargs:
+        draft_model = build_draft_model(
+            profile.draft_mode,
+            profile.draft_num_pred_tokens,
+            profile.draft_model_path,
+            n_threads=profile.n_threads,
+            n_ctx=profile.n_ctx,
+        )
+        if draft_model is not None:
+            kwargs["draft_model"] = draft_model
+    model_path = profile.resolve_model_path()
+    if model_path:
+        logger.info(f"Загрузка модели из локального файла: {model_path}")
+        return Llama(model_path=model_path, **kwargs)
+    logger.info(f"Локальный файл модели не найден. Загрузка {profile.repo_id}/{profile.model_filename} с HuggingFace...")
+    # После загрузки модель будет кэширована huggingface_hub
+    return Llama.from_pretrained(repo_id=profile.repo_id, filename=profile.model_filename, **kwargs)
 
 
 def get_local_model():
     """Ленивая загрузка локальной модели через llama-cpp-python."""
-    global _LOCAL_MODEL
-    if _LOCAL_MODEL is None:
-        print("Загрузка локальной модели IlyaGusev/saiga2_7b_gguf через llama-cpp-python...")
-        try:
-            # Проверяем, существует ли локальный файл
-            if os.path.exists(MODEL_PATH):
-                print(f"Загрузка модели из локального файла: {MODEL_PATH}")
-                _LOCAL_MODEL = Llama(
-                    model_path=MODEL_PATH,
-                    n_ctx=4096,  # Контекстное окно
-                    n_threads=8,  # Количество потоков CPU
-                    n_batch=512,  # Размер батча
-                    verbose=False  # Отключить подробный лог llama.cpp, если нужно
-                    # n_gpu_layers=35 # Раскомментируйте, если у вас подходящая GPU и установлен llama-cpp-python с поддержкой GPU
-                )
-            else:
-                print(f"Локальный файл {MODEL_PATH} не найден. Попытка загрузки с HuggingFace...")
-                # llama-cpp-python может загрузить модель напрямую из HuggingFace
-                _LOCAL_MODEL = Llama.from_pretrained(
-                    repo_id=MODEL_REPO_ID,
-                    filename=MODEL_FILENAME,
-                    n_ctx=4096,
-                    n_threads=8,
-                    n_batch=512,
-                    verbose=False
-                    # n_gpu_layers=35 # Раскомментируйте для GPU
-                )
-                # После загрузки модель будет кэширована huggingface_hub
-            print("Локальная модель загружена успешно.")
-        except Exception as e:
-            print(f"Ошибка при загрузке локальной модели: {e}")
-            import traceback
-            traceback.print_exc()
-            raise e
+    global _LOCAL_MODEL, _LOCAL_PROFILE
+    # Модель загружается один раз, даже если первые запросы пришли одновременно из разных потоков
+    with _MODEL_LOCK:
+        if _LOCAL_MODEL is None:
+            profile = load_profile()
+            logger.info(
+                f"Загрузка локальной модели {profile.repo_id} ({profile.quantization}) через llama-cpp-python: "
+                f"n_threads={profile.n_threads}, n_threads_batch={profile.n_threads_batch or profile.n_threads}, "
+                f"n_batch={profile.n_batch}, n_ctx={profile.n_ctx}, use_mmap={profile.use_mmap}, use_mlock={profile.use_mlock}, "
+                f"draft_mode={profile.draft_mode}"
+            )
+            try:
+                _LOCAL_MODEL = create_llama(profile)
+                _LOCAL_PROFILE = profile
+                logger.info("Локальная модель загружена успешно.")
+            except Exception as e:
+                logger.exception(f"Ошибка при загрузке локальной модели: {e}")
+                raise e
+            _init_state_cache(_LOCAL_MODEL)
     return _LOCAL_MODEL
 
 
+def _init_state_cache(model: Llama):
+    """
+    Загружает снимки KV-состояния и прогревает модель системным промптом.
+    """
+    global _STATE_CACHE
+    if os.getenv("LLM_STATE_CACHE", "1") != "1":
+        return
+    try:
+        _STATE_CACHE = LlmStateCache.for_model(model, PROMPT_TEMPLATE_VERSION)
+        _STATE_CACHE.load()
+        _STATE_CACHE.warm(model, prompt_prefix())
+    except Exception as e:
+        # Без снимков модель работает как обычно, только первый запрос медленнее
+        logger.warning(f"Снимки состояния LLM недоступны: {e}")
+        _STATE_CACHE = None
+
+
+def _llama_ctx(model: Llama):
+    """Возвращает указатель на контекст llama.cpp (атрибут отличается между версиями llama-cpp-python)."""
+    internal = getattr(model, "_ctx", None)
+    if internal is not None and hasattr(internal, "ctx"):
+        return internal.ctx
+    return getattr(model, "ctx", None)
+
+
+def reset_llama_timings(model: Llama):
+    """Сбрасывает внутренние тайминги llama.cpp перед новым запросом."""
+    ctx = _llama_ctx(model)
+    if ctx is None:
+        return
+    try:
+        if hasattr(llama_cpp, "llama_perf_context_reset"):
+            llama_cpp.llama_perf_context_reset(ctx)
+        elif hasattr(llama_cpp, "llama_reset_timings"):
+            llama_cpp.llama_reset_timings(ctx)
+    except Exception as e:
+        logger.debug(f"Не удалось сбросить тайминги llama.cpp: {e}")
+
+
+def read_llama_timings(model: Llama) -> Optional[Dict[str, float]]:
+    """
+    Читает внутренние тайминги llama.cpp: время prompt-eval и decode и число токенов в каждой фазе.
+    Возвращает None, если установленная версия llama-cpp-python их не предоставляет.
+    """
+    ctx = _llama_ctx(model)
+    if ctx is None:
+        return None
+    try:
+        if hasattr(llama_cpp, "llama_perf_context"):
+            data = llama_cpp.llama_perf_context(ctx)
+        elif hasattr(llama_cpp, "llama_get_timings"):
+            data = llama_cpp.llama_get_timings(ctx)
+        else:
+            return None
+    except Exception as e:
+        logger.debug(f"Не удалось прочитать тайминги llama.cpp: {e}")
+        return None
+    return {
+        "prompt_eval_ms": float(data.t_p_eval_ms),
+        "prompt_eval_tokens": int(data.n_p_eval),
+        "eval_ms": float(data.t_eval_ms),
+        "eval_tokens": int(data.n_eval),
+    }
+
+
 class LocalLLMWrapper(Runnable):
     """Обертка для локальной LLM через llama-cpp-python."""
 
     def __init__(self, **kwargs):
+        # Спекулятивное декодирование: None - как в профиле модели, False - выключить для этой обертки,
+        # True - требовать черновую модель (ее режим задается профилем, см. llm_config.draft_mode)
+        self.speculative: Optional[bool] = kwargs.get("speculative")
+        # Режим генерации по умолчанию (см. generation_modes.py): жесткий max_tokens, жадная выборка, грамматика
+        self.generation_mode = kwargs.get("generation_mode")
         # Сохраняем параметры по умолчанию для генерации
         # Эти параметры будут использоваться как базовые, но могут быть переопределены при вызове
         self.default_generation_config = {
@@ -74,16 +193,33 @@ class LocalLLMWrapper(Runnable):
         }
 
     def _call(self, prompt: str, stop: Optional[List[str]] = None, **kwargs) -> str:
+        # Одновременные запросы выполняются по очереди; время ожидания видно в спане llm_wait
+        # Поток вызова относится к профилируемому запросу, даже если его запустил LangChain
+        with profiling.attach():
+            with telemetry.span("llm_wait"):
+                _MODEL_LOCK.acquire()
+            try:
+                return self._generate(prompt, stop, **kwargs)
+            finally:
+                _MODEL_LOCK.release()
+
+    def _generate(self, prompt: str, stop: Optional[List[str]] = None, **kwargs) -> str:
         try:
             model = get_local_model()
 
             # Формируем промпт в формате, ожидаемом моделью Saiga2
-            full_prompt = (
-                f"<|system|>Ты помощник абитуриента ИТМО. Отвечай точно, кратко и только на основе предоставленной информации. "
-                f"Отвечай на русском языке. Не добавляй фразы вроде 'Question:' или 'Helpful Answer:'.</|system|>\n"
-                f"<|user|>{prompt}</|user|>\n"
-                f"<|assistant|>"
-            )
+            full_prompt = format_prompt(prompt)
+
+            # Подставляем снимок KV-состояния с самым длинным общим префиксом
+            prefix_tokens = None
+            if _STATE_CACHE is not None:
+                prompt_tokens = model.tokenize(full_prompt.encode("utf-8"))
+                _STATE_CACHE.prepare(model, prompt_tokens)
+                boundary = full_prompt.rfind(PREFIX_BOUNDARY)
+                if boundary > 0:
+                    prefix_len = Llama.longest_token_prefix(
+                        model.tokenize(full_prompt[:boundary].encode("utf-8")), prompt_tokens)
+                    prefix_tokens = prompt_tokens[:prefix_len]
 
             # Начинаем с базовой конфигурации
             generation_kwargs = self.default_generation_config.copy()
@@ -95,27 +231,64 @@ class LocalLLMWrapper(Runnable):
             if stop is not None:
                 generation_kwargs['stop'] = stop
 
+            # Режим спекулятивного декодирования можно переопределить на отдельный вызов
+            speculative = generation_kwargs.pop("speculative", self.speculative)
+
+            # Режим генерации задает max_tokens, параметры выборки и грамматику ответа
+            generation_mode = generation_kwargs.pop("generation_mode", self.generation_mode)
+            if generation_mode is not None:
+                generation_kwargs.update(generation_mode.completion_overrides())
+
             # Фильтруем параметры, убирая те, которые не поддерживаются create_completion
             filtered_kwargs = {
                 k: v for k, v in generation_kwargs.items()
                 if k not in self.invalid_completion_params
             }
 
-            # --- Отладка (раскомментируйте при необходимости) ---
-            # print(f"[DEBUG] Full Prompt: {repr(full_prompt)}")
-            # print(f"[DEBUG] Filtered Generation Kwargs: {filtered_kwargs}")
-            # ---
+            # Черновая модель задается при загрузке (ей нужен logits_all), поэтому на вызов
+            # ее можно только временно отключить
+            draft_model = getattr(model, "draft_model", None)
+            if speculative and draft_model is None:
+                logger.warning("Спекулятивное декодирование запрошено, но черновая модель не загружена "
+                               "(задайте draft_mode в профиле LLM)")
+            use_draft = draft_model is not None and speculative is not False
+            if isinstance(draft_model, CountingDraftModel):
+                draft_model.reset_counters()
 
             # Генерируем ответ
             # llama-cpp-python возвращает словарь с результатами
-            response = model.create_completion(
-                prompt=full_prompt,
-                **filtered_kwargs
-            )
+            reset_llama_timings(model)
+            if not use_draft:
+                model.draft_model = None
+            try:
+                with telemetry.span("llm", max_tokens=filtered_kwargs.get("max_tokens"), speculative=use_draft,
+                                    mode=generation_mode.name if generation_mode else "free") as llm_span:
+                    response = model.create_completion(
+                        prompt=full_prompt,
+                        **filtered_kwargs
+                    )
+                    usage = response.get('usage', {})
+                    llm_span["prompt_tokens"] = usage.get('prompt_tokens', 0)
+                    llm_span["completion_tokens"] = usage.get('completion_tokens', 0)
+            finally:
+                model.draft_model = draft_model
+
+            if use_draft and isinstance(draft_model, CountingDraftModel):
+                draft_model.record(usage.get('completion_tokens', 0))
 
-            # --- Отладка (раскомментируйте при необходимости) ---
-            # print(f"[DEBUG] Raw Response: {response}")
-            # ---
+            # Частые префиксы (инструкция + тот же найденный контекст) сохраняются снимками
+            if prefix_tokens:
+                _STATE_CACHE.observe(model, prefix_tokens)
+
+            # Тайминги llama.cpp разделяют время на prompt-eval и decode
+            timings = read_llama_timings(model)
+            profiling.record_llm_timings(timings)
+            telemetry.record_llm_timings(
+                prompt_tokens=timings["prompt_eval_tokens"] if timings else usage.get('prompt_tokens', 0),
+                completion_tokens=usage.get('completion_tokens', 0),
+                prompt_eval_ms=timings["prompt_eval_ms"] if timings else None,
+                eval_ms=timings["eval_ms"] if timings else None,
+            )
 
             # Извлекаем текст ответа
             answer = response['choices'][0]['text'].strip()
@@ -132,13 +305,20 @@ class LocalLLMWrapper(Runnable):
                 if min_idx < len(answer):
                     answer = answer[:min_idx]
 
+            # Структурированный ответ (JSON по схеме режима) превращаем в текст для пользователя
+            if generation_mode is not None:
+                rendered = generation_mode.render(answer)
+                if rendered is None:
+                    # JSON оборван по max_tokens: отвечаем свободной генерацией, а не фрагментом JSON
+                    logger.info(f"Повторная генерация без режима {generation_mode.name}")
+                    return self._generate(prompt, stop, **{**kwargs, "generation_mode": None})
+                answer = rendered
+
             return answer
 
         except Exception as e:
-            print(f"Ошибка при генерации текста локальной моделью: {e}")
-            import traceback
-            traceback.print_exc()
-            return "Извините, не удалось получить ответ от локальной модели."
+            logger.exception(f"Ошибка при генерации текста локальной моделью: {e}")
+            return GENERATION_ERROR_ANSWER
 
     # Реализация обязательных методов Runnable
     def invoke(self, input: Union[str, Dict], config=None, **kwargs) -> str:
@@ -153,9 +333,8 @@ class LocalLLMWrapper(Runnable):
         return self._call(prompt, **kwargs)
 
     async def ainvoke(self, input: Union[str, Dict], config=None, **kwargs) -> str:
-        # Для простоты асинхронная версия вызывает синхронный метод
-        # В реальном асинхронном коде тут должна быть awaitable операция
-        return self.invoke(input, config=config, **kwargs)
+        # Генерация выполняется в отдельном потоке, чтобы не блокировать цикл событий бота
+        return await profiling.to_thread(self.invoke, input, config, **kwargs)
 
     def batch(self, inputs: List[Union[str, Dict]], config=None, *, return_exceptions: bool = False, **kwargs) -> List[
         str]:
@@ -174,24 +353,25 @@ class LocalLLMWrapper(Runnable):
 
     async def abatch(self, inputs: List[Union[str, Dict]], config=None, *, return_exceptions: bool = False, **kwargs) -> \
     List[str]:
-        # Асинхронная версия batch
-        # Для простоты реализуем как синхронный batch
-        # В реальном асинхронном коде тут должна быть awaitable логика
-        return self.batch(inputs, config=config, return_exceptions=return_exceptions, **kwargs)
+        # Асинхронная версия batch: последовательная генерация в отдельном потоке
+        return await profiling.to_thread(self.batch, inputs, config, return_exceptions=return_exceptions, **kwargs)
 
 
-def load_local_llm():
+def load_local_llm(**overrides):
     """
     Загружает более качественную локальную LLM IlyaGusev/saiga2_7b_gguf через llama-cpp-python.
-    Модель будет загружена из локального файла 'models/saiga2_7b.gguf' или скачана с HuggingFace.
+    Модель будет загружена из локального файла (см. RuntimeProfile.resolve_model_path) или скачана с HuggingFace.
+    Параметры обертки (например, generation_mode или speculative) можно переопределить через overrides.
     """
-    llm = LocalLLMWrapper(
+    params = dict(
         max_tokens=512,
         temperature=0.7,
         top_p=0.95,
         top_k=40,
         repeat_penalty=1.1,
         stop=["</s>", "<|user|>", "<|assistant|>"]
-        # n_gpu_layers=35 # Раскомментируйте, если у вас подходящая GPU и установлен llama-cpp-python с поддержкой GPU
+        # Параметры загрузки модели (потоки, батч, контекст, GPU) задаются профилем, см. llm_config.py
     )
+    params.update(overrides)
+    llm = LocalLLMWrapper(**params)
     return llm
\ No newline at end of file
@@ -0,0 +1,233 @@
+# onnx_embedder.py
+"""
+Бэкенд эмбеддингов на onnxruntime с динамической int8-квантизацией.
+
+Модель sentence-transformers (трансформер + mean pooling + Dense-слой) экспортируется в ONNX
+целиком, веса квантуются в int8, а токенизация выполняется библиотекой tokenizers. Во время
+работы бота PyTorch не импортируется: это сокращает время старта, память процесса и задержку
+кодирования запроса на CPU.
+
+Подготовка модели (один раз, нужны torch, sentence-transformers, onnx и onnxruntime):
+    python onnx_embedder.py export
+Проверка совпадения с исходной моделью:
+    python onnx_embedder.py check
+
+Бэкенд включается переменной EMBEDDING_BACKEND=onnx (в боте и в create_vector_db.py).
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import logging
+from typing import List, Optional, Union
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+import telemetry
+
+logger = logging.getLogger(__name__)
+
+MODEL_NAME = "distiluse-base-multilingual-cased-v1"
+ONNX_MODEL_DIR = os.getenv("ONNX_MODEL_DIR", os.path.join("models", "onnx", MODEL_NAME))
+FP32_FILE = "model.onnx"
+INT8_FILE = "model_int8.onnx"
+CONFIG_FILE = "embedder.json"
+# Размер пула потоков внутри оператора (0 - решает onnxruntime)
+ONNX_THREADS = int(os.getenv("ONNX_THREADS", "0"))
+# Минимальная косинусная близость к исходным эмбеддингам, при которой экспорт считается корректным
+PARITY_MIN_COSINE = 0.98
+
+
+class OnnxEmbeddings(Embeddings):
+    """Эмбеддинги через onnxruntime; совместимы с интерфейсом LangChain и SentenceTransformer.encode."""
+
+    def __init__(
+            self,
+            model_dir: str = ONNX_MODEL_DIR,
+            quantized: bool = True,
+            intra_op_threads: int = ONNX_THREADS,
+            inter_op_threads: int = 1,
+            batch_size: int = 32
+    ):
+        import onnxruntime as ort
+        from tokenizers import Tokenizer
+
+        with open(os.path.join(model_dir, CONFIG_FILE), "r", encoding="utf-8") as f:
+            self.config = json.load(f)
+        self.batch_size = batch_size
+
+        self.tokenizer = Tokenizer.from_file(os.path.join(model_dir, "tokenizer.json"))
+        self.tokenizer.enable_truncation(max_length=self.config["max_seq_length"])
+        self.tokenizer.enable_padding(pad_id=self.config["pad_token_id"], pad_token=self.config["pad_token"])
+
+        options = ort.SessionOptions()
+        options.intra_op_num_threads = intra_op_threads
+        options.inter_op_num_threads = inter_op_threads
+        options.execution_mode = ort.ExecutionMode.ORT_SEQUENTIAL
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        model_path = os.path.join(model_dir, INT8_FILE if quantized else FP32_FILE)
+        self.session = ort.InferenceSession(model_path, sess_options=options, providers=["CPUExecutionProvider"])
+        logger.info(f"ONNX-модель эмбеддингов загружена: {model_path} (потоков: {intra_op_threads or 'авто'})")
+
+    def encode(self, sentences: Union[str, List[str]], batch_size: Optional[int] = None) -> np.ndarray:
+        """
+        Кодирует строку или список строк, как SentenceTransformer.encode.
+        """
+        single = isinstance(sentences, str)
+        texts = [sentences] if single else list(sentences)
+        batch_size = batch_size or self.batch_size
+        outputs = []
+        for start in range(0, len(texts), batch_size):
+            encodings = self.tokenizer.encode_batch(texts[start:start + batch_size])
+            feeds = {
+                "input_ids": np.array([e.ids for e in encodings], dtype=np.int64),
+                "attention_mask": np.array([e.attention_mask for e in encodings], dtype=np.int64),
+            }
+            outputs.append(self.session.run(["sentence_embedding"], feeds)[0])
+        embeddings = np.concatenate(outputs) if outputs else np.zeros((0, self.config["dimension"]), np.float32)
+        return embeddings[0] if single else embeddings
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return self.encode(texts).tolist()
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.encode(text).tolist()
+
+
+def export_model(model_name: str = MODEL_NAME, model_dir: str = ONNX_MODEL_DIR, opset: int = 14):
+    """
+    Экспортирует модель sentence-transformers в ONNX и квантует веса в int8.
+    """
+    import torch
+    from onnxruntime.quantization import QuantType, quantize_dynamic
+    from sentence_transformers import SentenceTransformer
+
+    class _Wrapper(torch.nn.Module):
+        def __init__(self, model):
+            super().__init__()
+            self.model = model
+
+        def forward(self, input_ids, attention_mask):
+            features = self.model({"input_ids": input_ids, "attention_mask": attention_mask})
+            return features["sentence_embedding"]
+
+    os.makedirs(model_dir, exist_ok=True)
+    model = SentenceTransformer(model_name, device="cpu")
+    model.eval()
+    tokenizer = model.tokenizer
+    sample = tokenizer(["пример запроса"], return_tensors="pt")
+
+    fp32_path = os.path.join(model_dir, FP32_FILE)
+    with telemetry.span("onnx_export", model=model_name):
+        torch.onnx.export(
+            _Wrapper(model),
+            (sample["input_ids"], sample["attention_mask"]),
+            fp32_path,
+            input_names=["input_ids", "attention_mask"],
+            output_names=["sentence_embedding"],
+            dynamic_axes={
+                "input_ids": {0: "batch", 1: "sequence"},
+                "attention_mask": {0: "batch", 1: "sequence"},
+                "sentence_embedding": {0: "batch"},
+            },
+            opset_version=opset,
+        )
+    int8_path = os.path.join(model_dir, INT8_FILE)
+    with telemetry.span("onnx_quantize", model=model_name):
+        quantize_dynamic(fp32_path, int8_path, weight_type=QuantType.QInt8)
+
+    tokenizer.save_pretrained(model_dir)
+    config = {
+        "model_name": model_name,
+        "max_seq_length": model.max_seq_length,
+        "dimension": model.get_sentence_embedding_dimension(),
+        "pad_token": tokenizer.pad_token,
+        "pad_token_id": tokenizer.pad_token_id,
+    }
+    with open(os.path.join(model_dir, CONFIG_FILE), "w", encoding="utf-8") as f:
+        json.dump(config, f, ensure_ascii=False, indent=2)
+    logger.info(f"Модель экспортирована: {fp32_path} ({os.path.getsize(fp32_path) / 2 ** 20:.0f} МБ), "
+                f"{int8_path} ({os.path.getsize(int8_path) / 2 ** 20:.0f} МБ)")
+
+
+def sample_texts(limit: int = 200) -> List[str]:
+    """
+    Тексты для проверки: вопросы из бенчмарка и чанки обработанных документов.
+    """
+    texts = []
+    questions_file = os.path.join("benchmarks", "retrieval_questions.json")
+    if os.path.exists(questions_file):
+        with open(questions_file, "r", encoding="utf-8") as f:
+            texts.extend(q["question"] for q in json.load(f))
+    documents_file = os.path.join("processed_data", "processed_documents.json")
+    if os.path.exists(documents_file):
+        with open(documents_file, "r", encoding="utf-8") as f:
+            texts.extend(doc["text"] for doc in json.load(f))
+    if not texts:
+        texts = ["Сколько стоит обучение на программе Искусственный интеллект?",
+                 "Есть ли общежитие?", "Когда проходят вступительные экзамены?"]
+    return texts[:limit]
+
+
+def _mean_latency_ms(encode, texts: List[str]) -> float:
+    start = time.perf_counter()
+    for text in texts:
+        encode(text)
+    return (time.perf_counter() - start) * 1000 / max(1, len(texts))
+
+
+def check_parity(model_name: str = MODEL_NAME, model_dir: str = ONNX_MODEL_DIR, limit: int = 200) -> bool:
+    """
+    Сравнивает эмбеддинги ONNX (fp32 и int8) с исходной моделью: косинусная близость,
+    совпадение ближайшего документа и задержка кодирования одного запроса.
+    """
+    from sentence_transformers import SentenceTransformer
+
+    texts = sample_texts(limit)
+    reference_model = SentenceTransformer(model_name, device="cpu")
+    reference = reference_model.encode(texts)
+    reference_ms = _mean_latency_ms(reference_model.encode, texts[:50])
+
+    ok = True
+    for quantized in (False, True):
+        onnx_model = OnnxEmbeddings(model_dir, quantized=quantized)
+        candidate = onnx_model.encode(texts)
+        ref_norm = reference / np.linalg.norm(reference, axis=1, keepdims=True)
+        cand_norm = candidate / np.linalg.norm(candidate, axis=1, keepdims=True)
+        cosine = np.sum(ref_norm * cand_norm, axis=1)
+        # Совпадение ближайшего соседа: ищем для каждого текста ближайший среди остальных
+        ref_sim = ref_norm @ ref_norm.T
+        cand_sim = cand_norm @ cand_norm.T
+        np.fill_diagonal(ref_sim, -1)
+        np.fill_diagonal(cand_sim, -1)
+        top1 = float(np.mean(ref_sim.argmax(axis=1) == cand_sim.argmax(axis=1)))
+        onnx_ms = _mean_latency_ms(onnx_model.encode, texts[:50])
+
+        name = "int8" if quantized else "fp32"
+        print(f"{name}: косинус min={cosine.min():.4f} mean={cosine.mean():.4f}, "
+              f"совпадение top-1={top1:.3f}, запрос {onnx_ms:.1f} мс против {reference_ms:.1f} мс PyTorch")
+        if cosine.min() < PARITY_MIN_COSINE:
+            logger.error(f"ONNX-модель ({name}) расходится с исходной: минимальный косинус {cosine.min():.4f}")
+            ok = False
+    return ok
+
+
+def main():
+    telemetry.setup_logging()
+    parser = argparse.ArgumentParser(description="ONNX-бэкенд эмбеддингов")
+    parser.add_argument("command", choices=["export", "check"], help="export - экспорт и квантизация, check - проверка")
+    parser.add_argument("--model", default=MODEL_NAME, help="Модель sentence-transformers")
+    parser.add_argument("--output", default=ONNX_MODEL_DIR, help="Папка ONNX-модели")
+    parser.add_argument("--limit", type=int, default=200, help="Число текстов для проверки")
+    args = parser.parse_args()
+
+    if args.command == "export":
+        export_model(args.model, args.output)
+    if not check_parity(args.model, args.output, args.limit):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,296 @@
+# pipeline.py
+"""
+Инкрементальный конвейер подготовки данных: сбор страниц -> обработка -> эмбеддинги -> индекс.
+
+Результаты этапов адресуются по содержимому:
+    хеш страницы (контент + учебный план + параметры чанкинга) -> чанки программы;
+    хеш текста чанка (+ модель эмбеддингов)                     -> эмбеддинг;
+    хеш набора чанков (+ модель эмбеддингов)                     -> версия индекса.
+Этап выполняется только для изменившихся входов: если изменилась одна программа, заново
+обрабатывается только она, а эмбеддинги считаются только для новых чанков. Программы
+обрабатываются параллельно, время каждого этапа печатается в конце.
+
+Пример:
+    python pipeline.py                 # обработка скачанных страниц и публикация нового индекса
+    python pipeline.py --crawl         # предварительно заново скачать страницы программ
+"""
+import os
+import json
+import time
+import hashlib
+import argparse
+import logging
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from contextlib import contextmanager
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+
+import telemetry
+import index_versions
+import process_data
+from fact_table import build_fact_table, save_fact_table
+from create_vector_db import (EMBEDDING_BACKEND, EMBEDDING_MODEL_NAME, QUANTIZED_SUBDIR, build_quantized_index,
+                              initialize_embedding_model, initialize_vector_db, verify_vector_db)
+from quantized_index import QUANTIZATION_MODES
+
+logger = logging.getLogger(__name__)
+
+CACHE_DIR = os.path.join(process_data.PROCESSED_DIR, "cache")
+CHUNKS_CACHE_DIR = os.path.join(CACHE_DIR, "chunks")
+EMBEDDINGS_CACHE_DIR = os.path.join(CACHE_DIR, "embeddings")
+PROCESSED_FILE = os.path.join(process_data.PROCESSED_DIR, "processed_documents.json")
+# Меняется при изменении логики обработки, чтобы инвалидировать кэш чанков
+PROCESS_VERSION = "2"
+
+
+def content_key(*parts: Any) -> str:
+    """
+    SHA-256 от последовательности строк/байтов (с разделителем, чтобы ("ab", "c") != ("a", "bc")).
+    """
+    digest = hashlib.sha256()
+    for part in parts:
+        data = part if isinstance(part, bytes) else str(part).encode("utf-8")
+        digest.update(len(data).to_bytes(8, "little"))
+        digest.update(data)
+    return digest.hexdigest()
+
+
+def _read_bytes(path: Optional[str]) -> bytes:
+    if not path or not os.path.exists(path):
+        return b""
+    with open(path, "rb") as f:
+        return f.read()
+
+
+def _write_json_atomic(path: str, data: Any):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_path, path)
+
+
+class StageTimer:
+    """Собирает время этапов по программам и признак попадания в кэш."""
+
+    def __init__(self):
+        self.records: List[Dict[str, Any]] = []
+        self.started = time.perf_counter()
+
+    @contextmanager
+    def stage(self, name: str, program: str = "*"):
+        record = {"stage": name, "program": program, "cached": False, "seconds": 0.0}
+        start = time.perf_counter()
+        with telemetry.span(f"pipeline_{name}", program=program):
+            yield record
+        if not record["seconds"]:
+            record["seconds"] = time.perf_counter() - start
+        self.records.append(record)
+
+    def report(self) -> str:
+        lines = [f"{'этап':<10} {'программа':<28} {'время, с':>9}  кэш"]
+        for r in self.records:
+            lines.append(f"{r['stage']:<10} {r['program']:<28} {r['seconds']:>9.2f}  {'да' if r['cached'] else 'нет'}")
+        lines.append(f"Общее время: {time.perf_counter() - self.started:.2f} с")
+        return "\n".join(lines)
+
+
+def crawl(timer: StageTimer, urls: Optional[List[str]] = None):
+    """
+    Заново скачивает страницы программ (Selenium; последовательно - один браузер).
+    Неизменившиеся страницы дадут те же хеши, и следующие этапы для них будут пропущены.
+    """
+    import glob
+    import parse_itmo
+
+    urls = urls or parse_itmo.PROGRAM_URLS
+    parse_itmo.INITIAL_PDF_FILES = set(glob.glob(os.path.join(parse_itmo.DOWNLOAD_DIR, "*.pdf")))
+    driver = parse_itmo.setup_driver()
+    try:
+        for url in urls:
+            with timer.stage("crawl", url.rstrip("/").rsplit("/", 1)[-1]):
+                parse_itmo.save_data(parse_itmo.get_program_data_selenium(driver, url))
+    finally:
+        driver.quit()
+
+
+def page_key(content_file: str, plan_info_file: str, chunk_size: int, overlap: int) -> str:
+    """
+    Хеш входов этапа обработки одной программы (бэкенды PDF извлекают текст по-разному).
+    """
+    plan_pdf = process_data.find_plan_pdf(plan_info_file)
+    return content_key(PROCESS_VERSION, process_data.pdf_backend(), chunk_size, overlap, _read_bytes(content_file),
+                       _read_bytes(plan_info_file), _read_bytes(plan_pdf))
+
+
+def _process_worker(program_name: str, content_file: str, plan_info_file: str,
+                    chunk_size: int, overlap: int) -> Tuple[List[Dict[str, Any]], float]:
+    start = time.perf_counter()
+    documents = process_data.process_program_data(program_name, content_file, plan_info_file,
+                                                  chunk_size=chunk_size, overlap=overlap)
+    return documents, time.perf_counter() - start
+
+
+def run_process_stage(timer: StageTimer, chunk_size: int, overlap: int,
+                      workers: int) -> Dict[str, List[Dict[str, Any]]]:
+    """
+    Обрабатывает программы с изменившимися страницами (параллельно), остальные берет из кэша.
+    """
+    results: Dict[str, List[Dict[str, Any]]] = {}
+    pending = {}
+    for program_name, content_file, plan_info_file in process_data.list_programs():
+        key = page_key(content_file, plan_info_file, chunk_size, overlap)
+        cache_path = os.path.join(CHUNKS_CACHE_DIR, f"{key}.json")
+        if os.path.exists(cache_path):
+            with timer.stage("process", program_name) as record:
+                with open(cache_path, "r", encoding="utf-8") as f:
+                    results[program_name] = json.load(f)
+                record["cached"] = True
+        else:
+            pending[program_name] = (content_file, plan_info_file, cache_path)
+
+    if pending:
+        with ProcessPoolExecutor(max_workers=max(1, min(workers, len(pending)))) as pool:
+            futures = {
+                pool.submit(_process_worker, name, content_file, plan_info_file, chunk_size, overlap): name
+                for name, (content_file, plan_info_file, _) in pending.items()
+            }
+            for future in as_completed(futures):
+                name = futures[future]
+                documents, seconds = future.result()
+                with timer.stage("process", name) as record:
+                    record["seconds"] = seconds
+                    _write_json_atomic(pending[name][2], documents)
+                results[name] = documents
+    return results
+
+
+def embedding_model_key() -> str:
+    return content_key(EMBEDDING_BACKEND, EMBEDDING_MODEL_NAME)[:16]
+
+
+def run_embed_stage(timer: StageTimer, documents: List[Dict[str, Any]],
+                    batch_size: int = 32) -> Dict[str, np.ndarray]:
+    """
+    Возвращает эмбеддинги по хешу текста; модель загружается, только если есть новые чанки.
+    """
+    cache_dir = os.path.join(EMBEDDINGS_CACHE_DIR, embedding_model_key())
+    embeddings: Dict[str, np.ndarray] = {}
+    missing: Dict[str, str] = {}
+    with timer.stage("embed") as record:
+        for doc in documents:
+            key = content_key(doc["text"])
+            if key in embeddings or key in missing:
+                continue
+            path = os.path.join(cache_dir, key[:2], f"{key}.npy")
+            if os.path.exists(path):
+                embeddings[key] = np.load(path)
+            else:
+                missing[key] = doc["text"]
+
+        logger.info(f"Эмбеддинги: {len(embeddings)} из кэша, {len(missing)} новых")
+        record["cached"] = not missing
+        if missing:
+            model = initialize_embedding_model()
+            keys = list(missing)
+            vectors = np.asarray(model.encode([missing[k] for k in keys], batch_size=batch_size), dtype=np.float32)
+            for key, vector in zip(keys, vectors):
+                path = os.path.join(cache_dir, key[:2], f"{key}.npy")
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                np.save(path, vector)
+                embeddings[key] = vector
+    return embeddings
+
+
+def index_key(documents: List[Dict[str, Any]]) -> str:
+    """
+    Хеш содержимого индекса: id, тексты и метаданные чанков плюс модель эмбеддингов.
+    """
+    parts = sorted(
+        f"{doc['id']}:{content_key(doc['text'], json.dumps(doc['metadata'], ensure_ascii=False, sort_keys=True))}"
+        for doc in documents
+    )
+    return content_key(embedding_model_key(), *parts)
+
+
+def run_index_stage(timer: StageTimer, documents: List[Dict[str, Any]], embeddings: Dict[str, np.ndarray],
+                    quantized: Optional[str], force: bool = False) -> Optional[str]:
+    """
+    Публикует новую версию индекса, если набор чанков изменился; возвращает версию или None.
+    """
+    key = index_key(documents) + (f":{quantized}" if quantized else "")
+    with timer.stage("index") as record:
+        active = index_versions.current_version()
+        if not force and active and index_versions.read_manifest(active).get("content_key") == key:
+            logger.info(f"Индекс не изменился, активная версия {active} остается")
+            record["cached"] = True
+            return None
+
+        version = index_versions.new_version()
+        output_dir = index_versions.build_dir(version)
+        added = {
+            "ids": [doc["id"] for doc in documents],
+            "embeddings": [embeddings[content_key(doc["text"])].tolist() for doc in documents],
+            "metadatas": [doc["metadata"] for doc in documents],
+            "texts": [doc["text"] for doc in documents],
+        }
+        try:
+            collection = initialize_vector_db(output_dir)
+            collection.add(ids=added["ids"], embeddings=added["embeddings"],
+                           metadatas=added["metadatas"], documents=added["texts"])
+            verify_vector_db(collection)
+            if quantized:
+                build_quantized_index(added, quantized, os.path.join(output_dir, QUANTIZED_SUBDIR))
+        except Exception:
+            index_versions.discard(version)
+            raise
+
+        index_versions.write_manifest(version, {
+            "collection": index_versions.COLLECTION_NAME,
+            "documents": len(documents),
+            "embedding_backend": EMBEDDING_BACKEND,
+            "quantized": quantized,
+            "content_key": key,
+        })
+        index_versions.publish(version)
+        index_versions.prune_builds()
+        return version
+
+
+def main():
+    telemetry.setup_logging()
+    parser = argparse.ArgumentParser(description="Инкрементальный конвейер: сбор -> обработка -> индекс")
+    parser.add_argument("--crawl", action="store_true", help="Заново скачать страницы программ")
+    parser.add_argument("--chunk-size", type=int, default=1000, help="Размер чанка в словах")
+    parser.add_argument("--overlap", type=int, default=100, help="Перекрытие чанков в словах")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="Параллельных обработчиков программ")
+    parser.add_argument("--quantized", choices=QUANTIZATION_MODES, default=os.getenv("INDEX_QUANTIZATION") or None,
+                        help="Дополнительно построить квантованный индекс")
+    parser.add_argument("--force", action="store_true", help="Опубликовать новую версию индекса, даже если данные не изменились")
+    args = parser.parse_args()
+
+    timer = StageTimer()
+    if args.crawl:
+        crawl(timer)
+
+    per_program = run_process_stage(timer, args.chunk_size, args.overlap, args.workers)
+    documents = [doc for name in sorted(per_program) for doc in per_program[name]]
+    if not documents:
+        logger.error("Нет документов для индексации. Сначала скачайте страницы (parse_itmo.py или --crawl).")
+        return
+    # Общий файл документов нужен остальным скриптам (build_faq.py, benchmark_retrieval.py)
+    _write_json_atomic(PROCESSED_FILE, documents)
+    with timer.stage("facts"):
+        save_fact_table(build_fact_table(process_data.list_programs()))
+
+    embeddings = run_embed_stage(timer, documents)
+    version = run_index_stage(timer, documents, embeddings, args.quantized, force=args.force)
+    if version:
+        logger.info(f"Опубликована версия индекса {version}: {len(documents)} документов")
+
+    print(timer.report())
+
+
+if __name__ == "__main__":
+    main()
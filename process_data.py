@@ -1,12 +1,24 @@
 import os
 import json
+import signal
+import threading
+from collections import deque
+from contextlib import contextmanager
 from pathlib import Path
 import hashlib
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Iterable, Iterator, Optional, Tuple
 
 # Для работы с PDF
 import PyPDF2
 
+# PyMuPDF заметно быстрее извлекает текст; если не установлен, используется PyPDF2
+try:
+    import fitz
+except ImportError:
+    fitz = None
+
+from fact_table import FACTS_PATH, build_fact_table, save_fact_table
+
 # Для работы с эмбеддингами и векторной БД
 # (эти импорты понадобятся позже, но добавим для полноты картины)
 # import chromadb
@@ -19,21 +31,125 @@ PROCESSED_DIR = "processed_data"
 # Создаем папку для обработанных данных
 os.makedirs(PROCESSED_DIR, exist_ok=True)
 
-def extract_text_from_pdf(pdf_path: str) -> str:
+# Бюджет на один PDF: лишние страницы и текст сверх лимита не извлекаются
+PDF_MAX_FILE_BYTES = int(os.getenv("PDF_MAX_FILE_BYTES", str(100 * 2 ** 20)))
+PDF_MAX_PAGES = int(os.getenv("PDF_MAX_PAGES", "500"))
+PDF_MAX_TEXT_BYTES = int(os.getenv("PDF_MAX_TEXT_BYTES", str(20 * 2 ** 20)))
+# Ограничение времени на страницу (секунд, 0 - без ограничения)
+PDF_PAGE_TIMEOUT = float(os.getenv("PDF_PAGE_TIMEOUT", "10"))
+# Бэкенд извлечения: auto (pymupdf, если установлен), pymupdf или pypdf2
+PDF_BACKEND = os.getenv("PDF_BACKEND", "auto")
+
+class PageTimeout(Exception):
+    pass
+
+def pdf_backend() -> str:
+    """
+    Имя используемого бэкенда извлечения текста из PDF.
+    """
+    if PDF_BACKEND == "pymupdf" or (PDF_BACKEND == "auto" and fitz is not None):
+        if fitz is None:
+            print("PyMuPDF не установлен, используется PyPDF2")
+            return "pypdf2"
+        return "pymupdf"
+    return "pypdf2"
+
+@contextmanager
+def page_timeout(seconds: float):
+    """
+    Прерывает извлечение страницы по таймеру SIGALRM. Работает только в главном потоке
+    (в том числе в процессах ProcessPoolExecutor); в остальных случаях ограничения нет.
+    Зависание внутри C-кода PyMuPDF сигналом не прерывается.
+    """
+    if seconds <= 0 or not hasattr(signal, "setitimer") or threading.current_thread() is not threading.main_thread():
+        yield
+        return
+
+    def on_alarm(signum, frame):
+        raise PageTimeout()
+
+    previous = signal.signal(signal.SIGALRM, on_alarm)
+    signal.setitimer(signal.ITIMER_REAL, seconds)
+    try:
+        yield
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        signal.signal(signal.SIGALRM, previous)
+
+def _open_pdf_pages(pdf_path: str, backend: str) -> Tuple[int, Any, Any]:
+    """
+    Открывает PDF; возвращает (число страниц, функция извлечения текста страницы, документ).
+    """
+    if backend == "pymupdf":
+        document = fitz.open(pdf_path)
+        return document.page_count, lambda i: document.load_page(i).get_text(), document
+    file = open(pdf_path, 'rb')
+    try:
+        pdf_reader = PyPDF2.PdfReader(file)
+        return len(pdf_reader.pages), lambda i: pdf_reader.pages[i].extract_text() or "", file
+    except Exception:
+        file.close()
+        raise
+
+def iter_pdf_pages(
+        pdf_path: str,
+        max_pages: int = PDF_MAX_PAGES,
+        max_text_bytes: int = PDF_MAX_TEXT_BYTES,
+        timeout: float = PDF_PAGE_TIMEOUT
+) -> Iterator[str]:
     """
-    Извлекает текст из PDF файла.
+    Извлекает текст PDF постранично. В памяти одновременно находится только одна страница;
+    поврежденная или слишком долгая страница пропускается, остальные извлекаются.
     """
-    text = ""
+    if os.path.getsize(pdf_path) > PDF_MAX_FILE_BYTES:
+        print(f"  PDF {pdf_path} больше {PDF_MAX_FILE_BYTES} байт, пропущен")
+        return
+    backend = pdf_backend()
     try:
-        with open(pdf_path, 'rb') as file:
-            pdf_reader = PyPDF2.PdfReader(file)
-            for page_num in range(len(pdf_reader.pages)):
-                page = pdf_reader.pages[page_num]
-                text += page.extract_text() + "\n"
+        page_count, extract_page, document = _open_pdf_pages(pdf_path, backend)
     except Exception as e:
-        print(f"Ошибка при извлечении текста из {pdf_path}: {e}")
-        return ""
-    return text
+        print(f"Ошибка при открытии PDF {pdf_path}: {e}")
+        return
+
+    text_bytes = 0
+    skipped = 0
+    try:
+        if page_count > max_pages:
+            print(f"  В {pdf_path} {page_count} страниц, извлекаются первые {max_pages}")
+        for page_num in range(min(page_count, max_pages)):
+            try:
+                with page_timeout(timeout):
+                    page_text = extract_page(page_num)
+            except PageTimeout:
+                print(f"  Страница {page_num + 1} в {pdf_path}: превышено время {timeout} с, пропущена")
+                skipped += 1
+                continue
+            except Exception as e:
+                print(f"  Страница {page_num + 1} в {pdf_path}: ошибка извлечения ({e}), пропущена")
+                skipped += 1
+                continue
+            text_bytes += len(page_text.encode("utf-8"))
+            if text_bytes > max_text_bytes:
+                print(f"  Текст {pdf_path} превысил {max_text_bytes} байт, извлечение остановлено на странице {page_num + 1}")
+                break
+            yield page_text
+    finally:
+        document.close()
+    if skipped:
+        print(f"  Пропущено страниц в {pdf_path}: {skipped}")
+
+def iter_pdf_words(pdf_path: str) -> Iterator[str]:
+    """
+    Слова текста PDF по мере извлечения страниц.
+    """
+    for page_text in iter_pdf_pages(pdf_path):
+        yield from page_text.split()
+
+def extract_text_from_pdf(pdf_path: str) -> str:
+    """
+    Извлекает текст из PDF файла целиком (для обработки используйте iter_pdf_pages).
+    """
+    return "".join(page_text + "\n" for page_text in iter_pdf_pages(pdf_path))
 
 def read_text_file(file_path: str) -> str:
     """
@@ -60,19 +176,50 @@ def get_file_hash(file_path: str) -> str:
         return ""
     return hash_md5.hexdigest()
 
+def chunk_words(words: Iterable[str], chunk_size: int = 1000, overlap: int = 100) -> Iterator[str]:
+    """
+    Разбивает поток слов на чанки по мере поступления: в памяти держится не больше chunk_size слов.
+    """
+    step = chunk_size - overlap
+    if step <= 0:
+        raise ValueError("overlap должен быть меньше chunk_size")
+    window = deque()
+    for word in words:
+        window.append(word)
+        if len(window) == chunk_size:
+            yield ' '.join(window)
+            for _ in range(step):
+                window.popleft()
+    # Хвост: как и при нарезке списка, последние чанки могут быть короче chunk_size
+    while window:
+        yield ' '.join(window)
+        for _ in range(min(step, len(window))):
+            window.popleft()
+
 def chunk_text(text: str, chunk_size: int = 1000, overlap: int = 100) -> List[str]:
     """
     Разбивает текст на чанки.
     """
-    chunks = []
-    words = text.split()
-    for i in range(0, len(words), chunk_size - overlap):
-        chunk = ' '.join(words[i:i + chunk_size])
-        if chunk.strip():  # Проверяем, что чанк не пустой
-            chunks.append(chunk)
-    return chunks
+    return list(chunk_words(text.split(), chunk_size, overlap))
 
-def process_program_data(program_name: str, content_file: str, plan_info_file: str) -> List[Dict[str, Any]]:
+def find_plan_pdf(plan_info_file: str) -> Optional[str]:
+    """
+    Возвращает путь к скачанному PDF учебного плана из файла информации о плане.
+    """
+    plan_info_text = read_text_file(plan_info_file)
+    if plan_info_text and "Скачанный учебный план:" in plan_info_text:
+        for line in plan_info_text.split('\n'):
+            if line.startswith("Скачанный учебный план:"):
+                return line.split(":", 1)[1].strip()
+    return None
+
+def process_program_data(
+        program_name: str,
+        content_file: str,
+        plan_info_file: str,
+        chunk_size: int = 1000,
+        overlap: int = 100
+) -> List[Dict[str, Any]]:
     """
     Обрабатывает данные для одной программы.
     """
@@ -85,24 +232,7 @@ def process_program_data(program_name: str, content_file: str, plan_info_file: s
         return []
     
     # Чтение информации о плане
-    plan_info_text = read_text_file(plan_info_file)
-    plan_pdf_path = None
-    if plan_info_text:
-        # Проверяем, есть ли путь к PDF в информации
-        if "Скачанный учебный план:" in plan_info_text:
-            # Извлекаем путь к PDF
-            for line in plan_info_text.split('\n'):
-                if line.startswith("Скачанный учебный план:"):
-                    plan_pdf_path = line.split(":", 1)[1].strip()
-                    break
-    
-    # Извлечение текста из PDF учебного плана
-    plan_text = ""
-    if plan_pdf_path and os.path.exists(plan_pdf_path):
-        print(f"  Извлечение текста из PDF: {plan_pdf_path}")
-        plan_text = extract_text_from_pdf(plan_pdf_path)
-    else:
-        print(f"  PDF файл учебного плана не найден для {program_name}")
+    plan_pdf_path = find_plan_pdf(plan_info_file)
     
     # Подготовка метаданных
     metadata = {
@@ -112,7 +242,7 @@ def process_program_data(program_name: str, content_file: str, plan_info_file: s
     }
     
     # Разбиение текстового контента на чанки
-    content_chunks = chunk_text(content_text)
+    content_chunks = chunk_text(content_text, chunk_size, overlap)
     print(f"  Создано {len(content_chunks)} чанков из текстового контента")
     
     # Создание документов для текстового контента
@@ -125,19 +255,18 @@ def process_program_data(program_name: str, content_file: str, plan_info_file: s
         }
         documents.append(doc)
     
-    # Обработка текста учебного плана, если он есть
-    if plan_text:
+    # Текст учебного плана извлекается постранично и сразу режется на чанки
+    if plan_pdf_path and os.path.exists(plan_pdf_path):
+        print(f"  Извлечение текста из PDF: {plan_pdf_path} ({pdf_backend()})")
         plan_metadata = {
             "program_name": program_name,
             "content_source": "study_plan",
             "source_file": plan_pdf_path
         }
         
-        # Разбиение текста плана на чанки
-        plan_chunks = chunk_text(plan_text)
-        print(f"  Создано {len(plan_chunks)} чанков из учебного плана")
-        
         # Создание документов для учебного плана
+        plan_chunks = chunk_words(iter_pdf_words(plan_pdf_path), chunk_size, overlap)
+        plan_count = 0
         for i, chunk in enumerate(plan_chunks):
             doc = {
                 "id": f"{program_name}_plan_{i}",
@@ -145,21 +274,21 @@ def process_program_data(program_name: str, content_file: str, plan_info_file: s
                 "metadata": {**plan_metadata, "chunk_index": i, "chunk_type": "study_plan"}
             }
             documents.append(doc)
+            plan_count += 1
+        print(f"  Создано {plan_count} чанков из учебного плана")
+    else:
+        print(f"  PDF файл учебного плана не найден для {program_name}")
     
     return documents
 
-def main():
+def list_programs() -> List[Tuple[str, str, str]]:
     """
-    Основная функция для обработки всех данных.
+    Возвращает (имя программы, файл контента, файл информации о плане) для скачанных программ.
     """
-    print("Начало обработки данных...")
-    
-    all_documents = []
+    programs = []
     
     # Получаем список программ из имен файлов контента
-    content_files = list(Path(DOWNLOADS_DIR).glob("*_content.txt"))
-    
-    for content_file in content_files:
+    for content_file in sorted(Path(DOWNLOADS_DIR).glob("*_content.txt")):
         # Определяем имя программы
         program_name = content_file.stem.replace("_content", "")
         
@@ -167,15 +296,40 @@ def main():
         plan_info_file = os.path.join(DOWNLOADS_DIR, f"{program_name}_plan_info.txt")
         
         if os.path.exists(plan_info_file):
-            # Обрабатываем данные для программы
-            program_documents = process_program_data(
-                program_name, 
-                str(content_file), 
-                plan_info_file
-            )
-            all_documents.extend(program_documents)
+            programs.append((program_name, str(content_file), plan_info_file))
         else:
             print(f"Файл с информацией о плане не найден для {program_name}")
+    return programs
+
+def collect_documents(chunk_size: int = 1000, overlap: int = 100) -> List[Dict[str, Any]]:
+    """
+    Обрабатывает все программы из папки загрузок и возвращает список документов.
+    """
+    all_documents = []
+    for program_name, content_file, plan_info_file in list_programs():
+        # Обрабатываем данные для программы
+        program_documents = process_program_data(
+            program_name, 
+            content_file, 
+            plan_info_file,
+            chunk_size=chunk_size,
+            overlap=overlap
+        )
+        all_documents.extend(program_documents)
+
+    return all_documents
+
+def main():
+    """
+    Основная функция для обработки всех данных.
+    """
+    print("Начало обработки данных...")
+
+    all_documents = collect_documents()
+
+    # Таблица фактов для быстрых ответов бота (стоимость, места, даты экзаменов и т.д.)
+    save_fact_table(build_fact_table(list_programs()))
+    print(f"Таблица фактов сохранена в {FACTS_PATH}")
     
     # Сохранение всех документов в JSON файл
     output_file = os.path.join(PROCESSED_DIR, "processed_documents.json")
@@ -0,0 +1,364 @@
+# profiling.py
+"""
+Выборочное профилирование запросов бота (включается PROFILE_SAMPLE_RATE > 0).
+
+Для доли запросов (обработка сообщения, вызов агента) фоновый поток раз в PROFILE_INTERVAL_MS
+снимает стеки потоков через sys._current_frames() - без трассировки каждого вызова, поэтому
+накладные расходы малы и профилирование можно держать включенным в продакшене.
+Сэмпл относится к запросу, если в стеке есть "якорь" запроса: кадр обертки profiled()
+в цикле событий или кадр attach() в рабочем потоке (profiling.to_thread, вызов LLM).
+Поэтому одновременные запросы не смешиваются, а время в Chroma, эмбеддере, LangChain и
+llama.cpp попадает в профиль того запроса, который его вызвал.
+
+Результаты в PROFILE_DIR (по умолчанию profiles/):
+    requests/<время>-<trace_id>-<имя>.folded   - стеки одного запроса (формат folded stacks);
+    requests.jsonl                             - сводка по запросам: длительность, число сэмплов,
+                                                 тайминги llama.cpp (prompt eval / eval, мс на токен);
+    aggregate-<имя>.folded, aggregate-<имя>.svg - накопленные стеки и flame graph по всем запросам.
+Файлы .folded открываются в speedscope или flamegraph.pl; SVG можно перестроить командой
+    python profiling.py profiles/aggregate-handle_message.folded
+"""
+import os
+import sys
+import json
+import time
+import html
+import zlib
+import atexit
+import random
+import asyncio
+import logging
+import argparse
+import functools
+import threading
+from collections import Counter
+from contextvars import ContextVar
+from datetime import datetime, timezone
+from typing import Any, Callable, Dict, List, Optional
+
+import telemetry
+
+logger = logging.getLogger(__name__)
+
+PROFILE_DIR = os.getenv("PROFILE_DIR", "profiles")
+# Интервал между снимками стеков
+PROFILE_INTERVAL_MS = float(os.getenv("PROFILE_INTERVAL_MS", "5"))
+# Максимальная глубина стека в сэмпле (самые глубокие кадры отбрасываются)
+MAX_STACK_DEPTH = 128
+# Агрегированный flame graph перестраивается после стольких профилей
+AGGREGATE_EVERY = int(os.getenv("PROFILE_AGGREGATE_EVERY", "10"))
+
+telemetry.metrics.describe("profiled_requests_total", "Запросы, попавшие в выборку профилирования")
+
+_current_profile: ContextVar[Optional["RequestProfile"]] = ContextVar("current_profile", default=None)
+
+
+def sample_rate() -> float:
+    try:
+        return float(os.getenv("PROFILE_SAMPLE_RATE", "0"))
+    except ValueError:
+        return 0.0
+
+
+def should_sample() -> bool:
+    rate = sample_rate()
+    return rate > 0 and random.random() < rate
+
+
+class RequestProfile:
+    """Сэмплы стеков и тайминги llama.cpp одного запроса."""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.trace_id = telemetry.current_trace()
+        self.started_at = datetime.now(timezone.utc)
+        self.started = time.perf_counter()
+        self.duration = 0.0
+        self.stacks: Counter = Counter()
+        self.samples = 0
+        self.llm_calls: List[Dict[str, Any]] = []
+
+    def add_llm_timings(self, timings: Dict[str, Any]):
+        call = dict(timings)
+        if call.get("prompt_eval_tokens"):
+            call["prompt_eval_ms_per_token"] = round(call["prompt_eval_ms"] / call["prompt_eval_tokens"], 3)
+        if call.get("eval_tokens"):
+            call["eval_ms_per_token"] = round(call["eval_ms"] / call["eval_tokens"], 3)
+        self.llm_calls.append(call)
+
+    def summary(self) -> Dict[str, Any]:
+        return {
+            "name": self.name,
+            "trace_id": self.trace_id,
+            "started_at": self.started_at.isoformat(),
+            "duration_ms": round(self.duration * 1000, 3),
+            "samples": self.samples,
+            "interval_ms": PROFILE_INTERVAL_MS,
+            "llm_prompt_eval_ms": round(sum(c.get("prompt_eval_ms", 0) for c in self.llm_calls), 3),
+            "llm_eval_ms": round(sum(c.get("eval_ms", 0) for c in self.llm_calls), 3),
+            "llm_calls": self.llm_calls,
+        }
+
+
+class _Sampler:
+    """Фоновый поток, снимающий стеки, пока есть хотя бы один профилируемый запрос."""
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        # id кадра-якоря -> (кадр, профиль); кадр хранится, чтобы id не переиспользовался
+        self._anchors: Dict[int, tuple] = {}
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def add_anchor(self, frame, profile: RequestProfile):
+        with self._lock:
+            self._anchors[id(frame)] = (frame, profile)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="profiler", daemon=True)
+                self._thread.start()
+        self._wakeup.set()
+
+    def remove_anchor(self, frame):
+        with self._lock:
+            self._anchors.pop(id(frame), None)
+
+    def _run(self):
+        own_id = threading.get_ident()
+        while True:
+            if not self._anchors:
+                self._wakeup.clear()
+                self._wakeup.wait()
+            time.sleep(self.interval)
+            # Снимок делается под блокировкой: после remove_anchor сэмплы в профиль не добавляются
+            with self._lock:
+                if not self._anchors:
+                    continue
+                for thread_id, frame in sys._current_frames().items():
+                    if thread_id != own_id:
+                        self._sample(frame, self._anchors)
+
+    @staticmethod
+    def _sample(frame, anchors: Dict[int, tuple]):
+        # Идем от текущего кадра к корню; стек обрезается по самому внешнему якорю,
+        # чтобы вложенные якоря (to_thread -> вызов LLM) не укорачивали стек
+        chain = []
+        profile = None
+        cut = 0
+        while frame is not None:
+            chain.append(frame)
+            entry = anchors.get(id(frame))
+            if entry is not None and entry[0] is frame:
+                profile, cut = entry[1], len(chain)
+            frame = frame.f_back
+        if profile is None:
+            return
+        stack = [_frame_label(f) for f in reversed(chain[:cut])][:MAX_STACK_DEPTH]
+        profile.stacks[";".join([profile.name] + stack)] += 1
+        profile.samples += 1
+
+
+def _frame_label(frame) -> str:
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+_sampler = _Sampler(PROFILE_INTERVAL_MS / 1000)
+_aggregates: Dict[str, Counter] = {}
+_aggregate_counts: Counter = Counter()
+_aggregate_lock = threading.Lock()
+
+
+class attach:
+    """
+    Делает кадр вызывающей функции якорем текущего профилируемого запроса (если он есть),
+    чтобы сэмплы этого потока попадали в профиль запроса.
+    """
+
+    def __enter__(self):
+        profile = _current_profile.get()
+        self.frame = sys._getframe(1) if profile is not None else None
+        if self.frame is not None:
+            _sampler.add_anchor(self.frame, profile)
+        return profile
+
+    def __exit__(self, *exc):
+        if self.frame is not None:
+            _sampler.remove_anchor(self.frame)
+            self.frame = None
+        return False
+
+
+def _run_attached(func: Callable, *args, **kwargs):
+    with attach():
+        return func(*args, **kwargs)
+
+
+async def to_thread(func: Callable, *args, **kwargs):
+    """
+    asyncio.to_thread, сэмплы которого относятся к текущему профилируемому запросу.
+    """
+    return await asyncio.to_thread(_run_attached, func, *args, **kwargs)
+
+
+def record_llm_timings(timings: Optional[Dict[str, Any]]):
+    """
+    Добавляет тайминги llama.cpp одного вызова к текущему профилируемому запросу.
+    """
+    profile = _current_profile.get()
+    if profile is not None and timings:
+        profile.add_llm_timings(timings)
+
+
+def profiled(name: str):
+    """
+    Декоратор асинхронной функции: доля вызовов PROFILE_SAMPLE_RATE профилируется.
+    Вложенный вызов (агент внутри обработки сообщения) входит в профиль внешнего запроса.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            if _current_profile.get() is not None or not should_sample():
+                return await func(*args, **kwargs)
+            profile = RequestProfile(name)
+            token = _current_profile.set(profile)
+            # Кадр этой обертки находится в стеке цикла событий, пока выполняется код запроса
+            anchor = sys._getframe()
+            _sampler.add_anchor(anchor, profile)
+            try:
+                return await func(*args, **kwargs)
+            finally:
+                _sampler.remove_anchor(anchor)
+                _current_profile.reset(token)
+                profile.duration = time.perf_counter() - profile.started
+                # Трасса могла начаться внутри обработчика (telemetry.new_trace)
+                profile.trace_id = profile.trace_id or telemetry.current_trace()
+                telemetry.metrics.inc("profiled_requests_total", labels={"name": name})
+                threading.Thread(target=_save_profile, args=(profile,), daemon=True).start()
+        return wrapper
+    return decorator
+
+
+def write_folded(path: str, stacks: Counter):
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        for stack, count in stacks.most_common():
+            f.write(f"{stack} {count}\n")
+    os.replace(tmp_path, path)
+
+
+def read_folded(path: str) -> Counter:
+    stacks: Counter = Counter()
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            stack, _, count = line.rstrip("\n").rpartition(" ")
+            if stack:
+                stacks[stack] += int(count)
+    return stacks
+
+
+def _save_profile(profile: RequestProfile):
+    try:
+        requests_dir = os.path.join(PROFILE_DIR, "requests")
+        os.makedirs(requests_dir, exist_ok=True)
+        stamp = profile.started_at.strftime("%Y%m%dT%H%M%S%f")
+        write_folded(os.path.join(requests_dir, f"{stamp}-{profile.trace_id or 'notrace'}-{profile.name}.folded"),
+                     profile.stacks)
+        with _aggregate_lock:
+            with open(os.path.join(PROFILE_DIR, "requests.jsonl"), "a", encoding="utf-8") as f:
+                f.write(json.dumps(profile.summary(), ensure_ascii=False) + "\n")
+            aggregate = _aggregates.setdefault(profile.name, _load_aggregate(profile.name))
+            aggregate.update(profile.stacks)
+            _aggregate_counts[profile.name] += 1
+            if AGGREGATE_EVERY <= 1 or _aggregate_counts[profile.name] % AGGREGATE_EVERY == 1:
+                _write_aggregate(profile.name)
+        logger.info(f"Профиль запроса {profile.name} ({profile.trace_id}): "
+                    f"{profile.duration * 1000:.0f} мс, {profile.samples} сэмплов")
+    except Exception as e:
+        logger.error(f"Не удалось сохранить профиль запроса: {e}")
+
+
+def _write_aggregate(name: str):
+    path = os.path.join(PROFILE_DIR, f"aggregate-{name}")
+    write_folded(f"{path}.folded", _aggregates[name])
+    with open(f"{path}.svg", "w", encoding="utf-8") as f:
+        f.write(render_flamegraph(_aggregates[name], title=f"{name}: {_aggregate_counts[name]} запросов"))
+
+
+@atexit.register
+def flush_aggregates():
+    """
+    Дописывает накопленные профили на диск (вызывается и при завершении процесса).
+    """
+    with _aggregate_lock:
+        for name in _aggregates:
+            _write_aggregate(name)
+
+
+def _load_aggregate(name: str) -> Counter:
+    # Накопленный профиль продолжается после перезапуска бота
+    path = os.path.join(PROFILE_DIR, f"aggregate-{name}.folded")
+    return read_folded(path) if os.path.exists(path) else Counter()
+
+
+def render_flamegraph(stacks: Counter, title: str = "", width: int = 1200, row_height: int = 16) -> str:
+    """
+    Простой SVG flame graph из folded stacks (без внешних зависимостей).
+    """
+    tree: Dict[str, Any] = {"count": 0, "children": {}}
+    for stack, count in stacks.items():
+        node = tree
+        node["count"] += count
+        for name in stack.split(";"):
+            node = node["children"].setdefault(name, {"count": 0, "children": {}})
+            node["count"] += count
+    total = tree["count"] or 1
+
+    rects: List[str] = []
+    max_depth = 0
+
+    def walk(node: Dict[str, Any], x: float, depth: int):
+        nonlocal max_depth
+        for name, child in sorted(node["children"].items()):
+            w = child["count"] / total * width
+            if w >= 0.5:
+                max_depth = max(max_depth, depth)
+                hue = 20 + zlib.crc32(name.encode("utf-8")) % 40
+                tooltip = f"{html.escape(name)} ({child['count']} сэмплов, {child['count'] / total:.1%})"
+                text = html.escape(name[:int(w / 7)]) if w > 60 else ""
+                rects.append(
+                    f'<g><title>{tooltip}</title>'
+                    f'<rect x="{x:.1f}" y="{{y{depth}}}" width="{w:.1f}" height="{row_height - 1}" '
+                    f'fill="hsl({hue},90%,60%)"/>'
+                    f'<text x="{x + 3:.1f}" y="{{t{depth}}}" font-size="11">{text}</text></g>'
+                )
+                walk(child, x, depth + 1)
+            x += w
+
+    walk(tree, 0.0, 0)
+    height = (max_depth + 1) * row_height + 30
+    # Корень внизу, как в классическом flame graph
+    body = "\n".join(rects)
+    for depth in range(max_depth + 1):
+        y = height - (depth + 1) * row_height
+        body = body.replace(f"{{y{depth}}}", str(y)).replace(f"{{t{depth}}}", str(y + row_height - 4))
+    return (
+        f'<svg xmlns="http://www.w3.org/2000/svg" width="{width}" height="{height}" font-family="monospace">\n'
+        f'<text x="4" y="16" font-size="13">{html.escape(title)}</text>\n{body}\n</svg>\n'
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Построение flame graph (SVG) из файла folded stacks")
+    parser.add_argument("folded", help="Файл .folded (например, profiles/aggregate-handle_message.folded)")
+    parser.add_argument("--output", default=None, help="Путь SVG (по умолчанию рядом с файлом .folded)")
+    args = parser.parse_args()
+
+    output = args.output or os.path.splitext(args.folded)[0] + ".svg"
+    with open(output, "w", encoding="utf-8") as f:
+        f.write(render_flamegraph(read_folded(args.folded), title=os.path.basename(args.folded)))
+    print(f"Flame graph сохранен: {output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,34 @@
+# programs.py
+"""
+Справочник магистерских программ: названия и варианты упоминания в вопросах.
+
+Модуль без внешних зависимостей: его используют и бот (через qa_pipeline), и офлайн-скрипты
+(process_data.py, build_faq.py), которым не нужен LangChain.
+"""
+import re
+from typing import Optional
+
+# Человекочитаемые названия программ для ссылок на источники
+PROGRAM_TITLES = {
+    "program_master_ai": "Искусственный интеллект",
+    "program_master_ai_product": "AI Product",
+}
+# Варианты упоминания программ в вопросах пользователей (регулярные выражения для нижнего регистра).
+# Более специфичные варианты проверяются первыми: "ии продукт" содержит "ии";
+# короткое "ии" ищется как отдельное слово, чтобы не совпадать с окончаниями ("информации").
+PROGRAM_ALIASES = {
+    "program_master_ai_product": [r"ai[ -]product", r"ai продукт", r"аи продукт", r"ии[ -]продукт"],
+    "program_master_ai": [r"искусственн\w*\s+интеллект", r"\bии\b"],
+}
+_ALIAS_PATTERNS = {program: re.compile("|".join(aliases)) for program, aliases in PROGRAM_ALIASES.items()}
+
+
+def detect_program(text: str) -> Optional[str]:
+    """
+    Определяет программу, упомянутую в тексте, или None.
+    """
+    text_lower = text.lower()
+    for program, pattern in _ALIAS_PATTERNS.items():
+        if pattern.search(text_lower):
+            return program
+    return None
@@ -0,0 +1,109 @@
+# qa_pipeline.py
+"""
+Явный QA-пайплайн: поиск контекста -> сборка промпта -> генерация ответа.
+
+В отличие от RetrievalQA, поиск выполняется ровно один раз: найденные документы
+используются и для отладочного вывода, и для промпта, и возвращаются вместе с ответом
+для цитирования источников.
+"""
+from typing import Any, Dict, List, Optional
+
+from langchain_core.documents import Document
+from langchain.chains.question_answering.stuff_prompt import PROMPT
+
+import telemetry
+from programs import PROGRAM_TITLES
+
+# Человекочитаемые названия типов фрагментов для ссылок на источники
+CHUNK_TYPE_TITLES = {
+    "web_content": "страница программы",
+    "study_plan": "учебный план",
+}
+
+
+class QAPipeline:
+    """QA по базе знаний с однократным поиском контекста."""
+
+    def __init__(self, retriever, llm, prompt=PROMPT, document_separator: str = "\n\n"):
+        self.retriever = retriever
+        self.llm = llm
+        self.prompt = prompt
+        self.document_separator = document_separator
+
+    def embed_query(self, query: str) -> Optional[List[float]]:
+        """
+        Кодирует запрос той же функцией эмбеддингов, что использует векторное хранилище.
+        """
+        vectorstore = getattr(self.retriever, "vectorstore", None)
+        embeddings = getattr(vectorstore, "embeddings", None)
+        if embeddings is None:
+            return None
+        return embeddings.embed_query(query)
+
+    def retrieve(self, query: str, embedding: Optional[List[float]] = None) -> List[Document]:
+        """
+        Ищет контекст для запроса. Если эмбеддинг запроса уже посчитан (например, при поиске
+        в FAQ), поиск идет по вектору без повторного кодирования.
+        """
+        with telemetry.span("retrieval") as retrieval_span:
+            if embedding is not None and hasattr(self.retriever, "vectorstore"):
+                docs = self.retriever.vectorstore.similarity_search_by_vector(
+                    embedding, **self.retriever.search_kwargs
+                )
+            else:
+                docs = self.retriever.invoke(query)
+            retrieval_span["documents"] = len(docs)
+        return docs
+
+    def build_prompt(self, query: str, docs: List[Document], history: str = "") -> str:
+        """
+        История диалога ставится перед инструкцией и контекстом: она только дописывается от
+        сообщения к сообщению, поэтому следующий промпт того же чата начинается с того же
+        префикса и llama.cpp не пересчитывает его KV-кэш.
+        """
+        with telemetry.span("prompt_build"):
+            context = self.document_separator.join(doc.page_content for doc in docs)
+            prompt = self.prompt.format(context=context, question=query)
+            return f"{history}\n\n{prompt}" if history else prompt
+
+    def generate(self, prompt: str, generation_mode=None) -> str:
+        if generation_mode is not None:
+            return self.llm.invoke(prompt, generation_mode=generation_mode)
+        return self.llm.invoke(prompt)
+
+    def answer(self, query: str, docs: List[Document], history: str = "", generation_mode=None) -> Dict[str, Any]:
+        """
+        Генерирует ответ по уже найденным документам (с учетом истории диалога, если она есть).
+        Для фактических вопросов можно передать короткий режим генерации (см. generation_modes.py).
+        """
+        prompt = self.build_prompt(query, docs, history)
+        return {
+            "query": query,
+            "result": self.generate(prompt, generation_mode=generation_mode),
+            "source_documents": docs,
+        }
+
+    def run(self, query: str, history: str = "") -> Dict[str, Any]:
+        """
+        Полный проход пайплайна: один поиск, один вызов LLM.
+        """
+        docs = self.retrieve(query)
+        return self.answer(query, docs, history)
+
+
+def format_sources(docs: List[Document]) -> str:
+    """
+    Формирует строку со списком источников ответа (без повторов).
+    """
+    seen = []
+    for doc in docs:
+        program = doc.metadata.get("program_name", "")
+        chunk_type = doc.metadata.get("chunk_type", "")
+        title = PROGRAM_TITLES.get(program, program or "неизвестная программа")
+        kind = CHUNK_TYPE_TITLES.get(chunk_type, chunk_type)
+        label = f"{title} ({kind})" if kind else title
+        if label not in seen:
+            seen.append(label)
+    if not seen:
+        return ""
+    return "Источники: " + "; ".join(seen)
@@ -0,0 +1,300 @@
+# quantized_index.py
+"""
+Квантованный индекс эмбеддингов с двухэтапным поиском.
+
+Первый проход идет по компактным кодам (int8 или бинарным), второй - пересчет точной
+косинусной близости для небольшого набора кандидатов. Полные float-векторы лежат на диске
+и открываются через memory-map, поэтому в RAM постоянно находятся только коды.
+
+    int8   - скалярная квантизация с общим масштабом, скалярные произведения в целых числах;
+    binary - знаковые биты (1 бит на измерение), расстояние Хэмминга через popcount.
+"""
+import os
+import json
+import time
+import uuid
+import logging
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+from langchain_core.vectorstores import VectorStore
+
+import telemetry
+
+logger = logging.getLogger(__name__)
+
+QUANTIZATION_MODES = ("int8", "binary")
+# Во сколько раз больше кандидатов, чем k, отбирается первым проходом
+DEFAULT_RESCORE_FACTOR = 4
+# Строк int8-кодов в одном блоке первого прохода: блок расширяется до 32 бит в кэше процессора,
+# а из памяти читаются только однобайтовые коды
+SCAN_BLOCK_ROWS = 1024
+# Пока dim * 127 * 127 < 2**24, скалярное произведение int8-кодов точно представимо во float32
+# и блок умножается через BLAS (sgemv); для больших размерностей - целочисленно в int32
+_FLOAT32_EXACT_LIMIT = 2 ** 24
+
+# Таблица popcount для байта (на случай NumPy без np.bitwise_count)
+_POPCOUNT_TABLE = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+
+def _popcount(values: np.ndarray) -> np.ndarray:
+    if hasattr(np, "bitwise_count"):
+        return np.bitwise_count(values)
+    return _POPCOUNT_TABLE[values]
+
+
+def _normalize(vectors: np.ndarray) -> np.ndarray:
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+class QuantizedIndex:
+    """Двухэтапный поиск: квантованные коды -> точный пересчет кандидатов."""
+
+    def __init__(
+            self,
+            ids: List[str],
+            vectors: np.ndarray,
+            mode: str = "int8",
+            rescore_factor: int = DEFAULT_RESCORE_FACTOR,
+            codes: Optional[np.ndarray] = None,
+            scale: Optional[float] = None
+    ):
+        if mode not in QUANTIZATION_MODES:
+            raise ValueError(f"Неизвестный режим квантизации: {mode}")
+        self.ids = list(ids)
+        self.mode = mode
+        self.rescore_factor = rescore_factor
+        # Нормированные float-векторы (могут быть memory-mapped) - только для пересчета кандидатов
+        self.vectors = vectors
+        self.dim = vectors.shape[1] if len(vectors.shape) == 2 else 0
+        if codes is None:
+            codes, scale = self._quantize_corpus(np.asarray(vectors, dtype=np.float32))
+        self.codes = codes
+        self.scale = scale
+
+    def _quantize_corpus(self, vectors: np.ndarray) -> Tuple[np.ndarray, Optional[float]]:
+        if self.mode == "binary":
+            return np.packbits(vectors > 0, axis=1), None
+        scale = float(np.abs(vectors).max()) / 127 if vectors.size else 1.0
+        scale = scale or 1.0
+        return self._quantize(vectors, scale), scale
+
+    def _quantize(self, vectors: np.ndarray, scale: Optional[float]) -> np.ndarray:
+        if self.mode == "binary":
+            return np.packbits(vectors > 0, axis=1)
+        return np.clip(np.rint(vectors / scale), -127, 127).astype(np.int8)
+
+    def add(self, ids: List[str], embeddings: np.ndarray):
+        """
+        Добавляет векторы в индекс, квантуя их с масштабом корпуса (компоненты больше
+        максимума корпуса обрезаются до ±127; точный пересчет кандидатов это компенсирует).
+        """
+        vectors = _normalize(embeddings)
+        if not len(self.ids):
+            self.dim = vectors.shape[1]
+            self.codes, self.scale = self._quantize_corpus(vectors)
+            self.vectors = vectors
+        else:
+            self.codes = np.concatenate([self.codes, self._quantize(vectors, self.scale)])
+            # Memory-mapped векторы только для чтения: после добавления индекс держит их в RAM
+            self.vectors = np.concatenate([np.asarray(self.vectors, dtype=np.float32), vectors])
+        self.ids.extend(ids)
+
+    @classmethod
+    def build(cls, ids: List[str], embeddings: np.ndarray, mode: str = "int8",
+              rescore_factor: int = DEFAULT_RESCORE_FACTOR) -> "QuantizedIndex":
+        return cls(ids, _normalize(embeddings), mode=mode, rescore_factor=rescore_factor)
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    @property
+    def code_bytes(self) -> int:
+        return int(self.codes.nbytes)
+
+    @property
+    def float_bytes(self) -> int:
+        return len(self.ids) * self.dim * 4
+
+    def first_pass(self, query: np.ndarray, n_candidates: int) -> np.ndarray:
+        """
+        Возвращает индексы кандидатов по квантованным кодам (без сортировки).
+        """
+        n_candidates = min(n_candidates, len(self.ids))
+        if self.mode == "binary":
+            query_bits = np.packbits(query > 0)
+            distances = _popcount(np.bitwise_xor(self.codes, query_bits)).sum(axis=1, dtype=np.int32)
+            scores = -distances
+        else:
+            # Общий масштаб не влияет на порядок, поэтому сравниваются скалярные произведения кодов
+            scores = self._int8_scores(query)
+        if n_candidates >= len(self.ids):
+            return np.arange(len(self.ids))
+        return np.argpartition(-scores, n_candidates - 1)[:n_candidates]
+
+    def _int8_scores(self, query: np.ndarray) -> np.ndarray:
+        """
+        Скалярные произведения int8-кодов корпуса с квантованным запросом, блоками по SCAN_BLOCK_ROWS строк.
+        """
+        exact_in_float = self.dim * 127 * 127 < _FLOAT32_EXACT_LIMIT
+        dtype = np.float32 if exact_in_float else np.int32
+        query_codes = np.clip(np.rint(query / self.scale), -127, 127).astype(dtype)
+        scores = np.empty(len(self.ids), dtype=dtype)
+        for start in range(0, len(self.ids), SCAN_BLOCK_ROWS):
+            block = self.codes[start:start + SCAN_BLOCK_ROWS]
+            np.dot(block.astype(dtype), query_codes, out=scores[start:start + len(block)])
+        return scores
+
+    def search(self, query_embedding, k: int) -> List[Tuple[str, float]]:
+        """
+        Ищет k ближайших документов; возвращает пары (id, косинусная близость).
+        """
+        if not self.ids:
+            return []
+        query = _normalize(np.asarray(query_embedding, dtype=np.float32))
+        candidates = self.first_pass(query, k * self.rescore_factor)
+        candidates.sort()
+        exact = np.asarray(self.vectors[candidates], dtype=np.float32) @ query
+        order = np.argsort(-exact)[:k]
+        return [(self.ids[candidates[i]], float(exact[i])) for i in order]
+
+    def evaluate(self, queries: np.ndarray, k: int = 5) -> Dict[str, Any]:
+        """
+        Сравнивает квантованный поиск с точным перебором: recall@k, задержка и объем памяти.
+        """
+        queries = _normalize(queries)
+        all_vectors = np.asarray(self.vectors, dtype=np.float32)
+        k = min(k, len(self.ids))
+        positions = {doc_id: i for i, doc_id in enumerate(self.ids)}
+        recalls, quantized_ms, exact_ms = [], [], []
+        for query in queries:
+            start = time.perf_counter()
+            exact_top = set(np.argsort(-(all_vectors @ query))[:k].tolist())
+            exact_ms.append((time.perf_counter() - start) * 1000)
+
+            start = time.perf_counter()
+            found = self.search(query, k)
+            quantized_ms.append((time.perf_counter() - start) * 1000)
+
+            found_idx = {positions[doc_id] for doc_id, _ in found}
+            recalls.append(len(exact_top & found_idx) / k if k else 1.0)
+        return {
+            "mode": self.mode,
+            "documents": len(self.ids),
+            "k": k,
+            "rescore_factor": self.rescore_factor,
+            "recall_at_k": float(np.mean(recalls)) if recalls else 1.0,
+            "code_bytes": self.code_bytes,
+            "float_bytes": self.float_bytes,
+            "compression": self.float_bytes / max(1, self.code_bytes),
+            "quantized_ms": float(np.mean(quantized_ms)) if quantized_ms else 0.0,
+            "exact_ms": float(np.mean(exact_ms)) if exact_ms else 0.0,
+        }
+
+    def save(self, directory: str, documents: Optional[List[Dict[str, Any]]] = None):
+        """
+        Сохраняет коды, float-векторы и (опционально) тексты с метаданными документов.
+        """
+        os.makedirs(directory, exist_ok=True)
+        np.save(os.path.join(directory, "codes.npy"), self.codes)
+        np.save(os.path.join(directory, "vectors.npy"), np.asarray(self.vectors, dtype=np.float32))
+        meta = {"mode": self.mode, "scale": self.scale, "rescore_factor": self.rescore_factor, "ids": self.ids}
+        with open(os.path.join(directory, "index.json"), "w", encoding="utf-8") as f:
+            json.dump(meta, f, ensure_ascii=False)
+        if documents is not None:
+            with open(os.path.join(directory, "documents.json"), "w", encoding="utf-8") as f:
+                json.dump(documents, f, ensure_ascii=False)
+
+    @classmethod
+    def load(cls, directory: str) -> "QuantizedIndex":
+        with open(os.path.join(directory, "index.json"), "r", encoding="utf-8") as f:
+            meta = json.load(f)
+        codes = np.load(os.path.join(directory, "codes.npy"))
+        # Полные векторы не загружаются в RAM: нужны только строки кандидатов
+        vectors = np.load(os.path.join(directory, "vectors.npy"), mmap_mode="r")
+        return cls(meta["ids"], vectors, mode=meta["mode"], rescore_factor=meta["rescore_factor"],
+                   codes=codes, scale=meta["scale"])
+
+
+def format_report(report: Dict[str, Any]) -> str:
+    return (
+        f"Квантованный индекс ({report['mode']}): документов {report['documents']}, "
+        f"recall@{report['k']} относительно точного поиска {report['recall_at_k']:.3f}, "
+        f"коды {report['code_bytes'] / 1024:.1f} КБ против {report['float_bytes'] / 1024:.1f} КБ float "
+        f"(сжатие x{report['compression']:.1f}), поиск {report['quantized_ms']:.3f} мс "
+        f"против {report['exact_ms']:.3f} мс точного перебора"
+    )
+
+
+class QuantizedVectorStore(VectorStore):
+    """Векторное хранилище LangChain поверх QuantizedIndex."""
+
+    def __init__(self, index: QuantizedIndex, documents: Dict[str, Dict[str, Any]], embedding: Embeddings):
+        self.index = index
+        self.documents = documents
+        self._embedding = embedding
+
+    @property
+    def embeddings(self) -> Embeddings:
+        return self._embedding
+
+    @classmethod
+    def load(cls, directory: str, embedding: Embeddings) -> "QuantizedVectorStore":
+        index = QuantizedIndex.load(directory)
+        with open(os.path.join(directory, "documents.json"), "r", encoding="utf-8") as f:
+            documents = {doc["id"]: doc for doc in json.load(f)}
+        logger.info(f"Загружен квантованный индекс ({index.mode}): {len(index)} документов, "
+                    f"коды {index.code_bytes / 1024:.1f} КБ")
+        return cls(index, documents, embedding)
+
+    def _to_document(self, doc_id: str) -> Document:
+        doc = self.documents[doc_id]
+        return Document(page_content=doc["text"], metadata=doc.get("metadata", {}))
+
+    def similarity_search_by_vector(self, embedding: List[float], k: int = 4, **kwargs: Any) -> List[Document]:
+        with telemetry.span("quantized_search", mode=self.index.mode):
+            found = self.index.search(embedding, k)
+        return [self._to_document(doc_id) for doc_id, _ in found]
+
+    def similarity_search_with_score(self, query: str, k: int = 4, **kwargs: Any) -> List[Tuple[Document, float]]:
+        found = self.index.search(self._embedding.embed_query(query), k)
+        return [(self._to_document(doc_id), score) for doc_id, score in found]
+
+    def _select_relevance_score_fn(self):
+        return lambda score: score
+
+    def similarity_search(self, query: str, k: int = 4, **kwargs: Any) -> List[Document]:
+        return self.similarity_search_by_vector(self._embedding.embed_query(query), k=k, **kwargs)
+
+    def add_texts(self, texts: Iterable[str], metadatas: Optional[List[dict]] = None, **kwargs: Any) -> List[str]:
+        """
+        Считает эмбеддинги текстов и добавляет их в индекс (в памяти; на диск - через save).
+        """
+        texts = list(texts)
+        if not texts:
+            return []
+        ids = list(kwargs.get("ids") or [uuid.uuid4().hex for _ in texts])
+        metadatas = metadatas or [{} for _ in texts]
+        self.index.add(ids, np.asarray(self._embedding.embed_documents(texts), dtype=np.float32))
+        for doc_id, text, metadata in zip(ids, texts, metadatas):
+            self.documents[doc_id] = {"id": doc_id, "text": text, "metadata": metadata}
+        return ids
+
+    def save(self, directory: str):
+        self.index.save(directory, documents=list(self.documents.values()))
+
+    @classmethod
+    def from_texts(cls, texts: List[str], embedding: Embeddings, metadatas: Optional[List[dict]] = None,
+                   **kwargs: Any) -> "QuantizedVectorStore":
+        """
+        Строит хранилище по текстам; режим квантизации задается аргументом mode (по умолчанию int8).
+        """
+        index = QuantizedIndex([], np.zeros((0, 0), dtype=np.float32), mode=kwargs.pop("mode", "int8"),
+                               rescore_factor=kwargs.pop("rescore_factor", DEFAULT_RESCORE_FACTOR))
+        store = cls(index, {}, embedding)
+        store.add_texts(texts, metadatas, **kwargs)
+        return store
@@ -0,0 +1,119 @@
+# speculative.py
+"""
+Спекулятивное декодирование для локальной LLM.
+
+Черновая модель предлагает несколько следующих токенов, основная модель проверяет их за один
+проход и принимает совпавший префикс. Поддерживаются два источника черновиков:
+    prompt_lookup - поиск продолжения в самом промпте (подходит для RAG, где ответ цитирует контекст);
+    model         - маленькая GGUF-модель с тем же словарем токенов, что и основная.
+"""
+import logging
+from typing import Optional
+
+import numpy as np
+import numpy.typing as npt
+from llama_cpp import Llama
+from llama_cpp.llama_speculative import LlamaDraftModel, LlamaPromptLookupDecoding
+
+import telemetry
+
+logger = logging.getLogger(__name__)
+
+telemetry.metrics.describe("speculative_draft_tokens_total", "Токены черновой модели: предложенные и принятые")
+telemetry.metrics.describe("speculative_acceptance_rate", "Доля принятых черновых токенов в последнем запросе")
+
+
+class SmallModelDraft(LlamaDraftModel):
+    """Черновик от маленькой модели: жадно генерирует num_pred_tokens токенов."""
+
+    def __init__(self, model: Llama, num_pred_tokens: int = 8):
+        self.model = model
+        self.num_pred_tokens = num_pred_tokens
+
+    def __call__(self, input_ids: npt.NDArray[np.intc], /, **kwargs) -> npt.NDArray[np.intc]:
+        ids = input_ids.tolist()
+        # Промпт с черновиком не помещается в контекст черновой модели: основная модель
+        # продолжает без черновых токенов вместо ошибки
+        if len(ids) + self.num_pred_tokens > self.model.n_ctx():
+            return np.array([], dtype=np.intc)
+        # Переиспользуем KV-кэш черновой модели для общего префикса
+        cached = self.model._input_ids.tolist()
+        prefix = 0
+        for a, b in zip(cached, ids):
+            if a != b:
+                break
+            prefix += 1
+        # Последний токен всегда пересчитываем, чтобы получить свежие логиты
+        prefix = min(prefix, len(ids) - 1)
+        self.model.n_tokens = prefix
+        self.model._ctx.kv_cache_seq_rm(-1, prefix, -1)
+        self.model.eval(ids[prefix:])
+
+        draft = []
+        eos = self.model.token_eos()
+        for _ in range(self.num_pred_tokens):
+            token = self.model.sample(top_k=1, temp=0.0)
+            if token == eos:
+                break
+            draft.append(token)
+            self.model.eval([token])
+        return np.array(draft, dtype=np.intc)
+
+
+class CountingDraftModel(LlamaDraftModel):
+    """Обертка над черновой моделью, считающая шаги проверки и предложенные токены."""
+
+    def __init__(self, inner: LlamaDraftModel):
+        self.inner = inner
+        self.steps = 0
+        self.proposed = 0
+
+    def __call__(self, input_ids: npt.NDArray[np.intc], /, **kwargs) -> npt.NDArray[np.intc]:
+        draft = self.inner(input_ids, **kwargs)
+        self.steps += 1
+        self.proposed += len(draft)
+        return draft
+
+    def reset_counters(self):
+        self.steps = 0
+        self.proposed = 0
+
+    def record(self, completion_tokens: int) -> Optional[float]:
+        """
+        Записывает метрики принятия для завершенной генерации и возвращает долю принятых токенов.
+
+        Каждый шаг проверки дает один собственный токен основной модели плюс принятые черновые,
+        поэтому число принятых оценивается как completion_tokens - steps.
+        """
+        if not self.proposed:
+            return None
+        accepted = max(0, min(self.proposed, completion_tokens - self.steps))
+        rate = accepted / self.proposed
+        telemetry.metrics.inc("speculative_draft_tokens_total", self.proposed, {"result": "proposed"})
+        telemetry.metrics.inc("speculative_draft_tokens_total", accepted, {"result": "accepted"})
+        telemetry.metrics.set_gauge("speculative_acceptance_rate", rate)
+        telemetry.log_event("speculative", steps=self.steps, proposed=self.proposed, accepted=accepted,
+                            acceptance_rate=round(rate, 3))
+        return rate
+
+
+def build_draft_model(mode: str, num_pred_tokens: int, draft_model_path: Optional[str] = None,
+                      n_threads: Optional[int] = None, n_ctx: int = 4096) -> Optional[CountingDraftModel]:
+    """
+    Создает черновую модель по режиму из профиля; 'none' отключает спекулятивное декодирование.
+    Контекст черновой модели должен совпадать с контекстом основной (n_ctx из профиля).
+    """
+    if mode in (None, "", "none"):
+        return None
+    if mode == "prompt_lookup":
+        inner = LlamaPromptLookupDecoding(num_pred_tokens=num_pred_tokens)
+    elif mode == "model":
+        if not draft_model_path:
+            raise ValueError("Для draft_mode='model' нужно указать draft_model_path")
+        logger.info(f"Загрузка черновой модели: {draft_model_path}")
+        small = Llama(model_path=draft_model_path, n_ctx=n_ctx, n_threads=n_threads, verbose=False)
+        inner = SmallModelDraft(small, num_pred_tokens=num_pred_tokens)
+    else:
+        raise ValueError(f"Неизвестный режим черновой модели: {mode}")
+    logger.info(f"Спекулятивное декодирование включено: режим={mode}, токенов в черновике={num_pred_tokens}")
+    return CountingDraftModel(inner)
@@ -0,0 +1,353 @@
+# telemetry.py
+"""
+Слой инструментирования: спаны этапов, метрики в формате Prometheus и структурные логи.
+
+Настройка через переменные окружения:
+    METRICS_PORT       - порт HTTP-эндпоинта /metrics (0 или пусто - эндпоинт не запускается)
+    LOG_FORMAT         - 'json' для структурных логов, иначе обычный текстовый формат
+    LOG_LEVEL          - уровень логирования (по умолчанию INFO)
+    DEBUG_SAMPLE_RATE  - доля запросов (0..1), для которых пишется подробный отладочный вывод
+"""
+import os
+import json
+import time
+import random
+import logging
+import threading
+import contextvars
+import uuid
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Tuple, Optional, Any, List
+
+logger = logging.getLogger("telemetry")
+
+# Границы бакетов гистограмм длительностей (секунды)
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+# Границы бакетов для скорости генерации (токенов в секунду)
+TOKENS_PER_SECOND_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+# Идентификатор текущей трассы (одно сообщение пользователя = одна трасса)
+_current_trace: contextvars.ContextVar[Optional[str]] = contextvars.ContextVar("trace_id", default=None)
+# Попала ли текущая трасса в отладочное семплирование (решается один раз в new_trace)
+_debug_sampled: contextvars.ContextVar[bool] = contextvars.ContextVar("debug_sampled", default=False)
+
+LabelKey = Tuple[Tuple[str, str], ...]
+
+
+def _label_key(labels: Optional[Dict[str, Any]]) -> LabelKey:
+    return tuple(sorted((k, str(v)) for k, v in (labels or {}).items()))
+
+
+def _format_labels(key: LabelKey, extra: Optional[Dict[str, str]] = None) -> str:
+    items = list(key) + list((extra or {}).items())
+    if not items:
+        return ""
+    escaped = ",".join(
+        f'{k}="' + str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") + '"'
+        for k, v in items
+    )
+    return "{" + escaped + "}"
+
+
+class _Histogram:
+    def __init__(self, buckets: Tuple[float, ...]):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.total = 0
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.total += 1
+        self.sum += value
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+
+
+class MetricsRegistry:
+    """Потокобезопасный реестр счетчиков, gauge-метрик и гистограмм."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters: Dict[str, Dict[LabelKey, float]] = {}
+        self._gauges: Dict[str, Dict[LabelKey, float]] = {}
+        self._histograms: Dict[str, Dict[LabelKey, _Histogram]] = {}
+        self._help: Dict[str, str] = {}
+
+    def describe(self, name: str, help_text: str):
+        self._help[name] = help_text
+
+    def inc(self, name: str, value: float = 1.0, labels: Optional[Dict[str, Any]] = None):
+        key = _label_key(labels)
+        with self._lock:
+            series = self._counters.setdefault(name, {})
+            series[key] = series.get(key, 0.0) + value
+
+    def set_gauge(self, name: str, value: float, labels: Optional[Dict[str, Any]] = None):
+        key = _label_key(labels)
+        with self._lock:
+            self._gauges.setdefault(name, {})[key] = value
+
+    def add_gauge(self, name: str, delta: float, labels: Optional[Dict[str, Any]] = None):
+        key = _label_key(labels)
+        with self._lock:
+            series = self._gauges.setdefault(name, {})
+            series[key] = series.get(key, 0.0) + delta
+
+    def observe(self, name: str, value: float, labels: Optional[Dict[str, Any]] = None,
+                buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        key = _label_key(labels)
+        with self._lock:
+            series = self._histograms.setdefault(name, {})
+            if key not in series:
+                series[key] = _Histogram(buckets)
+            series[key].observe(value)
+
+    def get_counter(self, name: str, labels: Optional[Dict[str, Any]] = None) -> float:
+        with self._lock:
+            return self._counters.get(name, {}).get(_label_key(labels), 0.0)
+
+    def get_gauge(self, name: str, labels: Optional[Dict[str, Any]] = None) -> float:
+        with self._lock:
+            return self._gauges.get(name, {}).get(_label_key(labels), 0.0)
+
+    def render_prometheus(self) -> str:
+        """
+        Возвращает все метрики в текстовом формате экспозиции Prometheus.
+        """
+        lines: List[str] = []
+        with self._lock:
+            for name, series in sorted(self._counters.items()):
+                self._header(lines, name, "counter")
+                for key, value in series.items():
+                    lines.append(f"{name}{_format_labels(key)} {value}")
+            for name, series in sorted(self._gauges.items()):
+                self._header(lines, name, "gauge")
+                for key, value in series.items():
+                    lines.append(f"{name}{_format_labels(key)} {value}")
+            for name, series in sorted(self._histograms.items()):
+                self._header(lines, name, "histogram")
+                for key, hist in series.items():
+                    for bound, count in zip(hist.buckets, hist.counts):
+                        lines.append(f"{name}_bucket{_format_labels(key, {'le': str(bound)})} {count}")
+                    lines.append(f"{name}_bucket{_format_labels(key, {'le': '+Inf'})} {hist.total}")
+                    lines.append(f"{name}_sum{_format_labels(key)} {hist.sum}")
+                    lines.append(f"{name}_count{_format_labels(key)} {hist.total}")
+        return "\n".join(lines) + "\n"
+
+    def _header(self, lines: List[str], name: str, metric_type: str):
+        if name in self._help:
+            lines.append(f"# HELP {name} {self._help[name]}")
+        lines.append(f"# TYPE {name} {metric_type}")
+
+
+# Глобальный реестр, общий для всех модулей
+metrics = MetricsRegistry()
+metrics.describe("stage_duration_seconds", "Длительность этапов обработки запроса")
+metrics.describe("llm_tokens_total", "Количество токенов, обработанных LLM")
+metrics.describe("llm_tokens_per_second", "Скорость обработки токенов LLM")
+metrics.describe("cache_requests_total", "Обращения к кэшам с разбивкой на попадания и промахи")
+metrics.describe("queue_depth", "Количество запросов в обработке")
+
+
+def new_trace() -> str:
+    """
+    Начинает новую трассу для текущего контекста и возвращает ее идентификатор.
+    Здесь же решается, пишется ли для трассы подробный отладочный вывод (DEBUG_SAMPLE_RATE).
+    """
+    trace_id = uuid.uuid4().hex[:16]
+    _current_trace.set(trace_id)
+    rate = debug_sample_rate()
+    _debug_sampled.set(rate > 0 and random.random() < rate)
+    return trace_id
+
+
+def current_trace() -> Optional[str]:
+    return _current_trace.get()
+
+
+def log_event(event: str, level: int = logging.DEBUG, **fields):
+    """
+    Пишет структурное событие в лог; при LOG_FORMAT=json поля попадают в JSON.
+    Отладочные события семплированных трасс пишутся независимо от уровня логгера.
+    """
+    enabled = logger.isEnabledFor(level)
+    if not enabled and not _debug_sampled.get():
+        return
+    trace_id = current_trace()
+    if trace_id:
+        fields.setdefault("trace_id", trace_id)
+    if enabled:
+        logger.log(level, event, extra={"fields": fields})
+    else:
+        logger.handle(logger.makeRecord(logger.name, level, __file__, 0, event, (), None,
+                                        extra={"fields": fields}))
+
+
+@contextmanager
+def span(stage: str, **attributes):
+    """
+    Измеряет длительность этапа и записывает ее в гистограмму stage_duration_seconds.
+    Атрибуты спана можно дополнить внутри блока: `with span("llm") as s: s["tokens"] = 10`.
+    """
+    attrs: Dict[str, Any] = dict(attributes)
+    start = time.perf_counter()
+    status = "ok"
+    try:
+        yield attrs
+    except Exception:
+        status = "error"
+        raise
+    finally:
+        duration = time.perf_counter() - start
+        metrics.observe("stage_duration_seconds", duration, {"stage": stage})
+        if status == "error":
+            metrics.inc("stage_errors_total", labels={"stage": stage})
+        log_event("span", stage=stage, duration_ms=round(duration * 1000, 3), status=status, **attrs)
+
+
+def observe_stage(stage: str, seconds: float, **attributes):
+    """
+    Записывает длительность этапа, измеренную вне процесса (например, таймингами llama.cpp).
+    """
+    metrics.observe("stage_duration_seconds", seconds, {"stage": stage})
+    log_event("span", stage=stage, duration_ms=round(seconds * 1000, 3), status="ok", **attributes)
+
+
+def record_llm_timings(
+        prompt_tokens: int,
+        completion_tokens: int,
+        prompt_eval_ms: Optional[float] = None,
+        eval_ms: Optional[float] = None
+):
+    """
+    Записывает количество токенов и скорость prompt-eval/decode по таймингам llama.cpp.
+    """
+    metrics.inc("llm_tokens_total", prompt_tokens, {"phase": "prompt"})
+    metrics.inc("llm_tokens_total", completion_tokens, {"phase": "completion"})
+    if prompt_eval_ms is not None:
+        observe_stage("llm_prompt_eval", prompt_eval_ms / 1000, tokens=prompt_tokens)
+        if prompt_eval_ms > 0 and prompt_tokens:
+            metrics.observe("llm_tokens_per_second", prompt_tokens / (prompt_eval_ms / 1000),
+                            {"phase": "prompt_eval"}, buckets=TOKENS_PER_SECOND_BUCKETS)
+    if eval_ms is not None:
+        observe_stage("llm_decode", eval_ms / 1000, tokens=completion_tokens)
+        if eval_ms > 0 and completion_tokens:
+            metrics.observe("llm_tokens_per_second", completion_tokens / (eval_ms / 1000),
+                            {"phase": "decode"}, buckets=TOKENS_PER_SECOND_BUCKETS)
+
+
+def record_cache(cache: str, hit: bool):
+    """
+    Учитывает обращение к кэшу; доля попаданий считается в Prometheus по лейблу result.
+    """
+    metrics.inc("cache_requests_total", labels={"cache": cache, "result": "hit" if hit else "miss"})
+
+
+def cache_hit_rate(cache: str) -> float:
+    hits = metrics.get_counter("cache_requests_total", {"cache": cache, "result": "hit"})
+    misses = metrics.get_counter("cache_requests_total", {"cache": cache, "result": "miss"})
+    total = hits + misses
+    return hits / total if total else 0.0
+
+
+@contextmanager
+def track_in_flight(queue: str = "messages"):
+    """
+    Увеличивает gauge queue_depth на время обработки запроса.
+    """
+    metrics.add_gauge("queue_depth", 1, {"queue": queue})
+    try:
+        yield
+    finally:
+        metrics.add_gauge("queue_depth", -1, {"queue": queue})
+
+
+def debug_sample_rate() -> float:
+    try:
+        return float(os.getenv("DEBUG_SAMPLE_RATE", "0"))
+    except ValueError:
+        return 0.0
+
+
+def should_sample_debug() -> bool:
+    """
+    Пишется ли подробный отладочный вывод для текущей трассы (см. new_trace).
+    """
+    return _debug_sampled.get()
+
+
+class JsonFormatter(logging.Formatter):
+    """Форматирует записи лога в одну JSON-строку."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        payload = {
+            "ts": round(record.created, 3),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        payload.update(getattr(record, "fields", {}))
+        if record.exc_info:
+            payload["exc_info"] = self.formatException(record.exc_info)
+        return json.dumps(payload, ensure_ascii=False, default=str)
+
+
+class KeyValueFormatter(logging.Formatter):
+    """Текстовый формат, дописывающий поля структурного события в виде key=value."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        line = super().format(record)
+        fields = getattr(record, "fields", None)
+        if fields:
+            line += " " + " ".join(f"{k}={v}" for k, v in fields.items())
+        return line
+
+
+def setup_logging():
+    """
+    Настраивает корневой логгер в соответствии с LOG_FORMAT и LOG_LEVEL.
+    """
+    level = getattr(logging, os.getenv("LOG_LEVEL", "INFO").upper(), logging.INFO)
+    handler = logging.StreamHandler()
+    if os.getenv("LOG_FORMAT", "").lower() == "json":
+        handler.setFormatter(JsonFormatter())
+    else:
+        handler.setFormatter(KeyValueFormatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s"))
+    root = logging.getLogger()
+    root.handlers = [handler]
+    root.setLevel(level)
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.rstrip("/") != "/metrics":
+            self.send_response(404)
+            self.end_headers()
+            return
+        body = metrics.render_prometheus().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Не засоряем stdout логами каждого скрейпа
+        pass
+
+
+def start_metrics_server(port: Optional[int] = None, host: str = "127.0.0.1") -> Optional[ThreadingHTTPServer]:
+    """
+    Запускает локальный HTTP-эндпоинт /metrics в фоновом потоке.
+    """
+    if port is None:
+        port = int(os.getenv("METRICS_PORT", "0") or 0)
+    if not port:
+        return None
+    server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    thread = threading.Thread(target=server.serve_forever, name="metrics-server", daemon=True)
+    thread.start()
+    logger.info(f"Эндпоинт метрик запущен на http://{host}:{port}/metrics")
+    return server